@@ -0,0 +1,115 @@
+# Benchmark of the slot based Metric against the dict based implementation it
+# replaced. Prints RAM and render time per series.
+
+import gc
+import benchutil
+from metric import Metric
+
+
+# The original Metric class, reduced to what is benchmarked
+class LegacyMetric:
+    def __init__(self, name, type_name, labels=()):
+        if type(labels) != tuple:
+            labels = (labels,)
+        self.name = name
+        self.type_name = type_name
+        self.help_text = None
+        self.labels = labels
+        self.measurements = {}
+
+    def set_value(self, value, labels=(), ts=None):
+        if type(value) != float:
+            value = float(value)
+        if type(labels) != tuple:
+            labels = (labels,)
+        if len(labels) != len(self.labels):
+            raise Exception("Label count mismatch. Should be %d, not %d",
+                            (len(self.labels), len(labels)))
+        self.measurements[labels] = {
+            "value": value,
+            "ts" : ts
+            }
+
+    def value_row(self, labels=()):
+        if type(labels) != tuple:
+            labels = (labels,)
+        if len(labels) != len(self.labels):
+            raise Exception("Label count mismatch. Should be %d, not %d",
+                            (len(self.labels), len(labels)))
+        row = self.name
+        measurement = self.measurements[labels]
+        if len(labels) > 0:
+            row += "{"
+            for i in range(0, len(labels)):
+                if i > 0:
+                    row += ","
+                row += self.labels[i] + "=\"" + labels[i] + "\""
+            row += "}"
+        row += " %f" % measurement["value"]
+        if measurement["ts"] is not None:
+            row += " %d" % int(measurement["ts"])
+        row += "\n"
+        return row
+
+    def value_rows(self):
+        rows = ''
+        for labels in self.measurements:
+            rows += self.value_row(labels)
+        return rows
+
+
+SERIES = 48
+
+
+def make_labels():
+    labels = []
+    for i in range(SERIES):
+        labels.append((("active", "reactive")[i % 2], ("consume", "produce")[i // 2 % 2],
+                       "L%d" % (i // 4)))
+    return labels
+
+
+def populate(cls, labels):
+    metric = cls("p1_power_watts", "gauge", ("type", "direction", "phase"))
+    for i in range(len(labels)):
+        metric.set_value("%d.%03d" % (i, i), labels[i], 1613583619000)
+    return metric
+
+
+def ram_per_series(cls, labels):
+    # Memory kept alive by a populated metric, divided by the series count
+    gc.collect()
+    if benchutil.MICROPYTHON:
+        before = gc.mem_alloc()
+        metric = populate(cls, labels)
+        gc.collect()
+        used = gc.mem_alloc() - before
+    else:
+        benchutil.tracemalloc.start()
+        metric = populate(cls, labels)
+        gc.collect()
+        used = benchutil.tracemalloc.get_traced_memory()[0]
+        benchutil.tracemalloc.stop()
+    return used / len(labels), metric
+
+
+def main():
+    labels = make_labels()
+    n = 50
+    for name, cls in (('legacy Metric', LegacyMetric), ('Metric', Metric)):
+        ram, metric = ram_per_series(cls, labels)
+        ops = benchutil.ops_per_sec(metric.value_rows, n)
+        alloc = benchutil.alloc_per_op(metric.value_rows, n)
+        print('%-16s %8.1f B RAM/series %8.1f us render/series %8.1f B alloc/series'
+              % (name, ram, 1000000 / ops / len(labels), alloc / len(labels)))
+
+        def set_all():
+            for l in labels:
+                metric.set_value(1.5, l, 1613583619000)
+
+        ops = benchutil.ops_per_sec(set_all, n)
+        print('%-16s %8.2f us set_value' % ('', 1000000 / ops / len(labels)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Benchmark of the streaming P1 parser against the regex based decoder it
+# replaced. Prints telegrams per second and bytes allocated per telegram.
+
+import re
+import benchutil
+from benchutil import TELEGRAM_3PHASE
+from p1parser import P1Parser, timestamp_seconds
+
+
+# The decoding part of the original decode_p1_msg(), without the printing,
+# OLED and metric updates. It is fed the telegram without the leading '/'
+# and everything from the '!', like the original framing did.
+def legacy_decode(msg, values):
+    line_re = re.compile("[\r\n]")
+    flag_re = re.compile("^(...)(.)(.*)$")
+    ts_re = re.compile(r"^(\d\d\d\d)(\d\d)(\d\d)(\d\d)(\d\d)(\d\d).$")
+
+    lines = line_re.split(msg.decode())
+    match = flag_re.match(lines[0])
+    if not match:
+        return
+    for line in lines[1:]:
+        match = re.match(r"^([^(]+)\(([^*]+)(\*(.*))?\)$", line)
+        if match:
+            obis = match.group(1)
+            value = match.group(2)
+            unit = match.group(4)
+            if unit is None:
+                unit = ''
+            if obis == "0-0:1.0.0":
+                match = ts_re.match("20" + value)
+                if match:
+                    continue
+            values[obis] = {
+                "value": value,
+                "unit": unit
+                }
+
+
+def main():
+    n = 200
+    msg = TELEGRAM_3PHASE[1:TELEGRAM_3PHASE.find(b'!')]
+    values = dict()
+
+    def run_legacy():
+        legacy_decode(msg, values)
+
+    benchutil.report('legacy decode_p1_msg', benchutil.ops_per_sec(run_legacy, n),
+                     benchutil.alloc_per_op(run_legacy, n), 'telegram')
+
+    state = [None]
+
+    def on_value(obis, value, unit):
+        if obis == "0-0:1.0.0":
+            state[0] = timestamp_seconds(value)
+            return
+        values[obis] = (value, unit)
+
+    parser = P1Parser(on_value)
+
+    def run_parser():
+        parser.feed(TELEGRAM_3PHASE)
+
+    benchutil.report('P1Parser.feed', benchutil.ops_per_sec(run_parser, n),
+                     benchutil.alloc_per_op(run_parser, n), 'telegram')
+
+    # Feed the telegram in UART sized chunks
+    mv = memoryview(TELEGRAM_3PHASE)
+    chunks = [mv[i:i+32] for i in range(0, len(mv), 32)]
+
+    def run_parser_chunked():
+        for chunk in chunks:
+            parser.feed(chunk)
+
+    benchutil.report('P1Parser.feed 32 byte chunks',
+                     benchutil.ops_per_sec(run_parser_chunked, n),
+                     benchutil.alloc_per_op(run_parser_chunked, n), 'telegram')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Benchmark suite of the hot paths of the exporter, run with CPython
+#
+# Every benchmark reports calls per second and bytes allocated per call. The
+# results can be saved as a baseline and later runs are compared with it,
+# failing if a benchmark got slower, or allocates more, than the threshold.
+#
+#   python3 bench/bench_suite.py --save       # record bench/baseline.json
+#   python3 bench/bench_suite.py              # compare with it
+#   python3 bench/bench_suite.py --threshold 10 --filter framer
+#
+# Timings vary between runs so each benchmark is repeated and the best run
+# is used. A baseline is only meaningful on the machine it was recorded on.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import benchutil
+import hal
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def metric_benchmarks(add):
+    from metric import Metric, Registry
+
+    metric = Metric('p1_power_watts', Metric.TYPE_GAUGE, ('type', 'direction', 'phase'))
+    for phase in ('total', 'L1', 'L2', 'L3'):
+        for direction in ('consume', 'produce'):
+            for kind in ('active', 'reactive'):
+                metric.set_value(1.5, (kind, direction, phase), 1613583619000)
+    labels = ('active', 'consume', 'L1')
+    slot = metric.series(labels)
+    values = [1.0, 2.0]
+
+    def set_value():
+        metric.set_value(values[0], labels, 1613583619000)
+        values.reverse()
+
+    def set_slot():
+        metric.set_slot(slot, values[0], 1613583619000)
+        values.reverse()
+
+    def render():
+        set_slot()
+        registry.render()
+
+    registry = Registry(lambda length: b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % length)
+    registry.register(metric)
+
+    add('metric.set_value', set_value, 5000)
+    add('metric.set_slot', set_slot, 5000)
+    add('metric.value_rows', metric.value_rows, 500)
+    add('metric.lineprotocol_rows', metric.lineprotocol_rows, 500)
+    add('registry.render', render, 500)
+
+
+def framer_benchmarks(add):
+    from framer import TelegramFramer
+
+    telegram = benchutil.TELEGRAM_3PHASE
+    framer = TelegramFramer(lambda mv, crc_ok: None)
+    for size in (1, 16, 64, 256, 1024):
+        chunks = [telegram[i:i+size] for i in range(0, len(telegram), size)]
+
+        def feed(chunks=chunks):
+            for chunk in chunks:
+                framer.feed(chunk)
+
+        add('framer.feed %dB chunks' % size, feed, 20 if size == 1 else 200)
+
+
+def http_benchmarks(add):
+    import httpd
+
+    value = 'My+WiFi%20%C3%A4r+h%C3%A4r%21'
+    query = ('tz_offset=3600&enable_wdt=&enable_wdt=on&ap=&ssid=My+WiFi&password=s%C3%A4kert'
+             '&uart_no=1&uart_tx_gpio=4&uart_rx_gpio=5&uart_baudrate=115200&uart_bits=8')
+    head = (b'GET /metrics HTTP/1.1\r\nHost: 192.168.4.1\r\nUser-Agent: Prometheus/2.40.0\r\n'
+            b'Accept: text/plain\r\nConnection: keep-alive')
+    add('httpd.unescape_form_value', lambda: httpd.unescape_form_value(value), 5000)
+    add('httpd.parse_query', lambda: httpd.parse_query(query), 1000)
+    add('httpd.HttpRequest', lambda: httpd.HttpRequest(head), 2000)
+
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+
+def exporter_benchmarks(add):
+    # The exporter is run on the host fakes, in a directory of its own
+    hal.ROOT = tempfile.mkdtemp(prefix='p1bench') + '/'
+    import p1_exporter
+    import httpd
+
+    p1_exporter.config['enable_wdt'] = False
+    p1_exporter.BOOT_DELAY = False
+    p1_exporter.setup_hardware()
+
+    telegram = benchutil.TELEGRAM_3PHASE
+    msg = memoryview(telegram)[0:telegram.index(b'!') + 1]
+    request = httpd.HttpRequest(b'GET / HTTP/1.1\r\nHost: p1')
+
+    def page(handler):
+        def render():
+            handler(request, httpd.HttpResponse(NullWriter(), request, True))
+        return render
+
+    meter = p1_exporter.meters[0]
+    add('p1_exporter Meter.decode', lambda: meter.decode(msg), 200)
+    add('p1_exporter Meter.on_telegram', lambda: meter.on_telegram(msg, True), 200)
+    add('p1_exporter index page', page(p1_exporter.reply_with_index_page), 100)
+    add('p1_exporter config page', page(p1_exporter.reply_with_config_page), 100)
+
+
+def run(benchmarks, repeat):
+    # The exporter prints what it decodes, which is part of what it costs but
+    # would drown the results
+    results = {}
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        for name, fn, n in benchmarks:
+            sys.stdout = devnull
+            try:
+                ops = max(benchutil.ops_per_sec(fn, n) for i in range(repeat))
+                alloc = benchutil.alloc_per_op(fn, n)
+            finally:
+                sys.stdout = stdout
+            results[name] = {'ops': ops, 'alloc': alloc}
+            benchutil.report(name, ops, alloc)
+    return results
+
+
+def compare(results, baseline, threshold, alloc_slack):
+    # Return the names of the benchmarks that regressed from the baseline
+    regressions = []
+    print()
+    print('%-32s %10s %10s' % ('Compared with baseline', 'ops', 'alloc'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ops_change = (result['ops'] / base['ops'] - 1) * 100
+        alloc_change = result['alloc'] - base['alloc']
+        failed = (ops_change < -threshold or
+                  alloc_change > base['alloc'] * threshold / 100 + alloc_slack)
+        print('%-32s %+9.1f%% %+9.1fB%s' % (name, ops_change, alloc_change,
+                                            '  REGRESSION' if failed else ''))
+        if failed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=15,
+                        help='allowed regression in percent')
+    parser.add_argument('--alloc-slack', type=float, default=16,
+                        help='allocation increase in bytes always allowed')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='only run benchmarks containing this')
+    args = parser.parse_args()
+
+    benchmarks = []
+
+    def add(name, fn, n):
+        if args.filter in name:
+            benchmarks.append((name, fn, n))
+
+    metric_benchmarks(add)
+    framer_benchmarks(add)
+    http_benchmarks(add)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        exporter_benchmarks(add)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    results = run(benchmarks, args.repeat)
+
+    if args.save:
+        baseline = dict()
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline saved to', args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.alloc_slack)
+        if regressions:
+            print('%d benchmarks regressed more than %g%%' % (len(regressions), args.threshold))
+            sys.exit(1)
+    else:
+        print('No baseline, save one with --save')
+
+
+if __name__ == '__main__':
+    main()
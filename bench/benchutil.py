@@ -0,0 +1,112 @@
+# Helpers shared by the benchmarks
+#
+# The benchmarks run under both CPython and MicroPython. On CPython, run them
+# from the repository root:
+#
+#   python3 bench/bench_parser.py
+#
+# On a Pico, mount the repository and put both the root and the bench
+# directory on the module search path:
+#
+#   mpremote mount . exec "import sys; sys.path[:0] = ['', 'bench']; import bench_parser"
+
+import gc
+import sys
+import time
+
+try:
+    from os.path import abspath, dirname
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+except ImportError:
+    # MicroPython, the search path is set up by the caller
+    pass
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+if not MICROPYTHON:
+    import tracemalloc
+
+# A telegram from a Swedish three phase meter
+TELEGRAM_3PHASE = (
+    b'/ELL5\\253833635_A\r\n'
+    b'\r\n'
+    b'0-0:1.0.0(210217184019W)\r\n'
+    b'1-0:1.8.0(00006678.394*kWh)\r\n'
+    b'1-0:2.8.0(00000000.000*kWh)\r\n'
+    b'1-0:3.8.0(00000021.988*kvarh)\r\n'
+    b'1-0:4.8.0(00001020.971*kvarh)\r\n'
+    b'1-0:1.7.0(0001.727*kW)\r\n'
+    b'1-0:2.7.0(0000.000*kW)\r\n'
+    b'1-0:3.7.0(0000.000*kvar)\r\n'
+    b'1-0:4.7.0(0000.309*kvar)\r\n'
+    b'1-0:21.7.0(0001.023*kW)\r\n'
+    b'1-0:41.7.0(0000.350*kW)\r\n'
+    b'1-0:61.7.0(0000.353*kW)\r\n'
+    b'1-0:22.7.0(0000.000*kW)\r\n'
+    b'1-0:42.7.0(0000.000*kW)\r\n'
+    b'1-0:62.7.0(0000.000*kW)\r\n'
+    b'1-0:23.7.0(0000.000*kvar)\r\n'
+    b'1-0:43.7.0(0000.000*kvar)\r\n'
+    b'1-0:63.7.0(0000.000*kvar)\r\n'
+    b'1-0:24.7.0(0000.000*kvar)\r\n'
+    b'1-0:44.7.0(0000.000*kvar)\r\n'
+    b'1-0:64.7.0(0000.000*kvar)\r\n'
+    b'1-0:32.7.0(240.3*V)\r\n'
+    b'1-0:52.7.0(240.1*V)\r\n'
+    b'1-0:72.7.0(241.3*V)\r\n'
+    b'1-0:31.7.0(004.2*A)\r\n'
+    b'1-0:51.7.0(001.6*A)\r\n'
+    b'1-0:71.7.0(001.7*A)\r\n'
+    b'!37EF\r\n'
+    )
+
+
+def ticks_us():
+    if MICROPYTHON:
+        return time.ticks_us()
+    return time.perf_counter_ns() // 1000
+
+
+def ticks_diff(end, start):
+    if MICROPYTHON:
+        return time.ticks_diff(end, start)
+    return end - start
+
+
+def ops_per_sec(fn, n):
+    # Run fn n times and return the number of calls per second
+    gc.collect()
+    start = ticks_us()
+    for i in range(n):
+        fn()
+    elapsed = ticks_diff(ticks_us(), start)
+    if elapsed <= 0:
+        elapsed = 1
+    return n * 1000000 / elapsed
+
+
+def alloc_per_op(fn, n):
+    # Return the number of bytes allocated per call of fn. MicroPython counts
+    # every allocation with the garbage collector disabled. CPython has no
+    # such counter so the tracemalloc peak above the baseline is used.
+    gc.collect()
+    if MICROPYTHON:
+        gc.disable()
+        before = gc.mem_alloc()
+        for i in range(n):
+            fn()
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        return allocated / n
+    tracemalloc.start()
+    fn()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def report(name, ops, alloc, unit='op'):
+    print('%-32s %12.1f %s/s %10.1f B/%s' % (name, ops, unit, alloc, unit))
@@ -0,0 +1,129 @@
+# A stand-in for an InfluxDB server, to test and load test the push of the
+# exporter against
+#
+# Accepts line protocol posted to any path, counts the lines and prints
+# what was received every few seconds. Like InfluxDB 2.x, a write with a
+# field key starting with an underscore is rejected. Failures can be injected:
+#
+#   python3 bench/influxsink.py --port 8086
+#   python3 bench/influxsink.py --fail-every 3 --status 503
+#   python3 bench/influxsink.py --close-every 5
+#
+# Point the exporter at it with influx_host 127.0.0.1 and influx_port 8086.
+
+import argparse
+import asyncio
+import time
+
+
+class Sink:
+    def __init__(self, args):
+        self.args = args
+        self.requests = 0
+        self.lines = 0
+        self.bytes = 0
+        self.failed = 0
+        self.bad_lines = 0
+        self.connections = 0
+        self.last_line = ''
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode().partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                body = await reader.readexactly(length)
+                self.requests += 1
+                args = self.args
+                if args.fail_every and self.requests % args.fail_every == 0:
+                    self.failed += 1
+                    msg = b'{"error":"injected failure"}'
+                    writer.write(b'HTTP/1.1 %d Failure\r\nContent-Type: application/json\r\n'
+                                 b'Content-Length: %d\r\n\r\n%s' % (args.status, len(msg), msg))
+                else:
+                    error = self.receive(body)
+                    if error is None:
+                        writer.write(b'HTTP/1.1 204 No Content\r\n\r\n')
+                    else:
+                        self.failed += 1
+                        msg = b'{"code":"invalid","message":"%s"}' % error.encode()
+                        writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\n'
+                                     b'Content-Length: %d\r\n\r\n%s' % (len(msg), msg))
+                await writer.drain()
+                if args.close_every and self.requests % args.close_every == 0:
+                    break
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    def receive(self, body):
+        # Count the lines of a write, returning why it is rejected, or None
+        self.bytes += len(body)
+        error = None
+        for line in body.decode().splitlines():
+            if not line:
+                continue
+            self.lines += 1
+            # measurement[,tags] fields [timestamp]
+            parts = line.replace('\\ ', '').split(' ')
+            if len(parts) not in (2, 3):
+                self.bad_lines += 1
+            else:
+                for field in parts[1].split(','):
+                    if field.startswith('_'):
+                        self.bad_lines += 1
+                        error = 'field key %s is reserved' % field.partition('=')[0]
+                        break
+            self.last_line = line
+        return error
+
+    async def report(self):
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(self.args.report)
+            print('%7.1fs requests=%d failed=%d connections=%d lines=%d bad=%d bytes=%d'
+                  % (time.monotonic() - start, self.requests, self.failed,
+                     self.connections, self.lines, self.bad_lines, self.bytes))
+            if self.last_line:
+                print('  last:', self.last_line)
+
+
+async def run(args):
+    sink = Sink(args)
+    server = await asyncio.start_server(sink.serve, args.addr, args.port)
+    print('Listening on %s:%d' % (args.addr, args.port))
+    async with server:
+        await sink.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in InfluxDB server')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help='fail every Nth request')
+    parser.add_argument('--status', type=int, default=503,
+                        help='status of the failed requests')
+    parser.add_argument('--close-every', type=int, default=0,
+                        help='close the connection after every Nth request')
+    parser.add_argument('--report', type=float, default=5,
+                        help='seconds between reports')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
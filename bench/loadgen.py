@@ -0,0 +1,381 @@
+# End to end load generator for the P1 exporter
+#
+# Telegrams, replayed from a capture or synthesised for a one or three phase
+# meter, are written to the UART input of the exporter while HTTP scrapers
+# and raw relay clients put load on it. This runs under CPython only. The
+# exporter is either started here, running host.py, or is already running
+# with its UART input reachable as a file, e.g. the pty printed by host.py or
+# a serial adapter wired to the Pico (configure it with stty first).
+#
+#   python3 bench/loadgen.py --spawn --rate 10 --waiters 4 --relay-clients 10
+#   python3 bench/loadgen.py --uart /dev/pts/3 --addr 192.168.4.1 --http-port 80
+#
+# The rate is relative to the meter interval, 0 sends as fast as the UART
+# input accepts. Reported are the sustained telegram rate, the latency from a
+# telegram being written to a /waitmetrics scrape returning it, the scrape
+# duration of /metrics pollers, dropped telegrams and, for a spawned
+# exporter, the peak memory use.
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import benchutil
+import crc16
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_telegram(seq, phases):
+    # Synthesise a telegram with values changing with seq
+    t = time.localtime()
+    lines = [
+        '/ELL5\\253833635_A',
+        '',
+        '0-0:1.0.0(%02d%02d%02d%02d%02d%02dW)' % ((t[0] % 100,) + tuple(t[1:6])),
+        '1-0:1.8.0(%012.3f*kWh)' % (6678.394 + seq / 1000),
+        '1-0:2.8.0(%012.3f*kWh)' % 0,
+        '1-0:3.8.0(%012.3f*kvarh)' % (21.988 + seq / 10000),
+        '1-0:4.8.0(%012.3f*kvarh)' % (1020.971 + seq / 5000),
+        '1-0:1.7.0(%08.3f*kW)' % (1 + seq % 1000 / 1000),
+        '1-0:2.7.0(%08.3f*kW)' % 0,
+        '1-0:3.7.0(%08.3f*kvar)' % 0,
+        '1-0:4.7.0(%08.3f*kvar)' % 0.309,
+        ]
+    for code in (21, 41, 61)[0:phases]:
+        lines.append('1-0:%d.7.0(%08.3f*kW)' % (code, (seq % 100 + code) / 100))
+        lines.append('1-0:%d.7.0(%08.3f*kW)' % (code + 1, 0))
+        lines.append('1-0:%d.7.0(%08.3f*kvar)' % (code + 2, 0))
+        lines.append('1-0:%d.7.0(%08.3f*kvar)' % (code + 3, 0))
+    for code in (32, 52, 72)[0:phases]:
+        lines.append('1-0:%d.7.0(%05.1f*V)' % (code, 230 + seq % 20 / 2))
+    for code in (31, 51, 71)[0:phases]:
+        lines.append('1-0:%d.7.0(%05.1f*A)' % (code, seq % 50 / 10))
+    data = ('\r\n'.join(lines) + '\r\n!').encode()
+    return data + b'%04X\r\n' % crc16.update(0, data, 0, len(data))
+
+
+def read_capture(filename):
+    # Split a capture of the serial stream into telegrams
+    with open(filename, 'rb') as f:
+        data = f.read()
+    telegrams = []
+    start = data.find(b'/')
+    while start >= 0:
+        end = data.find(b'!', start)
+        if end < 0:
+            break
+        end = data.find(b'\n', end)
+        end = len(data) if end < 0 else end + 1
+        telegrams.append(data[start:end])
+        start = data.find(b'/', end)
+    return telegrams
+
+
+def percentiles(samples):
+    if not samples:
+        return 'no samples'
+    samples = sorted(samples)
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+    return 'p50 %7.1f  p90 %7.1f  p99 %7.1f  max %7.1f ms  (%d samples)' % (
+        at(0.5), at(0.9), at(0.99), samples[-1], len(samples))
+
+
+class Feeder(threading.Thread):
+    # Writes the telegrams to the UART input, recording when each one was
+    # completely written. Blocking writes are done in a thread of their own
+    # so a full pty applies back pressure without stalling the clients.
+    def __init__(self, uart, telegrams, interval, count):
+        super().__init__(daemon=True)
+        self.fd = os.open(uart, os.O_WRONLY | os.O_NOCTTY)
+        self.telegrams = telegrams
+        self.interval = interval
+        self.count = count
+        self.written = []
+        self.bytes = 0
+        self.stop = False
+
+    def run(self):
+        next_time = time.monotonic()
+        for seq in range(self.count):
+            if self.stop:
+                break
+            data = self.telegrams(seq)
+            os.write(self.fd, data)
+            self.written.append(time.monotonic())
+            self.bytes += len(data)
+            if self.interval > 0:
+                next_time += self.interval
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def parse_counters(body):
+    # Return the telegram counters of an exposition
+    counters = {}
+    for line in body.split(b'\n'):
+        if line.startswith(b'p1_telegrams_'):
+            name, value = line.split(b' ')[0:2]
+            counters[name.decode()] = float(value)
+    return counters
+
+
+def counter(counters, series):
+    # The value of a counter that the exporter is known to export, its
+    # absence means the name used here is wrong
+    if series not in counters:
+        raise SystemExit('series %s not in the exposition' % series)
+    return int(counters[series])
+
+
+def received(counters):
+    total = 0
+    for result in ('ok', 'crc_error', 'malformed'):
+        total += counters.get('p1_telegrams_total{result="%s"}' % result, 0)
+    return int(total)
+
+
+async def http_get(reader, writer, path):
+    # Request path on a kept alive connection and return the body, None if
+    # the connection was closed before any of the response was received, as
+    # the exporter does after http_max_requests
+    try:
+        writer.write(b'GET %s HTTP/1.1\r\nHost: p1\r\n\r\n' % path.encode())
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    except (BrokenPipeError, ConnectionResetError):
+        return None
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line[15:])
+    return await reader.readexactly(length)
+
+
+class Load:
+    def __init__(self, args):
+        self.args = args
+        self.base = 0
+        self.latencies = []
+        self.scrape_times = []
+        self.errors = 0
+        self.reconnects = 0
+        self.relay_bytes = []
+        self.relay_closed = 0
+        self.done = False
+        self.feeder = None
+
+    async def connect(self):
+        return await asyncio.open_connection(self.args.addr, self.args.http_port)
+
+    def closed(self, requests):
+        # A connection closed between requests is routine once it has served
+        # some, the exporter limits the requests per connection
+        if requests > 0:
+            self.reconnects += 1
+        else:
+            self.errors += 1
+
+    async def waiter(self):
+        # Wait for telegrams on /waitmetrics and time how long it took from
+        # the telegram being written until it could be scraped
+        while not self.done:
+            try:
+                reader, writer = await self.connect()
+                requests = 0
+                while not self.done:
+                    body = await http_get(reader, writer, '/waitmetrics')
+                    if body is None:
+                        self.closed(requests)
+                        break
+                    requests += 1
+                    now = time.monotonic()
+                    index = received(parse_counters(body)) - self.base - 1
+                    written = self.feeder.written
+                    if 0 <= index < len(written):
+                        self.latencies.append((now - written[index]) * 1000)
+                writer.close()
+            except (OSError, asyncio.IncompleteReadError):
+                self.errors += 1
+                await asyncio.sleep(0.1)
+
+    async def scraper(self):
+        # Poll /metrics at the scrape interval
+        while not self.done:
+            try:
+                reader, writer = await self.connect()
+                requests = 0
+                while not self.done:
+                    start = time.monotonic()
+                    if await http_get(reader, writer, '/metrics') is None:
+                        self.closed(requests)
+                        break
+                    requests += 1
+                    self.scrape_times.append((time.monotonic() - start) * 1000)
+                    await asyncio.sleep(self.args.scrape_interval)
+                writer.close()
+            except (OSError, asyncio.IncompleteReadError):
+                self.errors += 1
+                await asyncio.sleep(0.1)
+
+    async def relay_client(self, i):
+        reader, writer = await asyncio.open_connection(self.args.addr, self.args.raw_port)
+        while not self.done:
+            data = await reader.read(4096)
+            if not data:
+                # Disconnected by the exporter
+                self.relay_closed += 1
+                break
+            self.relay_bytes[i] += len(data)
+        writer.close()
+
+    async def counters(self):
+        reader, writer = await self.connect()
+        body = await http_get(reader, writer, '/metrics')
+        writer.close()
+        if body is None:
+            raise SystemExit('the exporter closed the connection for the counters')
+        return parse_counters(body)
+
+    async def run(self, telegrams, interval):
+        args = self.args
+        self.base = received(await self.counters())
+        for i in range(args.relay_clients):
+            self.relay_bytes.append(0)
+        tasks = [asyncio.create_task(self.relay_client(i)) for i in range(args.relay_clients)]
+        await asyncio.sleep(0.2)
+        self.feeder = Feeder(args.uart, telegrams, interval, args.count)
+        tasks += [asyncio.create_task(self.waiter()) for i in range(args.waiters)]
+        tasks += [asyncio.create_task(self.scraper()) for i in range(args.scrapers)]
+        start = time.monotonic()
+        self.feeder.start()
+        while self.feeder.is_alive() and time.monotonic() - start < args.duration:
+            await asyncio.sleep(0.1)
+        self.feeder.stop = True
+        self.feeder.join()
+        sent = len(self.feeder.written)
+        elapsed = time.monotonic() - start
+        # Give the exporter a moment to catch up with what was sent
+        await asyncio.sleep(1)
+        counters = await self.counters()
+        self.done = True
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return sent, elapsed, counters
+
+
+def spawn(args, log):
+    # Start the exporter on this host and return the process and its UART
+    root = tempfile.mkdtemp(prefix='p1load')
+    proc = subprocess.Popen([sys.executable, '-u', os.path.join(ROOT, 'host.py'),
+                             '--root', root, '--addr', args.addr,
+                             '--http-port', str(args.http_port),
+                             '--raw-port', str(args.raw_port)],
+                            stdout=log, stderr=subprocess.STDOUT, cwd=ROOT)
+    uart = None
+    for i in range(100):
+        time.sleep(0.1)
+        with open(log.name) as f:
+            output = f.read()
+        if uart is None and '/dev/' in output:
+            uart = output[output.index('/dev/'):].split()[0]
+        if uart is not None and 'Raw socket listening' in output:
+            return proc, uart
+    proc.kill()
+    raise Exception('The exporter did not start, see %s' % log.name)
+
+
+def peak_memory(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return line.split(':')[1].strip()
+    except OSError:
+        pass
+    return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the P1 exporter')
+    parser.add_argument('--spawn', action='store_true', help='run the exporter using host.py')
+    parser.add_argument('--uart', help='UART input of a running exporter')
+    parser.add_argument('--pid', type=int, help='process of a running exporter, for its memory use')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=8080)
+    parser.add_argument('--raw-port', type=int, default=1234)
+    parser.add_argument('--capture', help='replay telegrams from this file')
+    parser.add_argument('--phases', type=int, choices=(1, 3), default=3,
+                        help='synthesise telegrams for this kind of meter')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='meter telegram interval in seconds, 10 for DSMR 4, 1 for DSMR 5')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='speed relative to the meter, 0 for as fast as possible')
+    parser.add_argument('--count', type=int, default=1000000, help='telegrams to send')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--scrapers', type=int, default=1, help='/metrics pollers')
+    parser.add_argument('--scrape-interval', type=float, default=1)
+    parser.add_argument('--waiters', type=int, default=1, help='/waitmetrics clients')
+    parser.add_argument('--relay-clients', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.capture:
+        captured = read_capture(args.capture)
+        telegrams = lambda seq: captured[seq % len(captured)]
+    else:
+        telegrams = lambda seq: make_telegram(seq, args.phases)
+    interval = args.interval / args.rate if args.rate > 0 else 0
+
+    proc = None
+    if args.spawn:
+        log = tempfile.NamedTemporaryFile(prefix='p1load', suffix='.log', delete=False)
+        proc, args.uart = spawn(args, log)
+        args.pid = proc.pid
+        print('Exporter started, UART %s, output in %s' % (args.uart, log.name))
+    elif args.uart is None:
+        parser.error('either --spawn or --uart is needed')
+
+    load = Load(args)
+    try:
+        sent, elapsed, counters = asyncio.run(load.run(telegrams, interval))
+        memory = peak_memory(args.pid) if args.pid else 'unknown'
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    decoded = received(counters) - load.base
+    too_large = counter(counters, 'p1_telegrams_dropped_total{reason="too_large"}')
+    truncated = counter(counters, 'p1_telegrams_dropped_total{reason="truncated"}')
+    print('Telegrams sent      %8d  %8.1f/s' % (sent, sent / elapsed))
+    print('Telegrams decoded   %8d  %8.1f/s  (ok %d, crc error %d, malformed %d in total)' % (
+        decoded, decoded / elapsed,
+        counter(counters, 'p1_telegrams_total{result="ok"}'),
+        counter(counters, 'p1_telegrams_total{result="crc_error"}'),
+        counter(counters, 'p1_telegrams_total{result="malformed"}')))
+    print('Telegrams dropped   %8d  (too large %d, truncated %d in total)' % (
+        sent - decoded, too_large, truncated))
+    print('Decode to scrape    %s' % percentiles(load.latencies))
+    print('Scrape duration     %s' % percentiles(load.scrape_times))
+    print('HTTP errors         %8d  (%d reconnects after http_max_requests)' % (
+        load.errors, load.reconnects))
+    if load.relay_bytes:
+        print('Relay bytes         %8d sent, per client min %d max %d, %d disconnected' % (
+            load.feeder.bytes, min(load.relay_bytes), max(load.relay_bytes), load.relay_closed))
+    print('Peak memory         %s' % memory)
+
+
+if __name__ == '__main__':
+    main()
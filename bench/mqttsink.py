@@ -0,0 +1,120 @@
+# A stand-in for an MQTT broker, to test the MQTT publish of the exporter
+# against when no real broker is at hand
+#
+# Accepts connections, answers CONNECT and PINGREQ, and prints every
+# message published. Connections can be dropped to test the reconnect:
+#
+#   python3 bench/mqttsink.py --port 1883
+#   python3 bench/mqttsink.py --close-every 20
+#
+# Point the exporter at it with mqtt_host 127.0.0.1 and mqtt_port 1883.
+# With a real broker, mosquitto_sub -v -t 'p1exporter/#' does the same.
+
+import argparse
+import asyncio
+import struct
+
+
+async def read_packet(reader):
+    first = (await reader.readexactly(1))[0]
+    length = 0
+    shift = 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        length |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return first, await reader.readexactly(length)
+
+
+class Sink:
+    def __init__(self, args):
+        self.args = args
+        self.connections = 0
+        self.messages = 0
+        self.retained = {}
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        peer = writer.get_extra_info('peername')
+        will = None
+        try:
+            while True:
+                first, body = await read_packet(reader)
+                kind = first >> 4
+                if kind == 1:
+                    will = self.connect(peer, body)
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:
+                    self.publish(first, body)
+                    if self.args.close_every and self.messages % self.args.close_every == 0:
+                        print('Closing the connection of', peer)
+                        break
+                elif kind == 12:
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:
+                    will = None
+                    break
+                await writer.drain()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+        if will is not None:
+            print('Will %s %s' % will)
+            self.retained[will[0]] = will[1]
+
+    def connect(self, peer, body):
+        pos = 2 + struct.unpack('>H', body[0:2])[0]
+        level, flags, keepalive = struct.unpack('>BBH', body[pos:pos + 4])
+        pos += 4
+        fields = []
+        while pos < len(body):
+            n = struct.unpack('>H', body[pos:pos + 2])[0]
+            fields.append(body[pos + 2:pos + 2 + n].decode())
+            pos += 2 + n
+        print('CONNECT from %s level=%d flags=0x%02x keepalive=%d client=%s'
+              % (peer, level, flags, keepalive, fields[0]))
+        if flags & 0x04:
+            return (fields[1], fields[2])
+        return None
+
+    def publish(self, first, body):
+        n = struct.unpack('>H', body[0:2])[0]
+        topic = body[2:2 + n].decode()
+        pos = 2 + n
+        if first & 0x06:
+            # Packet identifier of QoS 1 and 2
+            pos += 2
+        payload = body[pos:].decode()
+        self.messages += 1
+        if first & 0x01:
+            self.retained[topic] = payload
+        if not self.args.quiet:
+            print('%s%s %s' % (topic, ' (retained)' if first & 0x01 else '', payload))
+
+
+async def run(args):
+    sink = Sink(args)
+    server = await asyncio.start_server(sink.serve, args.addr, args.port)
+    print('Listening on %s:%d' % (args.addr, args.port))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in MQTT broker')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--close-every', type=int, default=0,
+                        help='close the connection after every Nth message')
+    parser.add_argument('--quiet', action='store_true', help='do not print the messages')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# CRC16 as used by DSMR telegrams
+#
+# The checksum is CRC-16/ARC (polynomial 0x8005, reflected, initial value 0)
+# computed over everything from the '/' up to and including the '!'. It is
+# sent as four hex digits following the '!'.
+
+import sys
+from array import array
+
+_MICROPYTHON = sys.implementation.name == 'micropython'
+
+
+def _make_table():
+    table = array('H', bytes(512))
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+        table[i] = crc
+    return table
+
+_TABLE = _make_table()
+
+
+def update(crc, buf, start, end):
+    # Update crc with the bytes buf[start:end] and return the new value
+    table = _TABLE
+    for i in range(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ buf[i]) & 0xff]
+    return crc
+
+
+if _MICROPYTHON:
+    import micropython
+
+    @micropython.viper
+    def _update_viper(crc: int, buf: ptr8, start: int, end: int) -> int:
+        table = ptr16(_TABLE)
+        i = start
+        while i < end:
+            crc = (crc >> 8) ^ table[(crc ^ buf[i]) & 0xff]
+            i += 1
+        return crc
+
+    update = _update_viper
+
+
+def parse(digits):
+    # Parse the four hex digits following the '!'. None is returned if they
+    # are not valid.
+    crc = 0
+    for b in digits:
+        if 0x30 <= b <= 0x39:
+            b -= 0x30
+        elif 0x41 <= b <= 0x46:
+            b -= 0x37
+        elif 0x61 <= b <= 0x66:
+            b -= 0x57
+        else:
+            return None
+        crc = (crc << 4) | b
+    return crc
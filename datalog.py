@@ -0,0 +1,289 @@
+# Persistent log of metric values on the flash filesystem
+#
+# Records are appended to segment files of about a fixed size, next to
+# config.json, and the oldest segment is removed when there are too many.
+# Records are collected in RAM and written a flash block at a time, or when
+# the oldest has waited long enough, to limit the wear and the number of
+# slow writes. What has not been written yet is lost on a power cut.
+#
+# A segment starts with a header listing the series:
+#
+#   b'P1L1', base time u32, series count u16, (name length u16, name)...
+#
+# followed by one record per logged telegram:
+#
+#   seconds since the previous record, or the base time   varint
+#   bitmap of the series that changed                     (count + 7) // 8 bytes
+#   change of every changed series, in thousandths        zigzag varint
+#
+# Values start at 0 in every segment, so a segment can be read on its own.
+# A three phase meter takes about 30 bytes per record.
+
+import struct
+from hal import uos
+
+MAGIC = b'P1L1'
+PREFIX = 'p1log_'
+SUFFIX = '.bin'
+# Values are stored as integers in thousandths
+SCALE = 1000
+# Records are written when this much is collected, a littlefs block
+BLOCK_SIZE = 4096
+# Amount read at a time from a segment when streaming it
+READ_SIZE = 1024
+# Rows are collected into chunks of about this size before being sent
+CHUNK_SIZE = 1024
+
+
+def _csv_name(name):
+    # Quote a series name, which contains both quotes and commas
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _put_varint(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _get_varint(data, pos):
+    # Return the varint at pos and the position after it. IndexError is
+    # raised if data ends within it.
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+class DataLog:
+    def __init__(self, root, metrics, segment_size, segments, interval, flush_seconds):
+        self.root = root
+        self.metrics = metrics
+        self.segment_size = segment_size
+        self.segments = segments
+        self.interval = interval
+        self.flush_seconds = flush_seconds
+        # Numbers of the segments on flash, oldest first. A new segment is
+        # always started at boot.
+        self.seqs = []
+        for name in uos.listdir(root):
+            if name.startswith(PREFIX) and name.endswith(SUFFIX):
+                try:
+                    self.seqs.append(int(name[len(PREFIX):-len(SUFFIX)]))
+                except ValueError:
+                    pass
+        self.seqs.sort()
+        self.seq = None
+        # Bytes of the current segment on flash
+        self.size = 0
+        self.records = 0
+        self._buf = bytearray()
+        self._buf_ts = 0
+        self._series = []
+        self._last = []
+        self._last_ts = None
+        self._zeros = b''
+
+    def path(self, seq):
+        return self.root + '%s%08d%s' % (PREFIX, seq, SUFFIX)
+
+    def _series_count(self):
+        count = 0
+        for metric in self.metrics:
+            count += metric.series_count()
+        return count
+
+    def _start(self, ts):
+        # Start a new segment at time ts, with the series there are now
+        self.flush()
+        self.seq = self.seqs[-1] + 1 if self.seqs else 1
+        self.seqs.append(self.seq)
+        while len(self.seqs) > self.segments:
+            try:
+                uos.remove(self.path(self.seqs[0]))
+            except OSError:
+                pass
+            self.seqs.pop(0)
+        self.size = 0
+        self._series = []
+        names = []
+        for metric in self.metrics:
+            for slot in range(metric.series_count()):
+                self._series.append((metric, slot))
+                names.append(metric.series_name(slot).encode())
+        self._last = [0] * len(self._series)
+        self._last_ts = ts
+        self._zeros = bytes((len(self._series) + 7) // 8)
+        self._buf_ts = ts
+        buf = self._buf
+        buf.extend(struct.pack('<4sIH', MAGIC, ts, len(names)))
+        for name in names:
+            buf.extend(struct.pack('<H', len(name)))
+            buf.extend(name)
+
+    def record(self, ts):
+        # Log the current values, for the time ts in seconds, if at least
+        # interval seconds passed since the last record
+        last_ts = self._last_ts
+        if last_ts is not None and 0 <= ts - last_ts < self.interval:
+            return
+        if (self.seq is None or last_ts is None or ts < last_ts or
+                self._series_count() != len(self._series)):
+            self._start(ts)
+            last_ts = ts
+        buf = self._buf
+        if len(buf) == 0:
+            self._buf_ts = ts
+        _put_varint(buf, ts - last_ts)
+        bitmap = len(buf)
+        buf.extend(self._zeros)
+        last = self._last
+        series = self._series
+        for i in range(len(series)):
+            metric, slot = series[i]
+            value = int(round(metric.slot_value(slot) * SCALE))
+            delta = value - last[i]
+            if delta != 0:
+                last[i] = value
+                buf[bitmap + (i >> 3)] |= 1 << (i & 7)
+                _put_varint(buf, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        self._last_ts = ts
+        self.records += 1
+        if len(buf) >= BLOCK_SIZE or ts - self._buf_ts >= self.flush_seconds:
+            self.flush()
+        if self.size + len(buf) >= self.segment_size:
+            self.flush()
+            self.seq = None
+
+    def flush(self):
+        # Write the collected records to flash
+        if len(self._buf) == 0:
+            return
+        try:
+            with open(self.path(self.seq), 'ab') as f:
+                f.write(self._buf)
+            self.size += len(self._buf)
+        except OSError as e:
+            print("### Data log write failed: %s" % e)
+        self._buf = bytearray()
+
+    def _read(self, f, n):
+        data = f.read(n)
+        if len(data) != n:
+            raise ValueError('short read')
+        return data
+
+    def _read_header(self, f):
+        magic, base, count = struct.unpack('<4sIH', self._read(f, 10))
+        if magic != MAGIC:
+            raise ValueError('bad magic')
+        names = []
+        for i in range(count):
+            n = struct.unpack('<H', self._read(f, 2))[0]
+            names.append(self._read(f, n).decode())
+        return base, names
+
+    def _bases(self):
+        # Return the base time of every segment, None for unreadable ones
+        bases = []
+        for seq in self.seqs:
+            try:
+                with open(self.path(seq), 'rb') as f:
+                    bases.append(self._read_header(f)[0])
+            except (OSError, ValueError):
+                bases.append(None)
+        return bases
+
+    async def stream(self, send, since=0):
+        # Stream all records from since, in seconds, as CSV using the
+        # coroutine send(data). A new header line is sent wherever the series
+        # change.
+        self.flush()
+        seqs = list(self.seqs)
+        bases = self._bases()
+        current = self.seq
+        current_size = self.size
+        header = None
+        for i in range(len(seqs)):
+            # Skip segments that end before since
+            if i + 1 < len(bases) and bases[i + 1] is not None and bases[i + 1] <= since:
+                continue
+            # The current segment may be appended to while it is read
+            limit = current_size if seqs[i] == current else None
+            header = await self._stream_segment(send, seqs[i], since, header, limit)
+        if header is None:
+            await send('time\n')
+
+    async def _stream_segment(self, send, seq, since, header, limit):
+        try:
+            f = open(self.path(seq), 'rb')
+        except OSError:
+            # Removed since the stream started
+            return header
+        with f:
+            try:
+                ts, names = self._read_header(f)
+            except (ValueError, UnicodeError):
+                print("### Data log segment %d is broken" % seq)
+                return header
+            line = 'time,' + ','.join([_csv_name(name) for name in names]) + '\n'
+            if line != header:
+                header = line
+                await send(header)
+            count = len(names)
+            nbytes = (count + 7) // 8
+            values = [0] * count
+            remaining = None
+            if limit is not None:
+                remaining = limit - f.tell()
+            # Longest possible record
+            read_size = max(READ_SIZE, 5 + nbytes + 10 * count)
+            data = b''
+            pos = 0
+            eof = False
+            chunk = []
+            chunk_len = 0
+            while True:
+                if not eof and len(data) - pos < read_size:
+                    n = read_size if remaining is None else min(read_size, remaining)
+                    more = f.read(n)
+                    if remaining is not None:
+                        remaining -= len(more)
+                    if len(more) == 0:
+                        eof = True
+                    data = data[pos:] + more
+                    pos = 0
+                if pos >= len(data):
+                    break
+                try:
+                    delta, pos = _get_varint(data, pos)
+                    bitmap = pos
+                    pos += nbytes
+                    for i in range(count):
+                        if data[bitmap + (i >> 3)] & (1 << (i & 7)):
+                            z, pos = _get_varint(data, pos)
+                            values[i] += (z >> 1) ^ -(z & 1)
+                except IndexError:
+                    # Cut short by a power cut while writing
+                    break
+                ts += delta
+                if ts < since:
+                    continue
+                line = '%d' % ts
+                for value in values:
+                    line += ',%.3f' % (value / SCALE)
+                line += '\n'
+                chunk.append(line)
+                chunk_len += len(line)
+                if chunk_len >= CHUNK_SIZE:
+                    await send(''.join(chunk))
+                    chunk = []
+                    chunk_len = 0
+            await send(''.join(chunk))
+        return header
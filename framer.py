@@ -0,0 +1,203 @@
+# Telegram framing for the P1 serial stream
+#
+# Incoming bytes are read straight into a preallocated buffer where they are
+# scanned for the '/' starting and the '!' ending a telegram. A telegram is
+# always moved to the start of the buffer when its '/' is found so a complete
+# telegram can be handed on as a memoryview into the buffer, without copying.
+# Bytes outside of telegrams are discarded and the buffer space reused.
+#
+# The CRC is updated as bytes arrive so it is ready as soon as the '!' is
+# seen. It only remains to compare it with the four digits following it.
+
+import sys
+import crc16
+
+MAX_SIZE = 2048
+
+_SLASH = 0x2f
+_EXCL = 0x21
+_CR = 0x0d
+_LF = 0x0a
+
+# Room after a maximum size telegram for the CRC digits
+_CRC_ROOM = 8
+
+
+if sys.implementation.name == 'micropython':
+    import micropython
+
+    @micropython.viper
+    def _find2(buf: ptr8, a: int, b: int, start: int, end: int) -> int:
+        i = start
+        while i < end:
+            c = buf[i]
+            if c == a or c == b:
+                return i
+            i += 1
+        return -1
+else:
+    def _find2(buf, a, b, start, end):
+        # Return the index of the first a or b in buf[start:end], or -1
+        i = buf.find(a, start, end)
+        j = buf.find(b, start, end if i < 0 else i)
+        if j >= 0:
+            return j
+        return i
+
+
+class TelegramFramer:
+    def __init__(self, on_telegram, max_size=MAX_SIZE):
+        # on_telegram(mv, crc_ok) is called with a memoryview of each
+        # complete telegram, from the '/' up to and including the '!'. The
+        # view is only valid during the call. crc_ok is True or False, or
+        # None if the meter does not send a CRC. During the call, crc holds
+        # a memoryview of the CRC digits following the '!', empty if none.
+        self.on_telegram = on_telegram
+        self.max_size = max_size
+        self.buf = bytearray(max_size + _CRC_ROOM)
+        self.mv = memoryview(self.buf)
+        self._wpos = 0
+        self._scan = 0
+        self._in_telegram = False
+        self._end = -1
+        self._crc = 0
+        self.crc = self.mv[0:0]
+        self.bytes = 0
+        self.telegrams = 0
+        self.crc_errors = 0
+        self.dropped_too_large = 0
+        self.dropped_truncated = 0
+
+    def dropped(self):
+        return self.dropped_too_large + self.dropped_truncated
+
+    def free(self):
+        # Return a memoryview of the free part of the buffer to read into
+        return self.mv[self._wpos:]
+
+    def received(self, n):
+        # Account for n bytes read into the view returned by free(). A
+        # memoryview of the new bytes is returned. It is valid until
+        # process() is called.
+        if not n:
+            return self.mv[0:0]
+        start = self._wpos
+        self._wpos += n
+        self.bytes += n
+        return self.mv[start:self._wpos]
+
+    def readinto(self, stream):
+        # Read what is available from stream directly into the buffer
+        return self.received(stream.readinto(self.free()))
+
+    def feed(self, data):
+        # Copy data into the buffer and process it
+        pos = 0
+        while pos < len(data):
+            n = min(len(data) - pos, len(self.buf) - self._wpos)
+            if n == 0:
+                # process() always leaves room, but never spin if it did not
+                self._drop_too_large()
+                continue
+            self.buf[self._wpos:self._wpos+n] = data[pos:pos+n]
+            self._wpos += n
+            self.bytes += n
+            pos += n
+            self.process()
+
+    def process(self):
+        # Scan the bytes received since the last call
+        buf = self.buf
+        i = self._scan
+        while True:
+            if self._end >= 0:
+                if not self._check_crc():
+                    # Waiting for more CRC digits
+                    break
+                i = 0
+                continue
+            if i >= self._wpos:
+                break
+            if not self._in_telegram:
+                j = _find2(buf, _SLASH, _SLASH, i, self._wpos)
+                if j < 0:
+                    i = self._wpos
+                    break
+                self._start(j)
+                i = 1
+                continue
+            j = _find2(buf, _SLASH, _EXCL, i, self._wpos)
+            if j < 0:
+                self._crc = crc16.update(self._crc, buf, i, self._wpos)
+                i = self._wpos
+                break
+            if buf[j] == _SLASH:
+                # The end of the previous telegram never arrived
+                self.dropped_truncated += 1
+                self._start(j)
+                i = 1
+                continue
+            self._crc = crc16.update(self._crc, buf, i, j + 1)
+            self._end = j
+            i = j + 1
+        if not self._in_telegram:
+            # Nothing worth keeping
+            self._wpos = 0
+            i = 0
+        elif self._wpos >= self.max_size and not 0 <= self._end < self.max_size:
+            # Too large, whether or not its '!' made it into the room for the
+            # CRC. With the '!' within max_size the CRC always fits.
+            self._drop_too_large()
+            i = 0
+        self._scan = i
+
+    def _drop_too_large(self):
+        self.dropped_too_large += 1
+        self._in_telegram = False
+        self._end = -1
+        self._wpos = 0
+        self._scan = 0
+
+    def _start(self, pos):
+        # Start a new telegram at the '/' found at pos
+        self._discard(pos)
+        self._in_telegram = True
+        self._crc = crc16.update(0, self.buf, 0, 1)
+
+    def _check_crc(self):
+        # Handle the CRC following the '!'. False is returned if all of it
+        # has not been received yet.
+        end = self._end
+        avail = self._wpos - end - 1
+        if avail < 1:
+            return False
+        first = self.buf[end+1]
+        if first == _CR or first == _LF:
+            crc_ok = None
+            length = 0
+        elif avail < 4:
+            return False
+        else:
+            length = 4
+            crc_ok = crc16.parse(self.mv[end+1:end+5]) == self._crc
+            if not crc_ok:
+                self.crc_errors += 1
+        self._end = -1
+        self._in_telegram = False
+        self.telegrams += 1
+        self.crc = self.mv[end+1:end+1+length]
+        self.on_telegram(self.mv[0:end+1], crc_ok)
+        self._discard(end + 1 + length)
+        return True
+
+    def _discard(self, n):
+        # Drop the first n bytes of the buffer, moving the rest to the start.
+        # If the ranges overlap the rest is copied out first, as a copy from
+        # a memoryview of the buffer itself may not be done as a memmove.
+        remain = self._wpos - n
+        if n > 0 and remain > 0:
+            if n >= remain:
+                self.buf[0:remain] = self.mv[n:n+remain]
+            else:
+                self.buf[0:remain] = self.buf[n:n+remain]
+        self._wpos = remain
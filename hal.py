@@ -0,0 +1,261 @@
+# Hardware abstraction layer
+#
+# On the Pico W this just hands out the MicroPython modules and classes used
+# by the exporter. On CPython the hardware is replaced by fakes, so that the
+# real parsing and serving code can be run, profiled and load tested on a
+# host. See host.py for how the host variant is started.
+#
+#   Pin, UART, I2C, WDT, ADC   machine classes
+#   network, ubinascii, uos    MicroPython modules
+#   ticks_ms, ticks_us,
+#   ticks_diff                 from time
+#   mem_free, mem_alloc        from gc, 0 on the host
+#   uart_stream(uart)          stream to await UART data on
+#   uart_pace(uart, n)         called by a thread after reading n bytes
+#   sleep_ms                   from time
+#   ThreadSafeFlag             asyncio.ThreadSafeFlag, set from a thread
+#   ROOT                       directory holding config.json and web files
+
+import sys
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+if MICROPYTHON:
+    from machine import Pin, UART, I2C, WDT, ADC
+    from time import ticks_ms, ticks_us, ticks_diff, sleep_ms
+    from gc import mem_free, mem_alloc
+    import network
+    import ubinascii
+    import uos
+    import uasyncio as asyncio
+
+    ROOT = '/'
+
+    def uart_stream(uart):
+        return asyncio.StreamReader(uart)
+
+    def uart_pace(uart, n):
+        pass
+
+    ThreadSafeFlag = asyncio.ThreadSafeFlag
+
+else:
+    import asyncio
+    import binascii as ubinascii
+    import os
+    import os as uos
+    import threading
+    import time
+    import tty
+
+    # Set by host.py before the exporter is imported
+    ROOT = './'
+    UART_SOURCE = None
+    UART_LOOP = False
+
+    _start = time.monotonic()
+
+    def ticks_ms():
+        return int((time.monotonic() - _start) * 1000)
+
+    def ticks_us():
+        return int((time.monotonic() - _start) * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+    # The heap of the host is not what is being measured
+    def mem_free():
+        return 0
+
+    def mem_alloc():
+        return 0
+
+    class Pin:
+        IN = 0
+        OUT = 1
+        PULL_UP = 1
+
+        def __init__(self, id, mode=IN, pull=None):
+            self.id = id
+            self._value = 0
+
+        def value(self, value=None):
+            if value is None:
+                return self._value
+            self._value = 1 if value else 0
+
+        def on(self):
+            self._value = 1
+
+        def off(self):
+            self._value = 0
+
+        def toggle(self):
+            self._value ^= 1
+
+    class I2C:
+        def __init__(self, id, **kwargs):
+            self.id = id
+
+    class ADC:
+        def __init__(self, id):
+            self.id = id
+
+        def read_u16(self):
+            # The internal temperature sensor at 27 degrees
+            return int(0.706 / 3.3 * 65535)
+
+    class WDT:
+        # Restarts the process, like the watchdog resets the Pico, if not
+        # fed in time
+        def __init__(self, id=0, timeout=5000):
+            self.timeout = timeout / 1000
+            self._timer = None
+            self.feed()
+
+        def feed(self):
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.timeout, self._expired)
+            self._timer.daemon = True
+            self._timer.start()
+
+        def _expired(self):
+            print('*** Watchdog timeout, restarting')
+            sys.stdout.flush()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    class UART:
+        # Reads from a pseudo-terminal, for something else to write P1
+        # data to, or from a file at the speed of the configured baudrate
+        INV_RX = 1
+
+        def __init__(self, id, baudrate=115200, bits=8, parity=None, stop=1,
+                     tx=None, rx=None, rxbuf=256, invert=0):
+            self.baudrate = baudrate
+            self.rxbuf = rxbuf
+            if UART_SOURCE is None:
+                self.fd, self._slave = os.openpty()
+                tty.setraw(self._slave)
+                os.set_blocking(self.fd, False)
+                self.file = None
+                print('UART %d on %s' % (id, os.ttyname(self._slave)))
+            else:
+                self.fd = None
+                self.file = open(UART_SOURCE, 'rb')
+                print('UART %d reading %s' % (id, UART_SOURCE))
+
+        def readinto(self, buf):
+            n = min(len(buf), self.rxbuf)
+            if self.file is not None:
+                n = self.file.readinto(memoryview(buf)[0:n])
+                if n == 0 and UART_LOOP:
+                    self.file.seek(0)
+                return n or None
+            try:
+                data = os.read(self.fd, n)
+            except BlockingIOError:
+                return None
+            buf[0:len(data)] = data
+            return len(data)
+
+        def write(self, data):
+            if self.fd is not None:
+                return os.write(self.fd, data)
+            return len(data)
+
+        async def wait(self, n):
+            # Called after n bytes were read, or nothing if n is 0. A file
+            # is read at the pace of the baudrate, a pty when there is data.
+            if self.file is not None:
+                # Nothing more to read at the end of the file
+                await asyncio.sleep(n * 10 / self.baudrate if n else 1)
+                return
+            if n:
+                return
+            loop = asyncio.get_running_loop()
+            readable = loop.create_future()
+
+            def ready():
+                if not readable.done():
+                    readable.set_result(None)
+
+            loop.add_reader(self.fd, ready)
+            try:
+                await readable
+            finally:
+                loop.remove_reader(self.fd)
+
+    class _UARTStream:
+        def __init__(self, uart):
+            self.uart = uart
+
+        async def readinto(self, buf):
+            while True:
+                n = self.uart.readinto(buf)
+                if n:
+                    await self.uart.wait(n)
+                    return n
+                await self.uart.wait(0)
+
+    def uart_stream(uart):
+        return _UARTStream(uart)
+
+    def uart_pace(uart, n):
+        # A file is read at the pace of the baudrate by a thread too
+        if uart.file is not None:
+            time.sleep(n * 10 / uart.baudrate if n else 1)
+
+    class ThreadSafeFlag:
+        # Must be made in the event loop it is waited on in
+        def __init__(self):
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+
+        def set(self):
+            self._loop.call_soon_threadsafe(self._event.set)
+
+        async def wait(self):
+            await self._event.wait()
+            self._event.clear()
+
+    class _WLAN:
+        def __init__(self, interface):
+            self.interface = interface
+            self._active = False
+            self._config = {'essid': 'p1exporter', 'channel': 1,
+                            'mac': b'\x02\x00\x00\x00\x00\x01'}
+
+        def active(self, active=None):
+            if active is None:
+                return self._active
+            self._active = active
+
+        def config(self, *args, **kwargs):
+            if args:
+                return self._config[args[0]]
+            self._config.update(kwargs)
+
+        def ifconfig(self):
+            return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+        def scan(self):
+            return []
+
+        def connect(self, ssid, password):
+            self._active = True
+
+        def disconnect(self):
+            pass
+
+        def status(self, param=None):
+            return 3
+
+    class network:
+        STA_IF = 0
+        AP_IF = 1
+        WLAN = _WLAN
@@ -0,0 +1,73 @@
+# Hand-off of decoded telegrams from the UART thread to the event loop
+#
+# In dual-core mode a thread on the second core reads the UARTs, frames the
+# telegrams and decodes them, while the event loop on the first core does
+# the networking and serving. Each telegram is decoded into the back buffer
+# of a TripleBuffer, which is swapped with the front buffer under a lock
+# when the telegram is complete. The event loop takes the front buffer by
+# swapping it with a spare one under the same lock, and applies it to the
+# metrics after releasing the lock. A buffer is thereby never seen half
+# written, the metrics never hold part of a telegram, and core 1 is only
+# ever held up for a swap. A telegram that was not taken before the next
+# one is handed over is skipped.
+
+import _thread
+
+
+class DecodedTelegram:
+    __slots__ = ('header', 'timestamp', 'values', 'ok', 'crc_ok', 'telegram', 'crc')
+
+    def __init__(self):
+        # (OBIS code, value, unit) of every value, in telegram order
+        self.values = []
+        self.clear()
+
+    def clear(self):
+        self.header = None
+        # Epoch milliseconds of the 0-0:1.0.0 value, None if not seen
+        self.timestamp = None
+        self.values.clear()
+        self.ok = False
+        self.crc_ok = None
+        # The telegram and its CRC digits, if wanted by the raw relay
+        self.telegram = None
+        self.crc = None
+
+
+class TripleBuffer:
+    def __init__(self, new):
+        # new() makes a buffer. The producer fills in back and calls
+        # publish(), the consumer calls take() and uses the buffer it got
+        # until its next call.
+        self.back = new()
+        self._front = new()
+        self._spare = new()
+        self._lock = _thread.allocate_lock()
+        self._ready = False
+        self.skipped = 0
+        # Set, if not None, when a buffer is handed over. It must be safe to
+        # set from another thread, like asyncio.ThreadSafeFlag.
+        self.flag = None
+
+    def publish(self):
+        # Hand over the back buffer, getting the old front one to fill next
+        self._lock.acquire()
+        if self._ready:
+            self.skipped += 1
+        self.back, self._front = self._front, self.back
+        self._ready = True
+        self._lock.release()
+        if self.flag is not None:
+            self.flag.set()
+
+    def take(self):
+        # Return the buffer handed over since the last call, None if there
+        # was none. The buffer returned by the last call is handed back.
+        self._lock.acquire()
+        taken = None
+        if self._ready:
+            self._ready = False
+            self._front, self._spare = self._spare, self._front
+            taken = self._spare
+        self._lock.release()
+        return taken
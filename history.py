@@ -0,0 +1,174 @@
+# Recent history of metric values
+#
+# Every decoded telegram adds a row holding the current value of every
+# series of the given metrics. Rows are kept in a ring of fixed size, one
+# array per column, so the memory use is known up front. Recording a row
+# still allocates a little on MicroPython, as every value read from a metric
+# is boxed as a float object before being stored in its column. A series
+# first seen after recording started gets a new column, filled with NaN for
+# the rows recorded before it. If a new column does not fit in the heap the
+# history is started over at half the size, and so on, rather than failing.
+#
+# The history is streamed out as CSV, either the rows as recorded or
+# downsampled to the min, max and average of every step seconds.
+
+from array import array
+
+# Rows are collected into chunks of about this size before being sent
+CHUNK_SIZE = 1024
+
+
+def _csv_name(name):
+    # Quote a series name, which contains both quotes and commas
+    return '"' + name.replace('"', '""') + '"'
+
+
+class History:
+    def __init__(self, metrics, size):
+        self.metrics = metrics
+        self._resize(size)
+
+    def _resize(self, size):
+        # Start over with room for size rows
+        self.size = size
+        self.ts = None
+        self._columns = None
+        self.ts = array('i', bytes(4 * size))
+        # Columns per metric, indexed by series slot
+        self._columns = [[] for metric in self.metrics]
+        # Total number of rows ever recorded
+        self.written = 0
+
+    def record(self, ts):
+        # Add a row with the current values, for the time ts in seconds
+        if self.size == 0:
+            return
+        try:
+            self._add_columns()
+        except MemoryError:
+            print('*** History of %d rows does not fit, keeping %d' % (self.size, self.size // 2))
+            self._resize(self.size // 2)
+            self.record(ts)
+            return
+        pos = self.written % self.size
+        self.ts[pos] = ts
+        for i in range(len(self.metrics)):
+            metric = self.metrics[i]
+            columns = self._columns[i]
+            for slot in range(metric.series_count()):
+                columns[slot][pos] = metric.slot_value(slot)
+        self.written += 1
+
+    def _add_columns(self):
+        # Add the columns of the series that are new since the last row
+        for i in range(len(self.metrics)):
+            columns = self._columns[i]
+            while len(columns) < self.metrics[i].series_count():
+                columns.append(self._new_column())
+
+    def _new_column(self):
+        column = array('f', bytes(4 * self.size))
+        nan = float('nan')
+        for i in range(self.size):
+            column[i] = nan
+        return column
+
+    def series(self, prefix=''):
+        # Return the names and columns of the series starting with prefix
+        series = []
+        for i in range(len(self.metrics)):
+            metric = self.metrics[i]
+            columns = self._columns[i]
+            for slot in range(len(columns)):
+                name = metric.series_name(slot)
+                if name.startswith(prefix):
+                    series.append((name, columns[slot]))
+        return series
+
+    def _oldest(self):
+        return max(0, self.written - self.size)
+
+    def first(self, since):
+        # Return the number of the first row at or after since, in seconds.
+        # A negative since is relative to the newest row.
+        lo = self._oldest()
+        hi = self.written
+        if since < 0 and hi > 0:
+            since += self.ts[(hi - 1) % self.size]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[mid % self.size] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    async def stream(self, send, prefix='', since=0, step=0):
+        # Stream the rows from since, for the series starting with prefix,
+        # using the coroutine send(data)
+        series = self.series(prefix)
+        columns = [column for name, column in series]
+        header = 'time'
+        for name, column in series:
+            if step > 0:
+                header += ',' + _csv_name(name + ' min')
+                header += ',' + _csv_name(name + ' max')
+                header += ',' + _csv_name(name + ' avg')
+            else:
+                header += ',' + _csv_name(name)
+        await send(header + '\n')
+
+        end = self.written
+        chunk = []
+        chunk_len = 0
+        bucket = None
+        row = self.first(since)
+        while row < end:
+            if row < self._oldest():
+                # Overwritten while streaming
+                row = self._oldest()
+                continue
+            pos = row % self.size
+            row += 1
+            ts = self.ts[pos]
+            if step > 0:
+                start = ts - ts % step
+                if start != bucket:
+                    if bucket is not None:
+                        line = self._bucket_line(bucket, mins, maxs, sums, count)
+                        chunk.append(line)
+                        chunk_len += len(line)
+                    bucket = start
+                    mins = [column[pos] for column in columns]
+                    maxs = list(mins)
+                    sums = list(mins)
+                    count = 1
+                else:
+                    for i in range(len(columns)):
+                        value = columns[i][pos]
+                        if value < mins[i]:
+                            mins[i] = value
+                        if value > maxs[i]:
+                            maxs[i] = value
+                        sums[i] += value
+                    count += 1
+            else:
+                line = '%d' % ts
+                for column in columns:
+                    line += ',%.3f' % column[pos]
+                line += '\n'
+                chunk.append(line)
+                chunk_len += len(line)
+            if chunk_len >= CHUNK_SIZE:
+                await send(''.join(chunk))
+                chunk = []
+                chunk_len = 0
+        if bucket is not None:
+            chunk.append(self._bucket_line(bucket, mins, maxs, sums, count))
+        await send(''.join(chunk))
+
+    def _bucket_line(self, bucket, mins, maxs, sums, count):
+        line = '%d' % bucket
+        for i in range(len(mins)):
+            line += ',%.3f,%.3f,%.3f' % (mins[i], maxs[i], sums[i] / count)
+        return line + '\n'
@@ -0,0 +1,52 @@
+# Run the P1 exporter on a host, using CPython, for development, profiling
+# and load testing
+#
+# The hardware is replaced by the fakes in hal.py. P1 data is read from a
+# pseudo-terminal, whose name is printed at startup, or from a file:
+#
+#   python3 host.py
+#   cat telegrams.txt > /dev/pts/N
+#
+#   python3 host.py --uart telegrams.txt --loop
+#
+# The exporter then serves HTTP on localhost:8080 and the raw relay on
+# localhost:1234. To profile it:
+#
+#   python3 -m cProfile -o p1.prof host.py --uart telegrams.txt --loop
+#
+# The configuration and the web files are taken from the --root directory,
+# the current directory by default.
+
+import argparse
+import asyncio
+import os
+import hal
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the P1 exporter on a host')
+    parser.add_argument('--root', default='.',
+                        help='directory holding config.json and the web files')
+    parser.add_argument('--uart', default=None,
+                        help='file to read P1 data from instead of a pty')
+    parser.add_argument('--loop', action='store_true',
+                        help='start over when the end of the --uart file is reached')
+    parser.add_argument('--addr', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--http-port', type=int, default=8080)
+    parser.add_argument('--raw-port', type=int, default=1234)
+    args = parser.parse_args()
+
+    hal.ROOT = os.path.join(args.root, '')
+    hal.UART_SOURCE = args.uart
+    hal.UART_LOOP = args.loop
+
+    import p1_exporter
+    p1_exporter.BOOT_DELAY = False
+    try:
+        asyncio.run(p1_exporter.main(args.addr, args.http_port, args.raw_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
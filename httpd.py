@@ -0,0 +1,345 @@
+# Small HTTP/1.1 server on top of uasyncio/asyncio streams
+#
+# Requests are parsed incrementally from whatever the stream returns, so a
+# request split over several TCP segments, or several requests in one, are
+# handled. Requests are dispatched on their path through a route table and
+# connections are kept alive between requests, up to an idle timeout and a
+# maximum number of requests.
+
+from array import array
+from hal import ticks_us, ticks_diff
+import crc16
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+MAX_REQUEST_SIZE = 2048
+REQUEST_TIMEOUT = 2.5
+IDLE_TIMEOUT = 35
+MAX_REQUESTS = 100
+# Seconds browsers may use a static file without asking for it again
+MAX_AGE = 86400
+# Total size of the static files kept in memory
+FILE_CACHE_SIZE = 16384
+
+REASONS = {
+    200: 'OK',
+    303: 'See Other',
+    400: 'Bad Request',
+    404: 'NOT FOUND',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+    }
+
+
+def unescape_form_value(val):
+    unescaped = ''
+    val = val.replace('+', ' ')
+    begin = 0
+    while True:
+        pos = val.find('%', begin)
+        if pos == -1:
+            break
+        code = val[pos+1:pos+3]
+        if len(code) != 2:
+            raise ValueError(code)
+        unescaped += val[begin:pos] + chr(int(code, 16))
+        begin = pos + 3
+    unescaped += val[begin:]
+    return unescaped
+
+
+def parse_query(query):
+    params = dict()
+    if len(query) == 0:
+        return params
+    begin = 0
+    while True:
+        end = query.find('&', begin)
+        if end == -1:
+            param = query[begin:]
+        else:
+            param = query[begin:end]
+        equals = param.find('=')
+        if equals == -1:
+            params[unescape_form_value(param)] = ''
+        else:
+            params[unescape_form_value(param[0:equals])] = unescape_form_value(param[equals+1:])
+        if end == -1:
+            break
+        begin = end + 1
+    return params
+
+
+class HttpError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class HttpRequest:
+    def __init__(self, head):
+        # Parse the request line and headers, without the empty line
+        # ending them
+        try:
+            lines = head.decode().split('\r\n')
+        except ValueError:
+            raise HttpError(400)
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HttpError(400)
+        self.request_line = lines[0]
+        self.method, self.target, self.version = parts
+        pos = self.target.find('?')
+        if pos == -1:
+            self.path = self.target
+            self.query = dict()
+        else:
+            self.path = self.target[0:pos]
+            try:
+                self.query = parse_query(self.target[pos+1:])
+            except ValueError:
+                # A bad %xx escape
+                raise HttpError(400)
+        self.headers = dict()
+        for line in lines[1:]:
+            pos = line.find(':')
+            if pos > 0:
+                self.headers[line[0:pos].strip().lower()] = line[pos+1:].strip()
+        self.body = b''
+
+    def content_length(self):
+        try:
+            return int(self.headers.get('content-length', '0'))
+        except ValueError:
+            raise HttpError(400)
+
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+class HttpResponse:
+    # Collects the status, headers and body of a response. The body is sent
+    # with a Content-Length so the connection can be kept alive. A body too
+    # large to collect in memory can instead be streamed using send().
+    def __init__(self, writer, request, keep_alive):
+        self.writer = writer
+        self.request = request
+        self.keep_alive = keep_alive
+        self.code = 200
+        self.headers = []
+        self._body = []
+        self.sent = False
+        self.chunked = False
+
+    def start(self, code, headers=()):
+        self.code = code
+        self.headers = headers
+
+    def write(self, data):
+        if type(data) == str:
+            data = data.encode()
+        self._body.append(data)
+
+    def sendall(self, data):
+        self.write(data)
+
+    def send_raw(self, data):
+        # Send data that already holds a complete response, status line and
+        # headers included. As it carries no Connection header the
+        # connection is only kept alive for HTTP/1.1 clients.
+        if self.request.version != 'HTTP/1.1':
+            self.keep_alive = False
+        self.sent = True
+        self.writer.write(data)
+
+    def _head(self, length_header):
+        head = 'HTTP/1.1 %d %s\r\n' % (self.code, REASONS[self.code])
+        for header in self.headers:
+            head += header + '\r\n'
+        if length_header is not None:
+            head += length_header + '\r\n'
+        head += 'Connection: %s\r\n\r\n' % ('keep-alive' if self.keep_alive else 'close')
+        return head.encode()
+
+    async def send(self, data):
+        # Send a part of the body right away. The body is sent chunked, or to
+        # HTTP/1.0 clients, up to the connection being closed.
+        if not self.sent:
+            self.sent = True
+            if self.request.version == 'HTTP/1.1':
+                self.chunked = True
+                self.writer.write(self._head('Transfer-Encoding: chunked'))
+            else:
+                self.keep_alive = False
+                self.writer.write(self._head(None))
+        if type(data) == str:
+            data = data.encode()
+        if len(data) == 0:
+            return
+        if self.chunked:
+            self.writer.write(('%x\r\n' % len(data)).encode())
+            self.writer.write(data)
+            self.writer.write(b'\r\n')
+        else:
+            self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), REQUEST_TIMEOUT)
+
+    async def finish(self):
+        if not self.sent:
+            self.sent = True
+            body = b''.join(self._body)
+            self.writer.write(self._head('Content-Length: %d' % len(body)) + body)
+        elif self.chunked:
+            self.writer.write(b'0\r\n\r\n')
+        await asyncio.wait_for(self.writer.drain(), REQUEST_TIMEOUT)
+
+
+class StaticFile:
+    # A file served from memory. The responses, with and without the file,
+    # are rendered once. Like send_raw() they carry no Connection header.
+    def __init__(self, path, content_type, max_age=MAX_AGE):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Only has to change when the file does
+        self.etag = '"%x-%04x"' % (len(data), crc16.update(0, data, 0, len(data)))
+        headers = 'ETag: %s\r\nCache-Control: max-age=%d\r\n' % (self.etag, max_age)
+        self.response = (('HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                          % (content_type, len(data)) + headers + '\r\n').encode() + data)
+        self.not_modified = ('HTTP/1.1 304 Not Modified\r\n' + headers + '\r\n').encode()
+
+    def serve(self, request, cl):
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None and (self.etag in if_none_match or if_none_match == '*'):
+            cl.send_raw(self.not_modified)
+        else:
+            cl.send_raw(self.response)
+
+
+class FileCache:
+    # Serves static files, keeping them in memory up to a total size. A file
+    # is read when first asked for, files that do not fit are read every
+    # time.
+    def __init__(self, root, max_size=FILE_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.size = 0
+        self.files = dict()
+
+    def serve(self, request, cl, name, content_type):
+        file = self.files.get(name)
+        if file is None:
+            try:
+                file = StaticFile(self.root + name, content_type)
+            except OSError:
+                cl.start(404)
+                return
+            if self.size + len(file.response) <= self.max_size:
+                self.files[name] = file
+                self.size += len(file.response)
+        file.serve(request, cl)
+
+
+class HttpServer:
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_requests=MAX_REQUESTS):
+        # Handlers are called as handler(request, response). A handler may
+        # be a coroutine function.
+        self.routes = dict()
+        self.not_found = None
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.connections = 0
+        # Request count and total duration in microseconds per route, and
+        # for requests not matching any route under None
+        self.stats = {None: array('q', [0, 0])}
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+        self.stats[path] = array('q', [0, 0])
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self._serve, host, port)
+
+    async def _read_request(self, reader, buf, timeout):
+        # Read until the buffer holds a complete request. The request and
+        # what is left of the buffer after it are returned.
+        while True:
+            end = buf.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+            if len(buf) > MAX_REQUEST_SIZE:
+                raise HttpError(431)
+            data = await asyncio.wait_for(reader.read(512), timeout)
+            if len(data) == 0:
+                return None, b''
+            buf += data
+            timeout = REQUEST_TIMEOUT
+        request = HttpRequest(buf[0:end])
+        buf = buf[end+4:]
+        length = request.content_length()
+        if length > MAX_REQUEST_SIZE:
+            raise HttpError(400)
+        while len(buf) < length:
+            data = await asyncio.wait_for(reader.read(512), REQUEST_TIMEOUT)
+            if len(data) == 0:
+                return None, b''
+            buf += data
+        request.body = buf[0:length]
+        return request, buf[length:]
+
+    async def _serve(self, reader, writer):
+        print('### Http client connected from', writer.get_extra_info('peername'))
+        self.connections += 1
+        requests = 0
+        buf = b''
+        try:
+            while True:
+                timeout = REQUEST_TIMEOUT if requests == 0 else self.idle_timeout
+                try:
+                    request, buf = await self._read_request(reader, buf, timeout)
+                except HttpError as e:
+                    response = HttpResponse(writer, None, False)
+                    response.start(e.code, ['Content-type: text/plain'])
+                    await response.finish()
+                    break
+                if request is None:
+                    break
+                print(request.request_line)
+                start = ticks_us()
+                requests += 1
+                keep_alive = request.keep_alive() and requests < self.max_requests
+                response = HttpResponse(writer, request, keep_alive)
+                handler = self.routes.get(request.path)
+                if request.method != 'GET':
+                    response.start(405, ['Content-type: text/plain'])
+                elif handler is not None:
+                    ret = handler(request, response)
+                    if ret is not None:
+                        await ret
+                elif self.not_found is not None:
+                    self.not_found(request, response)
+                else:
+                    response.start(404, ['Content-type: text/plain'])
+                await response.finish()
+                stats = self.stats.get(request.path)
+                if stats is None:
+                    stats = self.stats[None]
+                stats[0] += 1
+                stats[1] += ticks_diff(ticks_us(), start)
+                if not response.keep_alive:
+                    break
+        except (OSError, asyncio.TimeoutError) as e:
+            print('Http error:', repr(e))
+        finally:
+            self.connections -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except OSError:
+                pass
+        print('### Http connection done')
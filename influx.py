@@ -0,0 +1,179 @@
+# Push of metrics to an InfluxDB compatible server, in the line protocol
+#
+# The line protocol of every telegram is put on a bounded queue and a task
+# of its own posts the queue, a batch of telegrams per request, over one
+# persistent HTTP/1.1 connection. The UART path thereby never waits for the
+# network. When the server can not be reached the queue is kept and retried
+# with an increasing delay, and when it is full the oldest telegrams are
+# dropped.
+#
+# Use a path like /write?db=p1&precision=ns for InfluxDB 1.x or
+# /api/v2/write?org=home&bucket=p1&precision=ns for 2.x, where a token is
+# needed.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+QUEUE_SIZE = 16384
+BATCH_SIZE = 10
+INTERVAL = 10
+TIMEOUT = 10
+# Delay after a failure, doubled for every failure in a row up to the max
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+class InfluxPush:
+    def __init__(self, host, port, path, token=None, batch_size=BATCH_SIZE,
+                 interval=INTERVAL, queue_size=QUEUE_SIZE, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.token = token
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue_size = queue_size
+        self.timeout = timeout
+        # The line protocol of one telegram per entry, oldest first
+        self.queue = []
+        self.queued = 0
+        # Number of entries ever removed from the head of the queue
+        self._head = 0
+        self._event = asyncio.Event()
+        self._reader = None
+        self._writer = None
+        self.writes_ok = 0
+        self.writes_rejected = 0
+        self.writes_failed = 0
+        self.dropped = 0
+
+    def put(self, data):
+        # Queue the line protocol of a telegram
+        if type(data) == str:
+            data = data.encode()
+        self.queue.append(data)
+        self.queued += len(data)
+        while self.queued > self.queue_size and len(self.queue) > 1:
+            self._pop()
+            self.dropped += 1
+        if len(self.queue) >= self.batch_size:
+            self._event.set()
+
+    def _pop(self):
+        self.queued -= len(self.queue.pop(0))
+        self._head += 1
+
+    async def run(self):
+        # The task posting the queue
+        delay = RETRY_DELAY
+        while True:
+            if len(self.queue) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._event.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._event.clear()
+            while len(self.queue) > 0:
+                if await self._post():
+                    delay = RETRY_DELAY
+                else:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+                    break
+
+    async def _post(self):
+        # Post a batch from the head of the queue. True is returned if it
+        # was taken off the queue.
+        head = self._head
+        n = min(len(self.queue), self.batch_size)
+        body = b''.join(self.queue[0:n])
+        try:
+            try:
+                reused = self._writer is not None
+                status = await self._request(body)
+            except OSError:
+                if not reused:
+                    raise
+                # The server may have closed the idle connection, try again
+                # on a new one
+                self._close()
+                status = await self._request(body)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            print('### Influx write failed:', repr(e))
+            self._close()
+            self.writes_failed += 1
+            return False
+        if status // 100 == 2:
+            self.writes_ok += 1
+        elif status // 100 == 4 and status != 429:
+            # Retrying would not make the server take it
+            print('### Influx write rejected: %d' % status)
+            self.writes_rejected += 1
+        else:
+            print('### Influx write failed: %d' % status)
+            self.writes_failed += 1
+            return False
+        # Entries may have been dropped from the queue while posting
+        for i in range(head + n - self._head):
+            self._pop()
+        return True
+
+    async def _request(self, body):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        head = 'POST %s HTTP/1.1\r\nHost: %s:%d\r\n' % (self.path, self.host, self.port)
+        if self.token:
+            head += 'Authorization: Token %s\r\n' % self.token
+        head += ('Content-Type: text/plain; charset=utf-8\r\n'
+                 'Content-Length: %d\r\n\r\n' % len(body))
+        self._writer.write(head.encode())
+        self._writer.write(body)
+        await asyncio.wait_for(self._writer.drain(), self.timeout)
+
+        line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        if len(line) == 0:
+            # Closed without an answer, as an idle connection closed by the
+            # server shows up once written to
+            raise OSError('connection closed')
+        parts = line.split(None, 2)
+        if len(parts) < 2:
+            raise ValueError('bad status line %r' % line)
+        status = int(parts[1])
+        length = 0
+        keep_alive = parts[0] == b'HTTP/1.1'
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            if len(line) == 0:
+                raise OSError('connection closed')
+            if line == b'\r\n' or line == b'\n':
+                break
+            parts = line.decode().split(':', 1)
+            if len(parts) != 2:
+                continue
+            name = parts[0].strip().lower()
+            value = parts[1].strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding':
+                # The body can not be skipped, start over with a new
+                # connection instead
+                keep_alive = False
+            elif name == 'connection' and value == 'close':
+                keep_alive = False
+        if length > 0:
+            await asyncio.wait_for(self._reader.readexactly(length), self.timeout)
+        if not keep_alive:
+            self._close()
+        return status
+
+    def _close(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+        self._reader = None
+        self._writer = None
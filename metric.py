@@ -1,7 +1,25 @@
+from array import array
+
+# Timestamp markers stored in place of a real timestamp
+_NO_TS = -1
+_UNSET = -2
+
+
+def _escape_tag(value):
+    # Tag values are not quoted in the line protocol, the characters that
+    # would end them are escaped instead
+    for c in ', =':
+        value = value.replace(c, '\\' + c)
+    return value
+
+
 class Metric:
     TYPE_COUNTER = "counter"
     TYPE_GAUGE = "gauge"
-    
+
+    __slots__ = ('name', 'type_name', 'help_text', 'labels', '_slots', '_keys',
+                 '_names', '_tag_names', '_values', '_ts', 'dirty', 'aggregate')
+
     def __init__(self, name, type_name, labels=()):
         if type(labels) != tuple:
             labels = (labels,)
@@ -9,14 +27,26 @@ class Metric:
         self.type_name = type_name
         self.help_text = None
         self.labels = labels
-        self.measurements = {}
-        
+        # Each series is given a slot index when it is first seen. The name
+        # of a series with its labels, as in the exposition and as in the
+        # line protocol, is formatted once, when first needed, so no string
+        # is kept for a series never rendered or pushed.
+        self._slots = {}
+        self._keys = []
+        self._names = []
+        self._tag_names = []
+        self._values = array('d')
+        self._ts = array('q')
+        self.dirty = False
+        # Aggregate kept of the values set, if any
+        self.aggregate = None
+
     def set_type(self, type_name):
         self.type_name = type_name
-        
+
     def set_help(self, help_text):
         self.help_text = help_text
-    
+
     def headers(self):
         headers = ""
         if self.help_text is not None:
@@ -25,93 +55,414 @@ class Metric:
             headers += "# TYPE " + self.name + " " + self.type_name + "\n"
         return headers
 
-    def set_value(self, value, labels=(), ts=None):
-        if type(value) != float:
-            value = float(value)
+    def _check_labels(self, labels):
         if type(labels) != tuple:
             labels = (labels,)
         if len(labels) != len(self.labels):
-            raise Exception("Label count mismatch. Should be %d, not %d",
+            raise Exception("Label count mismatch. Should be %d, not %d" %
                             (len(self.labels), len(labels)))
-        self.measurements[labels] = {
-            "value": value,
-            "ts" : ts
-            }
+        return labels
+
+    def series(self, labels=()):
+        # Return the slot index of the series with the given label values,
+        # creating the series if needed
+        slot = self._slots.get(labels)
+        if slot is not None:
+            return slot
+        labels = self._check_labels(labels)
+        slot = self._slots.get(labels)
+        if slot is not None:
+            return slot
+        slot = len(self._values)
+        self._slots[labels] = slot
+        self._keys.append(labels)
+        self._names.append(None)
+        self._tag_names.append(None)
+        self._values.append(0.0)
+        self._ts.append(_UNSET)
+        if self.aggregate is not None:
+            self.aggregate.add_series(labels)
+        return slot
+
+    def set_slot(self, slot, value, ts=None):
+        # Set the value of a series by the slot index returned by series()
+        value = float(value)
+        ts = _NO_TS if ts is None else int(ts)
+        if self.aggregate is not None:
+            self.aggregate.add(slot, value, ts)
+        if self._values[slot] != value or self._ts[slot] != ts:
+            self._values[slot] = value
+            self._ts[slot] = ts
+            self.dirty = True
+
+    def set_value(self, value, labels=(), ts=None):
+        self.set_slot(self.series(labels), value, ts)
+
+    def _find(self, labels):
+        slot = self._slots.get(labels)
+        if slot is None:
+            slot = self._slots.get(self._check_labels(labels))
+        if slot is None or self._ts[slot] == _UNSET:
+            return None
+        return slot
 
     def value(self, labels=()):
-        if type(labels) != tuple:
-            labels = (labels,)
-        if len(labels) != len(self.labels):
-            raise Exception("Label count mismatch. Should be %d, not %d",
-                            (len(self.labels), len(labels)))
-        if labels in self.measurements:
-            measurement = self.measurements[labels]
-            return measurement["value"]
-        
-        return None
-    
+        slot = self._find(labels)
+        if slot is None:
+            return None
+        return self._values[slot]
+
     def timestamp(self, labels=()):
-        if type(labels) != tuple:
-            labels = (labels,)
-        if len(labels) != len(self.labels):
-            raise Exception("Label count mismatch. Should be %d, not %d",
-                            (len(self.labels), len(labels)))
-        if labels in self.measurements:
-            measurement = self.measurements[labels]
-            if measurement["ts"] is not None:
-                return int(measurement["ts"])
-        return None
-        
+        slot = self._find(labels)
+        if slot is None or self._ts[slot] == _NO_TS:
+            return None
+        return self._ts[slot]
+
+    def series_count(self):
+        return len(self._values)
+
+    def _label_str(self, slot):
+        # The labels of a series as in the exposition, e.g. {phase="L1"}
+        labels = self._keys[slot]
+        if len(labels) == 0:
+            return ""
+        label_str = ""
+        for i in range(0, len(labels)):
+            if i > 0:
+                label_str += ","
+            label_str += self.labels[i] + "=\"" + labels[i] + "\""
+        return "{" + label_str + "}"
+
+    def _tag_str(self, slot):
+        # The labels of a series as line protocol tags, e.g. ,phase=L1
+        labels = self._keys[slot]
+        tag_str = ""
+        for i in range(0, len(labels)):
+            tag_str += "," + self.labels[i] + "=" + _escape_tag(labels[i])
+        return tag_str
+
+    def series_name(self, slot):
+        # The name of a series as in the exposition, labels included
+        name = self._names[slot]
+        if name is None:
+            name = self._names[slot] = self.name + self._label_str(slot)
+        return name
+
+    def _tag_name(self, slot):
+        # The measurement and tags of a series as in the line protocol
+        name = self._tag_names[slot]
+        if name is None:
+            name = self._tag_names[slot] = self.name + self._tag_str(slot)
+        return name
+
+    def slot_value(self, slot):
+        return self._values[slot]
+
+    def slot_is_set(self, slot):
+        return self._ts[slot] != _UNSET
+
+    def slot_sample(self, slot, fmt="%f"):
+        # The value and timestamp of a series as in the exposition
+        sample = fmt % self._values[slot]
+        ts = self._ts[slot]
+        if ts >= 0:
+            sample += " %d" % ts
+        return sample
+
+    def slot_row(self, slot):
+        return self.series_name(slot) + " " + self.slot_sample(slot) + "\n"
+
     def value_row(self, labels=()):
-        if type(labels) != tuple:
-            labels = (labels,)
-        if len(labels) != len(self.labels):
-            raise Exception("Label count mismatch. Should be %d, not %d",
-                            (len(self.labels), len(labels)))
-        row = self.name
-        measurement = self.measurements[labels]
-        if len(labels) > 0:
-            row += "{"
-            for i in range(0, len(labels)):
-                if i > 0:
-                    row += ","
-                row += self.labels[i] + "=\"" + labels[i] + "\""
-            row += "}"
-        row += " %f" % measurement["value"]
-        if measurement["ts"] is not None:
-            row += " %d" % int(measurement["ts"])
-        row += "\n"
-        return row
+        slot = self._find(labels)
+        if slot is None:
+            raise KeyError(labels)
+        return self.slot_row(slot)
 
     def value_rows(self):
         rows = ''
-        for labels in self.measurements:
-            rows += self.value_row(labels)
+        for slot in range(len(self._values)):
+            if self._ts[slot] != _UNSET:
+                rows += self.slot_row(slot)
         return rows
-    
+
+    def slot_lineprotocol_row(self, slot):
+        row = self._tag_name(slot)
+        row += " value=%f" % self._values[slot]
+        ts = self._ts[slot]
+        if ts >= 0:
+            row += " %d000000" % ts
+        return row + "\n"
+
     def lineprotocol_row(self, labels=()):
-        if type(labels) != tuple:
-            labels = (labels,)
-        if len(labels) != len(self.labels):
-            raise Exception("Label count mismatch. Should be %d, not %d",
-                            (len(self.labels), len(labels)))
-        row = self.name
-        measurement = self.measurements[labels]
-        if len(labels) > 0:
-            row += ","
-            for i in range(0, len(labels)):
-                if i > 0:
-                    row += ","
-                row += self.labels[i] + "=\"" + labels[i] + "\""
-        row += " _value=%f" % measurement["value"]
-        if measurement["ts"] is not None:
-            row += " %d000000" % int(measurement["ts"])
-        row += "\n"
-        return row
-    
+        slot = self._find(labels)
+        if slot is None:
+            raise KeyError(labels)
+        return self.slot_lineprotocol_row(slot)
+
     def lineprotocol_rows(self):
         rows = ''
-        for labels in self.measurements:
-            rows += self.lineprotocol_row(labels)
+        for slot in range(len(self._values)):
+            if self._ts[slot] != _UNSET:
+                rows += self.slot_lineprotocol_row(slot)
         return rows
-    
+
+
+def _fixed_str(n, digits):
+    # The int n in units of 10**-digits as an exact decimal number
+    if digits == 0:
+        return str(n)
+    text = str(abs(n))
+    if len(text) <= digits:
+        text = "0" * (digits + 1 - len(text)) + text
+    text = text[:-digits] + "." + text[-digits:]
+    if n < 0:
+        text = "-" + text
+    return text
+
+
+class FixedMetric(Metric):
+    # A metric whose values are kept exact as ints, in units of 10**-digits,
+    # for values that would lose precision as floats, which have 32 bits on
+    # the RP2040. The ints grow as needed.
+    __slots__ = ('digits', '_scale', '_fixed')
+
+    def __init__(self, name, type_name, labels=(), digits=0):
+        super().__init__(name, type_name, labels)
+        self.digits = digits
+        self._scale = 10 ** digits
+        self._fixed = []
+
+    def series(self, labels=()):
+        slot = super().series(labels)
+        while len(self._fixed) <= slot:
+            self._fixed.append(0)
+        return slot
+
+    def slot_fixed(self, slot):
+        return self._fixed[slot]
+
+    def set_fixed(self, slot, n, ts=None):
+        # Set the value of a series by slot index to n units. The float value
+        # is kept too, but only as close as a float gets.
+        ts = _NO_TS if ts is None else int(ts)
+        if self._fixed[slot] != n or self._ts[slot] != ts:
+            self._fixed[slot] = n
+            self._values[slot] = n / self._scale
+            self._ts[slot] = ts
+            self.dirty = True
+
+    def slot_sample(self, slot, fmt="%f"):
+        # Always the exact value, whatever the format
+        sample = _fixed_str(self._fixed[slot], self.digits)
+        ts = self._ts[slot]
+        if ts >= 0:
+            sample += " %d" % ts
+        return sample
+
+
+# The sums of an Aggregate are kept in thousandths of the unit of the metric
+SUM_DIGITS = 3
+
+
+class Aggregate:
+    # Running min, max, sum and count of every value set on a metric, so that
+    # what happens between two scrapes is not lost. They are exported as the
+    # metrics <name>_min, <name>_max, <name>_sum and <name>_count, with the
+    # labels of the metric.
+    #
+    # The sum and count are never reset, the average over any range is the
+    # increase of the sum divided by the increase of the count. They are
+    # kept as ints, the sum in thousandths, so they never lose precision. The min and
+    # max are over the current and the previous window, where a new window
+    # is started by rotate(). reset() forgets both windows, for when a
+    # scrape should start over.
+
+    def __init__(self, metric):
+        self.metric = metric
+        name = metric.name
+        self.min = Metric(name + "_min", Metric.TYPE_GAUGE, metric.labels)
+        self.min.set_help("Lowest " + name + " in the current and previous window")
+        self.max = Metric(name + "_max", Metric.TYPE_GAUGE, metric.labels)
+        self.max.set_help("Highest " + name + " in the current and previous window")
+        self.sum = FixedMetric(name + "_sum", Metric.TYPE_COUNTER, metric.labels, SUM_DIGITS)
+        self.sum.set_help("Sum of all " + name + " values")
+        self.count = FixedMetric(name + "_count", Metric.TYPE_COUNTER, metric.labels)
+        self.count.set_help("Number of " + name + " values")
+        # Min and max per slot of the current and the previous window
+        self._min = array('d')
+        self._max = array('d')
+        self._prev_min = array('d')
+        self._prev_max = array('d')
+        metric.aggregate = self
+        for labels in metric._slots:
+            self.add_series(labels)
+
+    def metrics(self):
+        return (self.min, self.max, self.sum, self.count)
+
+    def add_series(self, labels):
+        # Called by the metric for a new series, so the slots stay the same
+        for metric in self.metrics():
+            metric.series(labels)
+        inf = float('inf')
+        self._min.append(inf)
+        self._max.append(-inf)
+        self._prev_min.append(inf)
+        self._prev_max.append(-inf)
+
+    def add(self, slot, value, ts):
+        if value < self._min[slot]:
+            self._min[slot] = value
+        if value > self._max[slot]:
+            self._max[slot] = value
+        self._set_min_max(slot, ts)
+        self.sum.set_fixed(slot, self.sum.slot_fixed(slot) + int(round(value * self.sum._scale)), ts)
+        self.count.set_fixed(slot, self.count.slot_fixed(slot) + 1, ts)
+
+    def _set_min_max(self, slot, ts):
+        self.min.set_slot(slot, min(self._min[slot], self._prev_min[slot]), ts)
+        self.max.set_slot(slot, max(self._max[slot], self._prev_max[slot]), ts)
+
+    def rotate(self):
+        # Start a new window, at the current value of every series
+        metric = self.metric
+        for slot in range(len(self._min)):
+            ts = metric._ts[slot]
+            if ts == _UNSET:
+                continue
+            value = metric._values[slot]
+            self._prev_min[slot] = self._min[slot]
+            self._prev_max[slot] = self._max[slot]
+            self._min[slot] = value
+            self._max[slot] = value
+            self._set_min_max(slot, None if ts == _NO_TS else ts)
+
+    def reset(self):
+        # Start over from the current value of every series
+        self.rotate()
+        self.rotate()
+
+
+# Room kept before the exposition in the buffer for the header
+HEADER_ROOM = 128
+
+
+class Registry:
+    # Owns the metrics that are exported and renders them into one buffer,
+    # which is kept and grown when needed. The position of the value and
+    # timestamp of every series in the buffer is kept, so those that changed
+    # are patched in place when their text keeps its width. Only a new
+    # series or a change of width makes for a new render. A metric with a
+    # fixed width format never changes width.
+
+    def __init__(self, header=None):
+        # header(length) returns what to put before the exposition in the
+        # buffer, e.g. an HTTP response header, given the exposition length
+        self.header = header
+        self.buf = bytearray()
+        self.body_pos = 0 if header is None else HEADER_ROOM
+        self._start = self.body_pos
+        self._end = self.body_pos
+        self._metrics = []
+        self._changed = True
+
+    def register(self, metric, fmt="%f"):
+        # Metrics are rendered in the order they are registered, their
+        # values formatted with fmt. The position and width of the sample of
+        # every series are kept in arrays indexed by slot, -1 for a series
+        # without a value.
+        self._metrics.append((metric, metric.headers().encode(), fmt, array('i'), array('H')))
+        self._changed = True
+        return metric
+
+    def render(self):
+        # Bring the buffer up to date with the metrics. True is returned if
+        # anything in it changed.
+        if not self._changed:
+            changed = False
+            for metric, headers, fmt, pos, width in self._metrics:
+                if metric.dirty:
+                    if not self._patch(metric, fmt, pos, width):
+                        self._changed = True
+                        break
+                    changed = True
+            if not self._changed:
+                return changed
+        self._render()
+        return True
+
+    def _patch(self, metric, fmt, pos, width):
+        # Patch the samples of a metric into the buffer. False is returned if
+        # that can not be done, a new render is needed then.
+        if len(pos) != metric.series_count():
+            return False
+        buf = self.buf
+        for slot in range(len(pos)):
+            p = pos[slot]
+            if p < 0:
+                if metric.slot_is_set(slot):
+                    return False
+                continue
+            sample = metric.slot_sample(slot, fmt).encode()
+            if len(sample) != width[slot]:
+                return False
+            buf[p:p+len(sample)] = sample
+        metric.dirty = False
+        return True
+
+    def _put(self, pos, data):
+        # Copy data into the buffer at pos, returning where it ends. A grown
+        # buffer is a new one, as one with a memoryview of it can not be
+        # resized.
+        end = pos + len(data)
+        if end > len(self.buf):
+            buf = bytearray(max(end, 2 * len(self.buf)))
+            buf[0:pos] = memoryview(self.buf)[0:pos]
+            self.buf = buf
+        self.buf[pos:end] = data
+        return end
+
+    def _render(self):
+        p = self.body_pos
+        for metric, headers, fmt, pos, width in self._metrics:
+            metric.dirty = False
+            count = metric.series_count()
+            while len(pos) < count:
+                pos.append(-1)
+                width.append(0)
+            empty = True
+            for slot in range(count):
+                if not metric.slot_is_set(slot):
+                    pos[slot] = -1
+                    continue
+                if empty:
+                    p = self._put(p, headers)
+                    empty = False
+                p = self._put(p, (metric.series_name(slot) + " ").encode())
+                sample = metric.slot_sample(slot, fmt).encode()
+                pos[slot] = p
+                width[slot] = len(sample)
+                p = self._put(p, sample)
+                p = self._put(p, b'\n')
+            if not empty:
+                p = self._put(p, b'\n')
+        self._end = p
+        self._start = self.body_pos
+        self._changed = False
+        if self.header is not None:
+            header = self.header(p - self.body_pos)
+            if len(header) > self.body_pos:
+                # Make room for it and render again
+                self.body_pos = len(header)
+                self._render()
+                return
+            self._start = self.body_pos - len(header)
+            self.buf[self._start:self.body_pos] = header
+
+    def response(self):
+        # Return a memoryview of the exposition, the header included
+        return memoryview(self.buf)[self._start:self._end]
+
+    def body(self):
+        # Return a memoryview of the exposition, without the header
+        return memoryview(self.buf)[self.body_pos:self._end]
@@ -0,0 +1,225 @@
+# Publish of the decoded values to an MQTT broker
+#
+# The values of every telegram are put in a pending set, the latest value
+# per OBIS code winning, and a task of its own publishes the set every
+# interval seconds, all in one write. Either every value is published to a
+# topic of its own, <prefix>/<OBIS code>, or all of them as one JSON object
+# to <prefix>/telegram. A value is skipped if it changed less than the
+# deadband of its OBIS code since it was last published, and, if changed
+# only is set, when it did not change at all.
+#
+# <prefix>/status is set to online when connected, and by the broker to
+# offline when the connection is lost. The connection is made, kept alive
+# and made again in the task, so the UART path never waits for the broker.
+# Only what is needed to publish with QoS 0 of MQTT 3.1.1 is implemented.
+
+import struct
+from p1parser import json_number
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+INTERVAL = 5
+KEEPALIVE = 60
+TIMEOUT = 10
+# Delay after a failure, doubled for every failure in a row up to the max
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+FORMAT_OBIS = 'obis'
+FORMAT_JSON = 'json'
+
+_PINGREQ = b'\xc0\x00'
+
+
+def _put_length(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _put_string(buf, s):
+    if type(s) == str:
+        s = s.encode()
+    buf.extend(struct.pack('>H', len(s)))
+    buf.extend(s)
+
+
+def _packet(buf, first, body):
+    buf.append(first)
+    _put_length(buf, len(body))
+    buf.extend(body)
+
+
+class MqttPublish:
+    def __init__(self, host, port, client_id, prefix, user=None, password=None,
+                 format=FORMAT_OBIS, retain=True, changed_only=True, deadbands=None,
+                 interval=INTERVAL, keepalive=KEEPALIVE, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.prefix = prefix
+        self.user = user
+        self.password = password
+        self.format = format
+        self.retain = retain
+        self.changed_only = changed_only
+        # Least change in value to publish, per OBIS code
+        self.deadbands = deadbands or {}
+        self.interval = interval
+        self.keepalive = keepalive
+        self.timeout = timeout
+        # Values to publish per OBIS code, as JSON numbers
+        self.pending = {}
+        self.timestamp = None
+        # Last published value per OBIS code
+        self.published = {}
+        self._reader = None
+        self._writer = None
+        self.connects = 0
+        self.messages = 0
+        self.skipped = 0
+
+    def put(self, obis, value):
+        # Queue the value text of an OBIS code
+        text = json_number(value)
+        if text is None:
+            return
+        last = self.published.get(obis)
+        if last is not None:
+            change = abs(float(text) - last)
+            if change < self.deadbands.get(obis, 0) or (change == 0 and self.changed_only):
+                self.skipped += 1
+                self.pending.pop(obis, None)
+                return
+        self.pending[obis] = text
+
+    def set_timestamp(self, ts):
+        # The time of the telegram being put, in seconds
+        self.timestamp = ts
+
+    async def run(self):
+        # The task keeping the connection and publishing
+        delay = RETRY_DELAY
+        while True:
+            try:
+                await self._connect()
+                delay = RETRY_DELAY
+                await self._publish_loop()
+            except (OSError, asyncio.TimeoutError, ValueError) as e:
+                print('### MQTT error:', repr(e))
+            self._close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        status = self.prefix + '/status'
+        # Clean session, with a retained will
+        flags = 0x02 | 0x04 | 0x20
+        if self.user:
+            flags |= 0x80
+            if self.password:
+                flags |= 0x40
+        body = bytearray()
+        _put_string(body, 'MQTT')
+        body.extend(struct.pack('>BBH', 4, flags, self.keepalive))
+        _put_string(body, self.client_id)
+        _put_string(body, status)
+        _put_string(body, 'offline')
+        if self.user:
+            _put_string(body, self.user)
+            if self.password:
+                _put_string(body, self.password)
+        buf = bytearray()
+        _packet(buf, 0x10, body)
+        self._writer.write(buf)
+        await asyncio.wait_for(self._writer.drain(), self.timeout)
+        connack = await asyncio.wait_for(self._reader.readexactly(4), self.timeout)
+        if connack[0] != 0x20 or connack[3] != 0:
+            raise ValueError('connection refused %r' % connack)
+        self.connects += 1
+        print('### MQTT connected to %s:%d' % (self.host, self.port))
+        buf = bytearray()
+        self._put_publish(buf, status, 'online', True)
+        self._writer.write(buf)
+        await asyncio.wait_for(self._writer.drain(), self.timeout)
+
+    async def _publish_loop(self):
+        # Anything from the broker is read by a task of its own, only to
+        # notice the connection being lost
+        reader = asyncio.create_task(self._read())
+        idle = 0
+        try:
+            while not reader.done():
+                await asyncio.sleep(self.interval)
+                sent = self.pending
+                self.pending = {}
+                buf = self._publish(sent)
+                if len(buf) == 0:
+                    idle += self.interval
+                    if idle < self.keepalive / 2:
+                        continue
+                    buf = _PINGREQ
+                idle = 0
+                try:
+                    self._writer.write(buf)
+                    await asyncio.wait_for(self._writer.drain(), self.timeout)
+                except (OSError, asyncio.TimeoutError):
+                    # Publish them with the next connection, unless they
+                    # were replaced in the meantime
+                    for obis, text in sent.items():
+                        if obis not in self.pending:
+                            self.pending[obis] = text
+                    raise
+                for obis, text in sent.items():
+                    self.published[obis] = float(text)
+        finally:
+            reader.cancel()
+
+    async def _read(self):
+        try:
+            while True:
+                data = await self._reader.read(64)
+                if len(data) == 0:
+                    break
+        except OSError:
+            pass
+
+    def _publish(self, pending):
+        # Return the packets publishing the given values
+        buf = bytearray()
+        if len(pending) == 0:
+            return buf
+        if self.format == FORMAT_JSON:
+            parts = []
+            if self.timestamp is not None:
+                parts.append('"timestamp": %d' % self.timestamp)
+            for obis, text in pending.items():
+                parts.append('"%s": %s' % (obis, text))
+            self._put_publish(buf, self.prefix + '/telegram',
+                              '{' + ', '.join(parts) + '}', self.retain)
+        else:
+            for obis, text in pending.items():
+                self._put_publish(buf, self.prefix + '/' + obis, text, self.retain)
+        return buf
+
+    def _put_publish(self, buf, topic, payload, retain):
+        body = bytearray()
+        _put_string(body, topic)
+        body.extend(payload.encode() if type(payload) == str else payload)
+        _packet(buf, 0x31 if retain else 0x30, body)
+        self.messages += 1
+
+    def _close(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except OSError:
+                pass
+        self._reader = None
+        self._writer = None
@@ -0,0 +1,272 @@
+# OBIS code profiles, mapping the codes of a meter to metric series
+#
+# A profile is a dict, as it would be loaded from JSON:
+#
+#   {
+#       "base": "se",
+#       "metrics": {
+#           "<key>": {"name": "p1_...", "type": "gauge", "help": "...",
+#                     "labels": ["...", ...]},
+#       },
+#       "codes": [
+#           {"obis": "1-0:1.8.0", "name": "...", "metric": "<key>",
+#            "labels": ["...", ...]},
+#       ],
+#   }
+#
+# All fields are optional. "base" names a built-in profile whose codes and
+# metrics are extended, codes of the same OBIS code being replaced.
+# "metrics" defines metrics in addition to the ones the exporter always
+# has, energy, power, voltage and current. A code without a metric is only
+# shown on the index page, in the order of the codes.
+#
+# A profile is compiled once into a table from OBIS code to an ObisCode,
+# holding the metric and the slot of its series, so decoding a line is a
+# single lookup.
+
+# Built-in profiles, by name
+PROFILES = dict()
+
+# The tariff registers of the Dutch and Belgian meters
+_TARIFF_METRICS = {
+    "energy_tariff": {
+        "name": "p1_energy_tariff_kwhs",
+        "type": "counter",
+        "help": "The accumulated meter value per tariff over all time",
+        "labels": ["type", "direction", "tariff"],
+    },
+    "tariff": {
+        "name": "p1_tariff",
+        "type": "gauge",
+        "help": "The tariff in use",
+        "labels": [],
+    },
+}
+
+PROFILES["se"] = {
+    "codes": [
+        {"obis": "1-0:1.8.0", "name": "Mätarställning Aktiv Energi Uttag.", "metric": "energy", "labels": ["active", "consume"]},
+        {"obis": "1-0:2.8.0", "name": "Mätarställning Aktiv Energi Inmatning", "metric": "energy", "labels": ["active", "produce"]},
+        {"obis": "1-0:3.8.0", "name": "Mätarställning Reaktiv Energi Uttag", "metric": "energy", "labels": ["reactive", "consume"]},
+        {"obis": "1-0:4.8.0", "name": "Mätarställning Reaktiv Energi Inmatning", "metric": "energy", "labels": ["reactive", "produce"]},
+        {"obis": "1-0:1.7.0", "name": "Aktiv Effekt Uttag", "metric": "power", "labels": ["active", "consume", "all"]},
+        {"obis": "1-0:2.7.0", "name": "Aktiv Effekt Inmatning", "metric": "power", "labels": ["active", "produce", "all"]},
+        {"obis": "1-0:3.7.0", "name": "Reaktiv Effekt Uttag", "metric": "power", "labels": ["reactive", "consume", "all"]},
+        {"obis": "1-0:4.7.0", "name": "Reaktiv Effekt Inmatning", "metric": "power", "labels": ["reactive", "produce", "all"]},
+        {"obis": "1-0:21.7.0", "name": "L1 Aktiv Effekt Uttag", "metric": "power", "labels": ["active", "consume", "L1"]},
+        {"obis": "1-0:22.7.0", "name": "L1 Aktiv Effekt Inmatning", "metric": "power", "labels": ["active", "produce", "L1"]},
+        {"obis": "1-0:41.7.0", "name": "L2 Aktiv Effekt Uttag", "metric": "power", "labels": ["active", "consume", "L2"]},
+        {"obis": "1-0:42.7.0", "name": "L2 Aktiv Effekt Inmatning", "metric": "power", "labels": ["active", "produce", "L2"]},
+        {"obis": "1-0:61.7.0", "name": "L3 Aktiv Effekt Uttag", "metric": "power", "labels": ["active", "consume", "L3"]},
+        {"obis": "1-0:62.7.0", "name": "L3 Aktiv Effekt Inmatning", "metric": "power", "labels": ["active", "produce", "L3"]},
+        {"obis": "1-0:23.7.0", "name": "L1 Reaktiv Effekt Uttag", "metric": "power", "labels": ["reactive", "consume", "L1"]},
+        {"obis": "1-0:24.7.0", "name": "L1 Reaktiv Effekt Inmatning", "metric": "power", "labels": ["reactive", "produce", "L1"]},
+        {"obis": "1-0:43.7.0", "name": "L2 Reaktiv Effekt Uttag", "metric": "power", "labels": ["reactive", "consume", "L2"]},
+        {"obis": "1-0:44.7.0", "name": "L2 Reaktiv Effekt Inmatning", "metric": "power", "labels": ["reactive", "produce", "L2"]},
+        {"obis": "1-0:63.7.0", "name": "L3 Reaktiv Effekt Uttag", "metric": "power", "labels": ["reactive", "consume", "L3"]},
+        {"obis": "1-0:64.7.0", "name": "L3 Reaktiv Effekt Inmatning", "metric": "power", "labels": ["reactive", "produce", "L3"]},
+        {"obis": "1-0:32.7.0", "name": "L1 Fasspänning", "metric": "voltage", "labels": ["L1"]},
+        {"obis": "1-0:52.7.0", "name": "L2 Fasspänning", "metric": "voltage", "labels": ["L2"]},
+        {"obis": "1-0:72.7.0", "name": "L3 Fasspänning", "metric": "voltage", "labels": ["L3"]},
+        {"obis": "1-0:31.7.0", "name": "L1 Fasström", "metric": "current", "labels": ["L1"]},
+        {"obis": "1-0:51.7.0", "name": "L2 Fasström", "metric": "current", "labels": ["L2"]},
+        {"obis": "1-0:71.7.0", "name": "L3 Fasström", "metric": "current", "labels": ["L3"]},
+    ],
+}
+
+PROFILES["nl"] = {
+    "metrics": _TARIFF_METRICS,
+    "codes": [
+        {"obis": "1-0:1.8.1", "name": "Meterstand Levering Tarief 1", "metric": "energy_tariff", "labels": ["active", "consume", "1"]},
+        {"obis": "1-0:1.8.2", "name": "Meterstand Levering Tarief 2", "metric": "energy_tariff", "labels": ["active", "consume", "2"]},
+        {"obis": "1-0:2.8.1", "name": "Meterstand Teruglevering Tarief 1", "metric": "energy_tariff", "labels": ["active", "produce", "1"]},
+        {"obis": "1-0:2.8.2", "name": "Meterstand Teruglevering Tarief 2", "metric": "energy_tariff", "labels": ["active", "produce", "2"]},
+        {"obis": "0-0:96.14.0", "name": "Actueel Tarief", "metric": "tariff", "labels": []},
+        {"obis": "1-0:1.7.0", "name": "Actueel Vermogen Levering", "metric": "power", "labels": ["active", "consume", "all"]},
+        {"obis": "1-0:2.7.0", "name": "Actueel Vermogen Teruglevering", "metric": "power", "labels": ["active", "produce", "all"]},
+        {"obis": "1-0:21.7.0", "name": "L1 Vermogen Levering", "metric": "power", "labels": ["active", "consume", "L1"]},
+        {"obis": "1-0:22.7.0", "name": "L1 Vermogen Teruglevering", "metric": "power", "labels": ["active", "produce", "L1"]},
+        {"obis": "1-0:41.7.0", "name": "L2 Vermogen Levering", "metric": "power", "labels": ["active", "consume", "L2"]},
+        {"obis": "1-0:42.7.0", "name": "L2 Vermogen Teruglevering", "metric": "power", "labels": ["active", "produce", "L2"]},
+        {"obis": "1-0:61.7.0", "name": "L3 Vermogen Levering", "metric": "power", "labels": ["active", "consume", "L3"]},
+        {"obis": "1-0:62.7.0", "name": "L3 Vermogen Teruglevering", "metric": "power", "labels": ["active", "produce", "L3"]},
+        {"obis": "1-0:32.7.0", "name": "L1 Spanning", "metric": "voltage", "labels": ["L1"]},
+        {"obis": "1-0:52.7.0", "name": "L2 Spanning", "metric": "voltage", "labels": ["L2"]},
+        {"obis": "1-0:72.7.0", "name": "L3 Spanning", "metric": "voltage", "labels": ["L3"]},
+        {"obis": "1-0:31.7.0", "name": "L1 Stroom", "metric": "current", "labels": ["L1"]},
+        {"obis": "1-0:51.7.0", "name": "L2 Stroom", "metric": "current", "labels": ["L2"]},
+        {"obis": "1-0:71.7.0", "name": "L3 Stroom", "metric": "current", "labels": ["L3"]},
+    ],
+}
+
+PROFILES["be"] = {
+    "metrics": {
+        "energy_tariff": _TARIFF_METRICS["energy_tariff"],
+        "tariff": _TARIFF_METRICS["tariff"],
+        "demand": {
+            "name": "p1_average_demand_watts",
+            "type": "gauge",
+            "help": "Average power consumed in the current quarter of an hour",
+            "labels": [],
+        },
+    },
+    "codes": [
+        {"obis": "1-0:1.8.1", "name": "Meterstand Afname Dag", "metric": "energy_tariff", "labels": ["active", "consume", "1"]},
+        {"obis": "1-0:1.8.2", "name": "Meterstand Afname Nacht", "metric": "energy_tariff", "labels": ["active", "consume", "2"]},
+        {"obis": "1-0:2.8.1", "name": "Meterstand Injectie Dag", "metric": "energy_tariff", "labels": ["active", "produce", "1"]},
+        {"obis": "1-0:2.8.2", "name": "Meterstand Injectie Nacht", "metric": "energy_tariff", "labels": ["active", "produce", "2"]},
+        {"obis": "0-0:96.14.0", "name": "Actueel Tarief", "metric": "tariff", "labels": []},
+        {"obis": "1-0:1.4.0", "name": "Kwartiervermogen", "metric": "demand", "labels": []},
+        {"obis": "1-0:1.7.0", "name": "Actueel Vermogen Afname", "metric": "power", "labels": ["active", "consume", "all"]},
+        {"obis": "1-0:2.7.0", "name": "Actueel Vermogen Injectie", "metric": "power", "labels": ["active", "produce", "all"]},
+        {"obis": "1-0:21.7.0", "name": "L1 Vermogen Afname", "metric": "power", "labels": ["active", "consume", "L1"]},
+        {"obis": "1-0:22.7.0", "name": "L1 Vermogen Injectie", "metric": "power", "labels": ["active", "produce", "L1"]},
+        {"obis": "1-0:41.7.0", "name": "L2 Vermogen Afname", "metric": "power", "labels": ["active", "consume", "L2"]},
+        {"obis": "1-0:42.7.0", "name": "L2 Vermogen Injectie", "metric": "power", "labels": ["active", "produce", "L2"]},
+        {"obis": "1-0:61.7.0", "name": "L3 Vermogen Afname", "metric": "power", "labels": ["active", "consume", "L3"]},
+        {"obis": "1-0:62.7.0", "name": "L3 Vermogen Injectie", "metric": "power", "labels": ["active", "produce", "L3"]},
+        {"obis": "1-0:32.7.0", "name": "L1 Spanning", "metric": "voltage", "labels": ["L1"]},
+        {"obis": "1-0:52.7.0", "name": "L2 Spanning", "metric": "voltage", "labels": ["L2"]},
+        {"obis": "1-0:72.7.0", "name": "L3 Spanning", "metric": "voltage", "labels": ["L3"]},
+        {"obis": "1-0:31.7.0", "name": "L1 Stroom", "metric": "current", "labels": ["L1"]},
+        {"obis": "1-0:51.7.0", "name": "L2 Stroom", "metric": "current", "labels": ["L2"]},
+        {"obis": "1-0:71.7.0", "name": "L3 Stroom", "metric": "current", "labels": ["L3"]},
+    ],
+}
+
+# Most OBIS codes without a mapping that are remembered
+MAX_UNKNOWN = 32
+
+# Longer numbers are identifiers, like the equipment id of 0-0:96.1.1,
+# rather than values
+MAX_NUMBER_LENGTH = 16
+
+
+def profile_chain(profile):
+    # The profile preceded by the profiles it is based on
+    chain = [profile]
+    while "base" in chain[0]:
+        base = chain[0]["base"]
+        if type(base) != str or base not in PROFILES:
+            raise ValueError("Unknown base profile %s" % repr(base))
+        chain.insert(0, PROFILES[base])
+    return chain
+
+
+def _check_labels(labels, what):
+    if type(labels) != list or any(type(label) != str for label in labels):
+        raise ValueError("The labels of %s are not a list of strings" % what)
+
+
+def check_profile(profile, metrics, prefix_len=0):
+    # Raise ValueError if a profile, as loaded from JSON, would not compile
+    # into a table with the given metrics, whose first prefix_len labels
+    # are not in the profile. Checked before any metric is made, so a bad
+    # profile leaves nothing behind.
+    if type(profile) != dict:
+        raise ValueError("The profile is not an object")
+    label_counts = dict()
+    for key, metric in metrics.items():
+        label_counts[key] = len(metric.labels) - prefix_len
+    for part in profile_chain(profile):
+        defined = part.get("metrics", {})
+        if type(defined) != dict:
+            raise ValueError("The metrics are not an object")
+        for key, spec in defined.items():
+            if type(spec) != dict or type(spec.get("name")) != str:
+                raise ValueError("Metric %s has no name" % key)
+            if type(spec.get("type", "")) != str or type(spec.get("help", "")) != str:
+                raise ValueError("The type or help of metric %s is not a string" % key)
+            labels = spec.get("labels", [])
+            _check_labels(labels, "metric " + key)
+            if key not in label_counts:
+                label_counts[key] = len(labels)
+        codes = part.get("codes", [])
+        if type(codes) != list:
+            raise ValueError("The codes are not a list")
+        for spec in codes:
+            if type(spec) != dict or type(spec.get("obis")) != str:
+                raise ValueError("Code without an OBIS code: %s" % repr(spec))
+            obis = spec["obis"]
+            if type(spec.get("name", obis)) != str:
+                raise ValueError("The name of code %s is not a string" % obis)
+            labels = spec.get("labels", [])
+            _check_labels(labels, "code " + obis)
+            if "metric" in spec:
+                key = spec["metric"]
+                if type(key) != str or key not in label_counts:
+                    raise ValueError("Code %s has unknown metric %s" % (obis, repr(key)))
+                if len(labels) != label_counts[key]:
+                    raise ValueError("Code %s has %d labels, its metric %d" %
+                                     (obis, len(labels), label_counts[key]))
+
+
+class ObisCode:
+    __slots__ = ('obis', 'name', 'metric', 'labels', 'slot')
+
+    def __init__(self, obis, name, metric=None, labels=()):
+        self.obis = obis
+        self.name = name
+        self.metric = metric
+        self.labels = labels
+        self.slot = None
+        if metric is not None:
+            self.slot = metric.series(labels)
+
+
+class ObisTable:
+    # OBIS code lookup compiled from a profile. metrics maps the metric keys
+    # of the profile to metrics, and is added to with the metrics defined by
+    # the profile. new_metric(name, type, labels, help) makes and registers
+    # such a metric. Values of OBIS codes without a mapping are exported as
+    # the series of unknown, labelled with their OBIS code and unit, if it
+    # is given. The label values in prefix are put before those of every
+    # series, for the labels a metric has before the ones in the profile.
+
+    def __init__(self, profile, metrics, new_metric, unknown=None, prefix=()):
+        self.codes = dict()
+        self.prefix = prefix
+        # The codes of the profile in the order they are listed
+        self.order = []
+        self.unknown = unknown
+        self._unknown_count = 0
+        for profile in profile_chain(profile):
+            for key, spec in profile.get("metrics", {}).items():
+                if key not in metrics:
+                    metrics[key] = new_metric(spec["name"], spec.get("type", "gauge"),
+                                              tuple(spec.get("labels", ())), spec.get("help"))
+            for spec in profile.get("codes", ()):
+                obis = spec["obis"]
+                metric = None
+                if "metric" in spec:
+                    metric = metrics[spec["metric"]]
+                code = ObisCode(obis, spec.get("name", obis), metric,
+                                prefix + tuple(spec.get("labels", ())))
+                if obis not in self.codes:
+                    self.order.append(obis)
+                self.codes[obis] = code
+
+    def get(self, obis, value, unit):
+        # Return the ObisCode of a value, None for a code without a mapping
+        # once MAX_UNKNOWN of them have been seen
+        code = self.codes.get(obis)
+        if code is None and self._unknown_count < MAX_UNKNOWN:
+            code = self._add_unknown(obis, value, unit)
+        return code
+
+    def _add_unknown(self, obis, value, unit):
+        # Codes that are not exported are remembered too, so they are not
+        # looked at again
+        self._unknown_count += 1
+        metric = None
+        labels = ()
+        if self.unknown is not None and len(value) <= MAX_NUMBER_LENGTH:
+            try:
+                float(value)
+                metric = self.unknown
+                labels = self.prefix + (obis, unit)
+            except ValueError:
+                pass
+        code = ObisCode(obis, obis, metric, labels)
+        self.codes[obis] = code
+        return code
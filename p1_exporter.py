@@ -1,15 +1,27 @@
-from machine import Pin, UART, I2C, WDT
-import network
-import socket
+from hal import Pin, UART, I2C, WDT, ADC, network, ubinascii, uos
+from hal import ticks_ms, ticks_us, ticks_diff, mem_free, mem_alloc, uart_stream, ROOT
+from hal import uart_pace, sleep_ms, ThreadSafeFlag
 import time
-import select
-from metric import Metric
-import re
+from metric import Metric, Registry, Aggregate
+from p1parser import P1Parser, timestamp_seconds
+from framer import TelegramFramer
+from httpd import HttpServer, FileCache
+from relay import RawRelay
+from history import History
+from datalog import DataLog
+from influx import InfluxPush
+from mqtt import MqttPublish
+from sse import EventStream
+from template import Template, escape
+from obis import PROFILES, ObisTable, check_profile
 #import config
-import ubinascii
 import sys
 import json
-import uos
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 # Configuration variable definitions
 # These definitions are mainly used to build the HTML configuration form and
@@ -31,6 +43,13 @@ CONFIG_VARS = [
         'text': 'Enable Watchdog Timer',
         'default': True,
     },
+    {
+        'fieldset': 'System',
+        'name': 'dual_core',
+        'type': 'checkbox',
+        'text': 'Read And Decode The UARTs On The Second Core',
+        'default': False,
+    },
     {
         'fieldset': 'WiFi',
         'name': 'ap',
@@ -52,6 +71,13 @@ CONFIG_VARS = [
         'text': 'WiFi Password',
         'default': 'p1exporter',
     },
+    {
+        'fieldset': 'UART',
+        'name': 'meter_name',
+        'type': 'text',
+        'text': 'Meter Name',
+        'default': 'main',
+    },
     {
         'fieldset': 'UART',
         'name': 'uart_no',
@@ -115,6 +141,412 @@ CONFIG_VARS = [
             },
         ],
     },
+    {
+        'fieldset': 'UART',
+        'name': 'uart_max_telegram_size',
+        'type': 'number',
+        'text': 'Max Telegram Size Bytes',
+        'min': 256,
+        'max': 16384,
+        'default': 2048,
+    },
+    {
+        'fieldset': 'UART',
+        'name': 'reject_crc_errors',
+        'type': 'checkbox',
+        'text': 'Reject Telegrams With CRC Errors',
+        'default': True,
+    },
+    {
+        'fieldset': 'Second UART',
+        'name': 'uart2_enable',
+        'type': 'checkbox',
+        'text': 'Enable A Second Meter On The Other UART',
+        'default': False,
+    },
+    {
+        'fieldset': 'Second UART',
+        'name': 'uart2_meter_name',
+        'type': 'text',
+        'text': 'Meter Name',
+        'default': 'sub',
+    },
+    {
+        'fieldset': 'Second UART',
+        'name': 'uart2_tx_gpio',
+        'type': 'number',
+        'text': 'UART TX GPIO',
+        'min': 0,
+        'max': 28,
+        'default': 12,
+    },
+    {
+        'fieldset': 'Second UART',
+        'name': 'uart2_rx_gpio',
+        'type': 'number',
+        'text': 'UART RX GPIO',
+        'min': 0,
+        'max': 28,
+        'default': 13,
+    },
+    {
+        'fieldset': 'Second UART',
+        'name': 'uart2_baudrate',
+        'type': 'number',
+        'text': 'UART Baudrate',
+        'min': 300,
+        'max': 115200,
+        'default': 115200,
+    },
+    {
+        'fieldset': 'Second UART',
+        'name': 'uart2_bits',
+        'type': 'radio',
+        'default': 8,
+        'selections': [
+            {
+                'id': 'uart2_bits7',
+                'text': 'UART 7 Bits',
+                'value': '7',
+            },
+            {
+                'id': 'uart2_bits8',
+                'text': 'UART 8 Bits',
+                'value': '8',
+            },
+        ],
+    },
+    {
+        'fieldset': 'HTTP',
+        'name': 'http_idle_timeout',
+        'type': 'number',
+        'text': 'Keep-Alive Idle Timeout Seconds',
+        'min': 1,
+        'max': 3600,
+        'default': 35,
+    },
+    {
+        'fieldset': 'HTTP',
+        'name': 'http_max_requests',
+        'type': 'number',
+        'text': 'Max Requests Per Connection',
+        'min': 1,
+        'max': 10000,
+        'default': 100,
+    },
+    {
+        'fieldset': 'Raw Relay',
+        'name': 'raw_queue_size',
+        'type': 'number',
+        'text': 'Queue Size Per Client',
+        'min': 512,
+        'max': 32768,
+        'default': 4096,
+    },
+    {
+        'fieldset': 'Raw Relay',
+        'name': 'raw_mode',
+        'type': 'radio',
+        'default': 'raw',
+        'selections': [
+            {
+                'id': 'raw_mode_raw',
+                'text': 'Relay Raw UART Data',
+                'value': 'raw',
+            },
+            {
+                'id': 'raw_mode_telegram',
+                'text': 'Relay Complete Telegrams',
+                'value': 'telegram',
+            },
+            {
+                'id': 'raw_mode_verified',
+                'text': 'Relay Telegrams With Correct CRC',
+                'value': 'verified',
+            },
+        ],
+    },
+    {
+        'fieldset': 'History',
+        'name': 'history_size',
+        'type': 'number',
+        'text': 'Telegrams To Keep In History',
+        'min': 0,
+        'max': 600,
+        'default': 300,
+    },
+    {
+        'fieldset': 'Data Log',
+        'name': 'log_enable',
+        'type': 'checkbox',
+        'text': 'Log Values To Flash',
+        'default': False,
+    },
+    {
+        'fieldset': 'Data Log',
+        'name': 'log_interval',
+        'type': 'number',
+        'text': 'Seconds Between Records',
+        'min': 1,
+        'max': 3600,
+        'default': 10,
+    },
+    {
+        'fieldset': 'Data Log',
+        'name': 'log_segment_size',
+        'type': 'number',
+        'text': 'Segment Size KiB',
+        'min': 8,
+        'max': 256,
+        'default': 32,
+    },
+    {
+        'fieldset': 'Data Log',
+        'name': 'log_segments',
+        'type': 'number',
+        'text': 'Segments To Keep',
+        'min': 2,
+        'max': 64,
+        'default': 12,
+    },
+    {
+        'fieldset': 'Data Log',
+        'name': 'log_flush_seconds',
+        'type': 'number',
+        'text': 'Max Seconds Before Writing To Flash',
+        'min': 10,
+        'max': 3600,
+        'default': 300,
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_enable',
+        'type': 'checkbox',
+        'text': 'Push To InfluxDB',
+        'default': False,
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_host',
+        'type': 'text',
+        'text': 'Host',
+        'default': '',
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_port',
+        'type': 'number',
+        'text': 'Port',
+        'min': 1,
+        'max': 65535,
+        'default': 8086,
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_path',
+        'type': 'text',
+        'text': 'Write Path',
+        'default': '/write?db=p1&precision=ns',
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_token',
+        'type': 'password',
+        'text': 'Token',
+        'default': '',
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_batch',
+        'type': 'number',
+        'text': 'Telegrams Per Write',
+        'min': 1,
+        'max': 100,
+        'default': 10,
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_interval',
+        'type': 'number',
+        'text': 'Max Seconds Between Writes',
+        'min': 1,
+        'max': 3600,
+        'default': 10,
+    },
+    {
+        'fieldset': 'InfluxDB',
+        'name': 'influx_queue_size',
+        'type': 'number',
+        'text': 'Retry Queue Bytes',
+        'min': 1024,
+        'max': 65536,
+        'default': 16384,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_enable',
+        'type': 'checkbox',
+        'text': 'Publish To MQTT',
+        'default': False,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_host',
+        'type': 'text',
+        'text': 'Broker Host',
+        'default': '',
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_port',
+        'type': 'number',
+        'text': 'Broker Port',
+        'min': 1,
+        'max': 65535,
+        'default': 1883,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_user',
+        'type': 'text',
+        'text': 'User',
+        'default': '',
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_password',
+        'type': 'password',
+        'text': 'Password',
+        'default': '',
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_topic',
+        'type': 'text',
+        'text': 'Topic Prefix',
+        'default': 'p1exporter',
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_format',
+        'type': 'radio',
+        'default': 'obis',
+        'selections': [
+            {
+                'id': 'mqtt_format_obis',
+                'text': 'One Topic Per OBIS Code',
+                'value': 'obis',
+            },
+            {
+                'id': 'mqtt_format_json',
+                'text': 'One JSON Object Per Publish',
+                'value': 'json',
+            },
+        ],
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_retain',
+        'type': 'checkbox',
+        'text': 'Retain Published Values',
+        'default': True,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_changed_only',
+        'type': 'checkbox',
+        'text': 'Only Publish Changed Values',
+        'default': True,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_interval',
+        'type': 'number',
+        'text': 'Seconds Between Publishes',
+        'min': 1,
+        'max': 3600,
+        'default': 5,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_deadband_power',
+        'type': 'number',
+        'text': 'Power Deadband W',
+        'min': 0,
+        'max': 100000,
+        'default': 0,
+    },
+    {
+        'fieldset': 'MQTT',
+        'name': 'mqtt_deadband_current',
+        'type': 'number',
+        'text': 'Current Deadband mA',
+        'min': 0,
+        'max': 100000,
+        'default': 0,
+    },
+    {
+        'fieldset': 'Min/Max',
+        'name': 'minmax_reset',
+        'type': 'radio',
+        'default': 'window',
+        'selections': [
+            {
+                'id': 'minmax_reset_window',
+                'text': 'Over The Last One Or Two Windows',
+                'value': 'window',
+            },
+            {
+                'id': 'minmax_reset_scrape',
+                'text': 'Since The Last Scrape',
+                'value': 'scrape',
+            },
+        ],
+    },
+    {
+        'fieldset': 'Min/Max',
+        'name': 'minmax_window',
+        'type': 'number',
+        'text': 'Window Seconds',
+        'min': 1,
+        'max': 3600,
+        'default': 60,
+    },
+    {
+        'fieldset': 'OBIS',
+        'name': 'obis_profile',
+        'type': 'radio',
+        'default': 'se',
+        'selections': [
+            {
+                'id': 'obis_profile_se',
+                'text': 'Sweden',
+                'value': 'se',
+            },
+            {
+                'id': 'obis_profile_nl',
+                'text': 'Netherlands (DSMR)',
+                'value': 'nl',
+            },
+            {
+                'id': 'obis_profile_be',
+                'text': 'Belgium (e-MUCS)',
+                'value': 'be',
+            },
+            {
+                'id': 'obis_profile_file',
+                'text': 'From obis.json',
+                'value': 'file',
+            },
+        ],
+    },
+    {
+        'fieldset': 'OBIS',
+        'name': 'obis_export_unknown',
+        'type': 'checkbox',
+        'text': 'Export Unknown Numeric Codes As p1_value',
+        'default': False,
+    },
     {
         'fieldset': 'OLED',
         'name': 'oled_enable',
@@ -172,7 +604,7 @@ CONFIG_VARS = [
 
 CONFIG_FILENAME = 'config.json'
 
-starttime = time.ticks_ms()
+starttime = ticks_ms()
 
 if time.gmtime(0)[0] != 1970:
     raise Exception("Epoch year is not 1970!")
@@ -183,6 +615,36 @@ class DummyWDT:
         pass
 
 wdt = DummyWDT()
+watchdog_feeds = 0
+
+# The tasks that must keep running are restarted when they fail, and the
+# restarts counted here by task name. A task that failed more than
+# TASK_RESTART_LIMIT times is taken to be broken for good, the watchdog is
+# then no longer fed so that the Pico is reset.
+TASK_RESTART_LIMIT = 10
+task_restarts = {}
+
+def feed_watchdog():
+    global watchdog_feeds
+    for restarts in task_restarts.values():
+        if restarts > TASK_RESTART_LIMIT:
+            return
+    watchdog_feeds += 1
+    wdt.feed()
+
+def task_failed(name, e):
+    print("*** Task %s failed: %s" % (name, repr(e)))
+    task_restarts[name] += 1
+
+async def supervise(name, task):
+    # Run the coroutine function task, restarting it when it fails
+    task_restarts[name] = 0
+    while True:
+        try:
+            await task()
+        except Exception as e:
+            task_failed(name, e)
+        await asyncio.sleep(1)
 
 def reboot():
     global wdt
@@ -192,7 +654,7 @@ def reboot():
         time.sleep(1)
     
 def save_config():
-    with open(CONFIG_FILENAME, 'w') as f:
+    with open(ROOT + CONFIG_FILENAME, 'w') as f:
         json.dump(config, f)
 
 def set_default_config():
@@ -203,8 +665,8 @@ def set_default_config():
         config[var['name']] = var['default']
     save_config()
 
-if CONFIG_FILENAME in uos.listdir('/'):
-    with open(CONFIG_FILENAME, 'r') as f:
+if CONFIG_FILENAME in uos.listdir(ROOT):
+    with open(ROOT + CONFIG_FILENAME, 'r') as f:
         config = json.load(f)
 else:
     set_default_config()
@@ -215,34 +677,50 @@ for var in CONFIG_VARS:
 
 print('Config:', config)
 
-if config['oled_enable']:
-    from ssd1306 import SSD1306_I2C
-    i2c = I2C(config['oled_i2c_no'], sda=Pin(config['oled_sda_pin']), scl=Pin(config['oled_scl_pin']), freq=config['oled_i2c_freq'])
-    oled = SSD1306_I2C(128, 64, i2c)
-    oled.text("P1 Exporter", 0, 0)
-    oled.text("WiFi connect...", 0, 16)
-    oled.show()
+conversion_factor = 3.3 / (65535)
 
-led = Pin('LED', Pin.OUT)
-led.off()
+# Wait a while before enabling the watchdog, giving a chance to interrupt
+# the application
+BOOT_DELAY = True
 
-if config['enable_wdt']:
-    for i in range(0,10):
-        time.sleep(1)
-        led.toggle()
-    print('Enabling Watchdog Timer')
-    wdt = WDT(timeout=5000)
-else:
-    for i in range(0,4):
-        time.sleep(1)
-        led.toggle()
-    
-led.off()
+def setup_hardware():
+    global i2c, oled, led, wdt, sensor_temp
 
-sensor_temp = machine.ADC(4)
-conversion_factor = 3.3 / (65535)
+    if config['oled_enable']:
+        from ssd1306 import SSD1306_I2C
+        i2c = I2C(config['oled_i2c_no'], sda=Pin(config['oled_sda_pin']), scl=Pin(config['oled_scl_pin']), freq=config['oled_i2c_freq'])
+        oled = SSD1306_I2C(128, 64, i2c)
+        oled.text("P1 Exporter", 0, 0)
+        oled.text("WiFi connect...", 0, 16)
+        oled.show()
+
+    led = Pin('LED', Pin.OUT)
+    led.off()
+
+    if config['enable_wdt']:
+        if BOOT_DELAY:
+            for i in range(0,10):
+                time.sleep(1)
+                led.toggle()
+        print('Enabling Watchdog Timer')
+        wdt = WDT(timeout=5000)
+    elif BOOT_DELAY:
+        for i in range(0,4):
+            time.sleep(1)
+            led.toggle()
+
+    led.off()
+
+    sensor_temp = ADC(4)
+
+    # Enable pull-up on the UART rx pin
+    #Pin(config['uart_rx_gpio'], Pin.IN, Pin.PULL_UP)
+
+    # Set up the UARTs for receiving P1 data
+    for meter in meters:
+        meter.open_uart()
  
-def wlan_setup_ap():
+async def wlan_setup_ap():
     global wlan
     try:
         ssid = config['ssid']
@@ -255,8 +733,8 @@ def wlan_setup_ap():
         wlan.active(True)
     
         while not wlan.active():
-            wdt.feed()
-            time.sleep(1)
+            feed_watchdog()
+            await asyncio.sleep(1)
 
         print('Access point active')
         ip, netmask, gateway, dns = wlan.ifconfig()
@@ -268,9 +746,9 @@ def wlan_setup_ap():
         print("channel:", wlan.config('channel'))
     except Exception as e:
         print("*** WiFi ERROR: " + str(e))
-        time.sleep(1)
+        await asyncio.sleep(1)
 
-def wlan_setup_sta():
+async def wlan_setup_sta(scan):
     global wlan
     try:
         wlan = network.WLAN(network.STA_IF)
@@ -280,11 +758,12 @@ def wlan_setup_sta():
 
         wlan.disconnect()
         wlan.active(False)
-        wdt.feed()
-        time.sleep(1)
+        feed_watchdog()
+        await asyncio.sleep(1)
         wlan.active(True)
 
-        # Scanning for APs
+        # Scanning for APs, which blocks the event loop for seconds, so only
+        # when setting up at boot and not when reconnecting
         wlan_sec_map = {
                 0: "OPEN",
                 1: "WEP",
@@ -292,10 +771,12 @@ def wlan_setup_sta():
                 3: "WPA2-PSK",
                 4: "WPA/WPA2-PSK"
             }
-        print("Scanning for WiFi networks...")
-        wdt.feed()
-        wlans = wlan.scan()
-        wdt.feed()
+        wlans = ()
+        if scan:
+            print("Scanning for WiFi networks...")
+            feed_watchdog()
+            wlans = wlan.scan()
+            feed_watchdog()
         for w in wlans:
             # (ssid, bssid, channel, RSSI, security, hidden)
             #print(w)
@@ -315,8 +796,8 @@ def wlan_setup_sta():
                 break
             max_wait -= 1
             sys.stdout.write('.')
-            wdt.feed()
-            time.sleep(1)
+            feed_watchdog()
+            await asyncio.sleep(1)
         print('')
 
         if wlan.status() != 3:
@@ -330,283 +811,670 @@ def wlan_setup_sta():
 
         for i in range(0, 3):
             led.on()
-            time.sleep(.1)
+            await asyncio.sleep(.1)
             led.off()
-            time.sleep(.1)
+            await asyncio.sleep(.1)
     except Exception as e:
         print("*** WiFi ERROR: " + str(e))
-        time.sleep(1)
+        await asyncio.sleep(1)
 
-def wlan_setup():
+async def wlan_setup(scan=True):
     if not config['ap'] and len(config['ssid']) > 0 and len(config['password']) > 0:
-        wlan_setup_sta()
+        await wlan_setup_sta(scan)
     else:
-        wlan_setup_ap()
-
+        await wlan_setup_ap()
 
-wlan_setup()
 
-# Create a stream poller
-poller = select.poll()
-
-s = socket.socket()
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-#s.setblocking(True)
-addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
-s.bind(addr)
-s.listen()
-poller.register(s, select.POLLIN)
-print('Http socket listening on port', addr[1])
+# Clients waiting on /waitmetrics for the next telegram
 http_clients = []
 
-# Raw socket for relaying incoming serial data
-raw_server = socket.socket()
-raw_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-raw_server_addr = socket.getaddrinfo('0.0.0.0', 1234)[0][-1]
-raw_server.bind(raw_server_addr)
-raw_server.listen()
-poller.register(raw_server, select.POLLIN)
-print('Raw socket listening on port', raw_server_addr[1])
-raw_clients = []
+# Clients of /stream
+event_stream = EventStream()
 
-# Set up metric for energy
-energy = Metric("p1_energy_kwhs", Metric.TYPE_COUNTER, ("type", "direction"))
-energy.set_help("The accumulated meter value over all time")
+# All exported metrics are registered here and rendered, in registration
+# order, into one buffer preceded by the HTTP response header. The buffer is
+# only rebuilt when a series changed and the live metrics, uptime and
+# temperature, are patched into it at scrape time. Every scraper is then
+# served from the same buffer with one sendall.
+def openmetrics_header(length):
+    return ('HTTP/1.1 200 OK\r\nContent-type: text/plain\r\nContent-Length: %d\r\n\r\n'
+            % length).encode()
 
-# Set up metric for power
-power = Metric("p1_power_watts", Metric.TYPE_GAUGE, ("type", "direction", "phase"))
-power.set_help("Momentary power")
+registry = Registry(openmetrics_header)
 
-# Set up metric for voltage
-voltage = Metric("p1_voltage_volts", Metric.TYPE_GAUGE, ("phase"))
-voltage.set_help("Incoming voltage from grid")
-
-# Set up metric for current
-current = Metric("p1_current_amperes", Metric.TYPE_GAUGE, ("phase"))
-current.set_help("Momentary current draw")
+# Fixed width formats for the metrics that change with every scrape or
+# telegram, whole numbers and seconds, so that their values are patched
+# into the exposition rather than it being rendered again
+INT_FMT = '%012.0f'
+SECONDS_FMT = '%016.6f'
 
 # Metric for applicaton uptime
 uptime = Metric("p1_uptime_seconds", Metric.TYPE_COUNTER)
 uptime.set_help("Uptime of the P1 exporter application")
+registry.register(uptime, '%016.3f')
 
 temperature = Metric("p1_temperature_celcius", Metric.TYPE_GAUGE)
 temperature.set_help("The temperature of the SOC")
+registry.register(temperature, '%08.3f')
+
+# The P1 inputs, one per UART, as (name, UART number, config prefix). The
+# second meter is on the other UART, configured by the uart2_ variables.
+# With more than one meter, every series of a meter is labelled with its
+# name.
+meter_configs = [(config['meter_name'], config['uart_no'], 'uart_')]
+if config['uart2_enable']:
+    meter_configs.append((config['uart2_meter_name'], 1 - config['uart_no'], 'uart2_'))
+METER_LABELS = ("meter",) if len(meter_configs) > 1 else ()
+
+# Metric for received telegrams
+telegrams_total = Metric("p1_telegrams_total", Metric.TYPE_COUNTER, METER_LABELS + ("result",))
+telegrams_total.set_help("Received telegrams by CRC and decode result")
+registry.register(telegrams_total, INT_FMT)
+
+# Metric for telegrams dropped by the framing
+telegrams_dropped = Metric("p1_telegrams_dropped_total", Metric.TYPE_COUNTER, METER_LABELS + ("reason",))
+telegrams_dropped.set_help("Telegrams dropped because they were too large or truncated")
+registry.register(telegrams_dropped, INT_FMT)
 
-# Map OBIS to related metric data
-obis_map = {
-    #"0-0:1.0.0": {
-    #    "name": "Datum och tid"
-    #    },
-    "1-0:1.8.0": {
-        "name": "Mätarställning Aktiv Energi Uttag.",
-        "metric": energy,
-        "labels": ("active", "consume")
-        },
-    "1-0:2.8.0": {
-        "name": "Mätarställning Aktiv Energi Inmatning",
-        "metric": energy,
-        "labels": ("active", "produce")
-        },
-    "1-0:3.8.0": {
-        "name": "Mätarställning Reaktiv Energi Uttag",
-        "metric": energy,
-        "labels": ("reactive", "consume")
-        },
-    "1-0:4.8.0": {
-        "name": "Mätarställning Reaktiv Energi Inmatning",
-        "metric": energy,
-        "labels": ("reactive", "produce")
-        },
-    "1-0:1.7.0": {
-        "name": "Aktiv Effekt Uttag",          # Momentan trefaseffekt
-        "metric": power,
-        "labels": ("active", "consume","all")
-        },
-    "1-0:2.7.0": {
-        "name": "Aktiv Effekt Inmatning",      # Momentan trefaseffekt
-        "metric": power,
-        "labels": ("active", "produce","all")
-        },
-    "1-0:3.7.0": {
-        "name": "Reaktiv Effekt Uttag",        # Momentan trefaseffekt
-        "metric": power,
-        "labels": ("reactive", "consume","all")
-        },
-    "1-0:4.7.0": {
-        "name": "Reaktiv Effekt Inmatning",    # Momentan trefaseffekt
-        "metric": power,
-        "labels": ("reactive", "produce","all")
-        },
-    "1-0:21.7.0": {
-        "name": "L1 Aktiv Effekt Uttag",       # Momentan effekt
-        "metric": power,
-        "labels": ("active", "consume", "L1")
-        },
-    "1-0:22.7.0": {
-        "name": "L1 Aktiv Effekt Inmatning",   # Momentan effekt
-        "metric": power,
-        "labels": ("active", "produce", "L1")
-        },
-    "1-0:41.7.0": {
-        "name": "L2 Aktiv Effekt Uttag",       # Momentan effekt
-        "metric": power,
-        "labels": ("active", "consume", "L2")
-        },
-    "1-0:42.7.0": {
-        "name": "L2 Aktiv Effekt Inmatning",   # Momentan effekt
-        "metric": power,
-        "labels": ("active", "produce", "L2")
-        },
-    "1-0:61.7.0": {
-        "name": "L3 Aktiv Effekt Uttag",       # Momentan effekt
-        "metric": power,
-        "labels": ("active", "consume", "L3")
-        },
-    "1-0:62.7.0": {
-        "name": "L3 Aktiv Effekt Inmatning",   # Momentan effekt
-        "metric": power,
-        "labels": ("active", "produce", "L3")
-        },
-    "1-0:23.7.0": {
-        "name": "L1 Reaktiv Effekt Uttag",     # Momentan effekt
-        "metric": power,
-        "labels": ("reactive", "consume", "L1")
-        },
-    "1-0:24.7.0": {
-        "name": "L1 Reaktiv Effekt Inmatning", # Momentan effekt
-        "metric": power,
-        "labels": ("reactive", "produce", "L1")
-        },
-    "1-0:43.7.0": {
-        "name": "L2 Reaktiv Effekt Uttag",     # Momentan effekt
-        "metric": power,
-        "labels": ("reactive", "consume", "L2")
-        },
-    "1-0:44.7.0": {
-        "name": "L2 Reaktiv Effekt Inmatning", # Momentan effekt
-        "metric": power,
-        "labels": ("reactive", "produce", "L2")
-        },
-    "1-0:63.7.0": {
-        "name": "L3 Reaktiv Effekt Uttag",     # Momentan effekt
-        "metric": power,
-        "labels": ("reactive", "consume", "L3")
-        },
-    "1-0:64.7.0": {
-        "name": "L3 Reaktiv Effekt Inmatning", # Momentan effekt
-        "metric": power,
-        "labels": ("reactive", "produce", "L3")
-        },
-    "1-0:32.7.0": {
-        "name": "L1 Fasspänning",              # Momentant RMS-värde
-        "metric": voltage,
-        "labels": ("L1")
-        },
-    "1-0:52.7.0": {
-        "name": "L2 Fasspänning",              # Momentant RMS-värde
-        "metric": voltage,
-        "labels": ("L2")
-        },
-    "1-0:72.7.0": {
-        "name": "L3 Fasspänning",              # Momentant RMS-värde
-        "metric": voltage,
-        "labels": ("L3")
-        },
-    "1-0:31.7.0": {
-        "name": "L1 Fasström",                 # Momentant RMS-värde
-        "metric": current,
-        "labels": ("L1")
-        },
-    "1-0:51.7.0": {
-        "name": "L2 Fasström",                 # Momentant RMS-värde
-        "metric": current,
-        "labels": ("L2")
-        },
-    "1-0:71.7.0": {
-        "name": "L3 Fasström",                 # Momentant RMS-värde
-        "metric": current,
-        "labels": ("L3")
-        }
-    }
-
-obis_display_order = [
-    "1-0:1.8.0",
-    "1-0:2.8.0",
-    "1-0:3.8.0",
-    "1-0:4.8.0",
-    "1-0:1.7.0",
-    "1-0:2.7.0",
-    "1-0:3.7.0",
-    "1-0:4.7.0",
-    "1-0:21.7.0",
-    "1-0:22.7.0",
-    "1-0:41.7.0",
-    "1-0:42.7.0",
-    "1-0:61.7.0",
-    "1-0:62.7.0",
-    "1-0:23.7.0",
-    "1-0:24.7.0",
-    "1-0:43.7.0",
-    "1-0:44.7.0",
-    "1-0:63.7.0",
-    "1-0:64.7.0",
-    "1-0:32.7.0",
-    "1-0:52.7.0",
-    "1-0:72.7.0",
-    "1-0:31.7.0",
-    "1-0:51.7.0",
-    "1-0:71.7.0"
-    ]
-
-
-def add_raw_client():
-    try:
-        cl, addr = raw_server.accept()
-        cl.setblocking(True)
-        print('### Raw client connected from', addr)
-        poller.register(cl, select.POLLIN)
-    except OSError as e:
-        cl.close()
+# Set up metric for energy
+energy = Metric("p1_energy_kwhs", Metric.TYPE_COUNTER, METER_LABELS + ("type", "direction"))
+energy.set_help("The accumulated meter value over all time")
+registry.register(energy)
+
+# The min, max, sum and count of power, voltage and current, so that peaks
+# between scrapes are seen. The min and max cover either the window that was
+# started every minmax_window seconds and the one before it, or the time
+# since the last scrape.
+aggregates = []
+aggregate_window_start = ticks_ms()
+
+def register_aggregate(metric):
+    aggregate = Aggregate(metric)
+    for m in aggregate.metrics():
+        registry.register(m)
+    aggregates.append(aggregate)
+
+def rotate_aggregates():
+    global aggregate_window_start
+    if config['minmax_reset'] != 'window':
+        return
+    now = ticks_ms()
+    if ticks_diff(now, aggregate_window_start) >= config['minmax_window'] * 1000:
+        aggregate_window_start = now
+        for aggregate in aggregates:
+            aggregate.rotate()
+
+def reset_aggregates():
+    if config['minmax_reset'] != 'scrape':
         return
-    raw_clients.append(cl)
+    for aggregate in aggregates:
+        aggregate.reset()
 
+# Set up metric for power
+power = Metric("p1_power_watts", Metric.TYPE_GAUGE, METER_LABELS + ("type", "direction", "phase"))
+power.set_help("Momentary power")
+registry.register(power)
+register_aggregate(power)
 
-def remove_raw_client(cl):
-    print("### Remove raw client")
-    raw_clients.remove(cl)
-    poller.unregister(cl)
-    cl.close()
-    
+# Set up metric for voltage
+voltage = Metric("p1_voltage_volts", Metric.TYPE_GAUGE, METER_LABELS + ("phase",))
+voltage.set_help("Incoming voltage from grid")
+registry.register(voltage)
+register_aggregate(voltage)
 
-def add_http_client(cl):
+# Set up metric for current
+current = Metric("p1_current_amperes", Metric.TYPE_GAUGE, METER_LABELS + ("phase",))
+current.set_help("Momentary current draw")
+registry.register(current)
+register_aggregate(current)
+
+# The OBIS codes of a meter, looked up in a table compiled from the profile
+# once. Metrics defined by the profile are added to obis_metrics.
+OBIS_FILENAME = 'obis.json'
+
+def new_obis_metric(name, type_name, labels, help_text):
+    metric = Metric(name, type_name, METER_LABELS + labels)
+    if help_text is not None:
+        metric.set_help(help_text)
+    return registry.register(metric)
+
+def load_obis_profile():
+    # A profile that cannot be used falls back to the se profile, rather
+    # than failing at every boot
+    if config['obis_profile'] != 'file':
+        return PROFILES[config['obis_profile']]
+    if OBIS_FILENAME not in uos.listdir(ROOT):
+        print('No %s, using the se profile' % OBIS_FILENAME)
+        return PROFILES['se']
     try:
-        poller.register(cl, select.POLLIN)
-    except OSError as e:
-        cl.close()
-        return
-    http_clients.append(cl)
-    print("### connected clients: %d" % len(http_clients))
+        with open(ROOT + OBIS_FILENAME, 'r') as f:
+            profile = json.load(f)
+        check_profile(profile, obis_metrics, len(METER_LABELS))
+        return profile
+    except (ValueError, KeyError, OSError) as e:
+        print('*** Bad %s, using the se profile: %s' % (OBIS_FILENAME, str(e)))
+        return PROFILES['se']
+
+obis_metrics = {
+    "energy": energy,
+    "power": power,
+    "voltage": voltage,
+    "current": current,
+}
+
+# Numeric values of OBIS codes without a mapping
+obis_unknown = None
+if config['obis_export_unknown']:
+    obis_unknown = new_obis_metric("p1_value", Metric.TYPE_GAUGE, ("obis", "unit"),
+                                   "Value of an OBIS code without a mapping")
+
+obis_profile = load_obis_profile()
+
+raw_relay = RawRelay(config['raw_queue_size'], config['raw_mode'],
+                     max_telegram_size=config['uart_max_telegram_size'])
+
+TELEGRAM_RESULTS = ("ok", "crc_error", "malformed")
+
+# In dual-core mode the UARTs are read, and the telegrams framed and decoded,
+# by a thread on the second core. The decoded values are handed over to the
+# event loop on the first core, which applies them to the metrics.
+if config['dual_core']:
+    import _thread
+    from handoff import TripleBuffer, DecodedTelegram
+
+class Meter:
+    # One P1 input, with its own UART, framing, parser and OBIS table. The
+    # raw relay, if given, is fed the data received.
+
+    def __init__(self, name, uart_no, prefix, relay=None):
+        self.name = name
+        self.uart_no = uart_no
+        self.prefix = prefix
+        self.relay = relay
+        self.uart = None
+        # Label values put before those of every series of the meter
+        self.labels = (name,) if len(METER_LABELS) > 0 else ()
+        self.obis_table = ObisTable(obis_profile, obis_metrics, new_obis_metric,
+                                    obis_unknown, self.labels)
+        self.values = dict()
+        self.header = None
+        self.timestamp = None
+        self.reads = 0
+        self.results = {}
+        for result in TELEGRAM_RESULTS:
+            self.results[result] = 0
+            telegrams_total.set_value(0, self.labels + (result,))
+        telegrams_dropped.set_value(0, self.labels + ("too_large",))
+        telegrams_dropped.set_value(0, self.labels + ("truncated",))
+        # With more than one meter the values published to MQTT and /stream
+        # are told apart by the meter name
+        self.key_prefix = None
+        self.stream_name = None
+        if len(METER_LABELS) > 0:
+            self.key_prefix = name + '/'
+            self.stream_name = name
+        self._dropped = 0
+        self.handoff = None
+        if config['dual_core']:
+            self.handoff = TripleBuffer(DecodedTelegram)
+            self.parser = P1Parser(self.collect_value, self.collect_header)
+            self.framer = TelegramFramer(self.on_telegram_core1, config['uart_max_telegram_size'])
+        else:
+            self.parser = P1Parser(self.on_value, self.on_header)
+            self.framer = TelegramFramer(self.on_telegram, config['uart_max_telegram_size'])
+
+    def open_uart(self):
+        prefix = self.prefix
+        self.uart = UART(
+            self.uart_no,
+            baudrate=config[prefix + 'baudrate'],
+            bits=config[prefix + 'bits'],
+            parity=None,
+            stop=1,
+            tx=Pin(config[prefix + 'tx_gpio']),
+            rx=Pin(config[prefix + 'rx_gpio']),
+            rxbuf=1024,
+            invert=UART.INV_RX)
+
+    def on_header(self, manufacturer, speed, meter_id):
+        led.on()
+        print("manufacturer=", manufacturer)
+        print("speed=", speed)
+        print("id=", meter_id)
+        self.header = (manufacturer, speed, meter_id)
+        self.timestamp = None
+
+    def on_value(self, obis, value, unit):
+        if obis == "0-0:1.0.0":
+            seconds = timestamp_seconds(value)
+            if seconds is not None:
+                self.timestamp = 1000 * (seconds - config['tz_offset'])
+                print(self.timestamp / 1000)
+                return
+        self.apply_value(obis, value, unit)
+
+    def apply_value(self, obis, value, unit):
+        obis_code = self.obis_table.get(obis, value, unit)
+        if obis_code is not None:
+            name = obis_code.name
+        else:
+            name = obis
+        print(name + ': ' + value + unit)
+        self.values[obis] = (value, unit)
+        if mqtt is not None and len(unit) > 0:
+            # Only measurements, not the identifiers and counters without unit
+            mqtt.put(obis if self.key_prefix is None else self.key_prefix + obis, value)
+        if obis_code is not None and obis_code.metric is not None:
+            obis_code.metric.set_slot(obis_code.slot, value, self.timestamp)
+
+    def decode(self, msg):
+        self.header = None
+        # msg is a complete telegram, ending at the '!', so start over from a
+        # clean state instead of waiting for the end of the CRC line
+        self.parser.reset()
+        self.parser.feed(msg)
+        if self.header is None:
+            return False
+        if self.handoff is None:
+            if config['oled_enable'] and self is meters[0]:
+                oled_show(self.header, self.values)
+            led.off()
+        return self.parser.errors == 0
+
+    def count_telegram(self, result):
+        self.results[result] += 1
+        telegrams_total.set_value(self.results[result], self.labels + (result,))
+
+    def lineprotocol_rows(self):
+        # The line protocol rows of the series of the meter that have a value
+        rows = ''
+        for obis_code in self.obis_table.codes.values():
+            metric = obis_code.metric
+            if metric is not None and metric.slot_is_set(obis_code.slot):
+                rows += metric.slot_lineprotocol_row(obis_code.slot)
+        return rows
+
+    def on_telegram(self, mv, crc_ok):
+        if self.relay is not None:
+            self.relay.feed_telegram(mv, self.framer.crc, crc_ok)
+        rotate_aggregates()
+        if crc_ok is False:
+            self.count_telegram("crc_error")
+            if config['reject_crc_errors']:
+                print("### Rejected telegram with CRC error")
+                registry.render()
+                return
+            decode_telegram(self, mv)
+        elif decode_telegram(self, mv):
+            self.count_telegram("ok")
+        else:
+            self.count_telegram("malformed")
+        self.finish_telegram()
 
+    def finish_telegram(self):
+        # Pass on the values of a telegram applied to the metrics
+        if self.timestamp is not None:
+            ts = self.timestamp // 1000
+        else:
+            ts = int(time.time())
+        record_history(ts)
+        event_stream.publish(self.values, ts, self.stream_name)
+        if mqtt is not None:
+            mqtt.set_timestamp(ts)
+        if influx is not None:
+            influx.put(self.lineprotocol_rows())
+        registry.render()
+        send_waiting_clients()
+
+    async def run(self):
+        reader = uart_stream(self.uart)
+        framer = self.framer
+        while True:
+            n = await reader.readinto(framer.free())
+            self.reads += 1
+            data = framer.received(n)
+            print("### UART read: len=%d" % len(data))
+
+            if self.relay is not None:
+                self.relay.feed(data)
+
+            framer.process()
+            if self.update_dropped():
+                registry.render()
+            # A read of data that is already buffered may not yield, so give
+            # the other meters their turn here, one read each
+            await asyncio.sleep(0)
+
+    def update_dropped(self):
+        # Copy the counts of telegrams dropped by the framing into the
+        # metric. True is returned if they changed.
+        framer = self.framer
+        dropped = framer.dropped()
+        if dropped == self._dropped:
+            return False
+        self._dropped = dropped
+        telegrams_dropped.set_value(framer.dropped_too_large, self.labels + ("too_large",))
+        telegrams_dropped.set_value(framer.dropped_truncated, self.labels + ("truncated",))
+        return True
+
+    # In dual-core mode the parser and framer callbacks run on core 1 and
+    # fill in the back buffer of the hand-off. Nothing else is touched.
+
+    def collect_header(self, manufacturer, speed, meter_id):
+        decoded = self.handoff.back
+        self.header = decoded.header = (manufacturer, speed, meter_id)
+        decoded.timestamp = None
+
+    def collect_value(self, obis, value, unit):
+        decoded = self.handoff.back
+        if obis == "0-0:1.0.0":
+            seconds = timestamp_seconds(value)
+            if seconds is not None:
+                decoded.timestamp = 1000 * (seconds - config['tz_offset'])
+                return
+        decoded.values.append((obis, value, unit))
+
+    def on_telegram_core1(self, mv, crc_ok):
+        decoded = self.handoff.back
+        decoded.clear()
+        decoded.crc_ok = crc_ok
+        if crc_ok is not False or not config['reject_crc_errors']:
+            decoded.ok = decode_telegram(self, mv)
+        if self.relay is not None and len(self.relay.clients) > 0:
+            decoded.telegram = bytes(mv)
+            decoded.crc = bytes(self.framer.crc)
+        self.handoff.publish()
+
+    def apply(self, decoded):
+        # Apply a telegram decoded on core 1 to the metrics, on core 0. False
+        # is returned if it was rejected.
+        if self.relay is not None and decoded.telegram is not None:
+            # The raw relay is given whole telegrams, in raw mode too
+            self.relay.feed(decoded.telegram)
+            self.relay.feed(decoded.crc)
+            self.relay.feed(b'\r\n')
+            self.relay.feed_telegram(decoded.telegram, decoded.crc, decoded.crc_ok)
+        rotate_aggregates()
+        self.update_dropped()
+        if decoded.crc_ok is False:
+            self.count_telegram("crc_error")
+            if config['reject_crc_errors']:
+                print("### Rejected telegram with CRC error")
+                return False
+        if decoded.header is not None:
+            led.on()
+            manufacturer, speed, meter_id = decoded.header
+            print("manufacturer=", manufacturer)
+            print("speed=", speed)
+            print("id=", meter_id)
+            self.timestamp = decoded.timestamp
+            for obis, value, unit in decoded.values:
+                self.apply_value(obis, value, unit)
+            if config['oled_enable'] and self is meters[0]:
+                oled_show(decoded.header, self.values)
+            led.off()
+        if decoded.crc_ok is not False:
+            self.count_telegram("ok" if decoded.ok else "malformed")
+        return True
+
+    async def run_handoff(self):
+        # Take over the telegrams decoded on core 1, in dual-core mode
+        flag = ThreadSafeFlag()
+        self.handoff.flag = flag
+        while True:
+            decoded = self.handoff.take()
+            if decoded is None:
+                await flag.wait()
+            elif self.apply(decoded):
+                self.finish_telegram()
+            else:
+                registry.render()
 
-def remove_http_client(cl):
-    print("### Remove http client")
-    http_clients.remove(cl)
-    print("### connected clients: %d" % len(http_clients))
-    poller.unregister(cl)
-    cl.close()
-    
-def send_http_header(cl, code, headers=[]):
-    code2str = {
-        200: 'OK',
-        303: 'See Other',
-        404: 'NOT FOUND',
-        }
-    cl.write('HTTP/1.0 %d %s\r\n' % (code, code2str[code]))
-    #headers.append('Connection: close')
-    for header in headers:
-        cl.write(header)
-        cl.write('\r\n')
-    cl.write('\r\n')
+# Milliseconds core 1 sleeps for when no UART had any data
+CORE1_IDLE_MS = 5
+
+def core1_loop():
+    # The thread on core 1 in dual-core mode, restarting the reading when it
+    # fails
+    while True:
+        try:
+            core1_read()
+        except Exception as e:
+            task_failed("core1", e)
+            sleep_ms(1000)
+
+def core1_read():
+    # Read the UARTs of all meters in turn. The telegrams are framed and
+    # decoded here and handed over to core 0.
+    while True:
+        idle = True
+        for meter in meters:
+            framer = meter.framer
+            n = meter.uart.readinto(framer.free())
+            uart_pace(meter.uart, n)
+            if n:
+                idle = False
+                meter.reads += 1
+                framer.received(n)
+                framer.process()
+        if idle:
+            sleep_ms(CORE1_IDLE_MS)
+
+# The raw relay carries the data of the first meter only, the streams of
+# two meters can not be told apart once mixed
+meters = []
+for name, uart_no, prefix in meter_configs:
+    meters.append(Meter(name, uart_no, prefix, raw_relay if len(meters) == 0 else None))
+
+# The last telegrams worth of power, current and voltage values, for
+# /history
+history = History((power, current, voltage), config['history_size'])
+
+# Energy, power, current and voltage logged to flash, for /log
+data_log = None
+if config['log_enable']:
+    data_log = DataLog(ROOT, (energy, power, current, voltage),
+                       config['log_segment_size'] * 1024, config['log_segments'],
+                       config['log_interval'], config['log_flush_seconds'])
+
+# The history and the data log get one row a second at most, of the values
+# of all meters, and their time must never go back. A telegram with a meter
+# time not after that of the last row, as of a meter with its clock behind
+# that of the other, is recorded one second after it, once a second passed.
+history_ts = None
+history_ticks = 0
+
+def record_history(ts):
+    global history_ts, history_ticks
+    now = ticks_ms()
+    if history_ts is not None and ts <= history_ts:
+        if ticks_diff(now, history_ticks) < 1000:
+            return
+        ts = history_ts + 1
+    history_ts = ts
+    history_ticks = now
+    history.record(ts)
+    if data_log is not None:
+        data_log.record(ts)
+
+# The series of a meter pushed to InfluxDB for every telegram of it
+influx = None
+if config['influx_enable'] and len(config['influx_host']) > 0:
+    influx = InfluxPush(config['influx_host'], config['influx_port'], config['influx_path'],
+                        config['influx_token'], config['influx_batch'],
+                        config['influx_interval'], config['influx_queue_size'])
+
+# Metrics of the exporter itself. On the hot paths only integers are
+# counted, in microseconds for durations, which are copied into the metrics
+# at scrape time.
+decode_us = 0
+decode_last_us = 0
+decode_max_us = 0
+loop_lag_us = 0
+loop_stall_us = 0
+gc_collections = 0
+wifi_reconnects = 0
+
+self_decode_seconds = Metric("p1_exporter_decode_seconds_total", Metric.TYPE_COUNTER)
+self_decode_seconds.set_help("Time spent decoding telegrams")
+registry.register(self_decode_seconds, SECONDS_FMT)
+
+self_decode_last = Metric("p1_exporter_decode_last_seconds", Metric.TYPE_GAUGE)
+self_decode_last.set_help("Time it took to decode the last telegram")
+registry.register(self_decode_last, SECONDS_FMT)
+
+self_decode_max = Metric("p1_exporter_decode_max_seconds", Metric.TYPE_GAUGE)
+self_decode_max.set_help("Longest time it took to decode a telegram")
+registry.register(self_decode_max, SECONDS_FMT)
+
+self_uart_bytes = Metric("p1_exporter_uart_bytes_total", Metric.TYPE_COUNTER, METER_LABELS)
+self_uart_bytes.set_help("Bytes received on the UART")
+registry.register(self_uart_bytes, INT_FMT)
+
+self_uart_reads = Metric("p1_exporter_uart_reads_total", Metric.TYPE_COUNTER, METER_LABELS)
+self_uart_reads.set_help("Chunks of data read from the UART")
+registry.register(self_uart_reads, INT_FMT)
+
+self_loop_lag = Metric("p1_exporter_loop_lag_seconds", Metric.TYPE_GAUGE)
+self_loop_lag.set_help("How late the event loop was at its last check")
+registry.register(self_loop_lag, SECONDS_FMT)
+
+self_loop_stall = Metric("p1_exporter_loop_max_stall_seconds", Metric.TYPE_GAUGE)
+self_loop_stall.set_help("Longest the event loop was late since the previous scrape")
+registry.register(self_loop_stall, SECONDS_FMT)
+
+self_http_requests = Metric("p1_exporter_http_requests_total", Metric.TYPE_COUNTER, ("route"))
+self_http_requests.set_help("HTTP requests by route")
+registry.register(self_http_requests, INT_FMT)
+
+self_http_seconds = Metric("p1_exporter_http_request_seconds_total", Metric.TYPE_COUNTER, ("route"))
+self_http_seconds.set_help("Time spent handling HTTP requests by route")
+registry.register(self_http_seconds, SECONDS_FMT)
+
+self_clients = Metric("p1_exporter_clients", Metric.TYPE_GAUGE, ("type"))
+self_clients.set_help("Connected HTTP clients, clients waiting for a telegram and raw clients")
+registry.register(self_clients, INT_FMT)
+
+self_raw_bytes = Metric("p1_exporter_raw_bytes_total", Metric.TYPE_COUNTER, ("result",))
+self_raw_bytes.set_help("Bytes sent to and dropped for the raw clients")
+registry.register(self_raw_bytes, INT_FMT)
+
+self_raw_overflows = Metric("p1_exporter_raw_overflows_total", Metric.TYPE_COUNTER)
+self_raw_overflows.set_help("Times the queue of a raw client overflowed")
+registry.register(self_raw_overflows, INT_FMT)
+
+self_raw_disconnects = Metric("p1_exporter_raw_disconnects_total", Metric.TYPE_COUNTER)
+self_raw_disconnects.set_help("Raw clients gone or disconnected")
+registry.register(self_raw_disconnects, INT_FMT)
+
+self_gc_collections = Metric("p1_exporter_gc_collections_total", Metric.TYPE_COUNTER)
+self_gc_collections.set_help("Garbage collections seen by the event loop check")
+registry.register(self_gc_collections, INT_FMT)
+
+self_mem_free = Metric("p1_exporter_mem_free_bytes", Metric.TYPE_GAUGE)
+self_mem_free.set_help("Free heap memory")
+registry.register(self_mem_free, INT_FMT)
+
+self_wifi_reconnects = Metric("p1_exporter_wifi_reconnects_total", Metric.TYPE_COUNTER)
+self_wifi_reconnects.set_help("WiFi reconnects after losing the connection")
+registry.register(self_wifi_reconnects, INT_FMT)
+
+self_watchdog_feeds = Metric("p1_exporter_watchdog_feeds_total", Metric.TYPE_COUNTER)
+self_watchdog_feeds.set_help("Times the watchdog was fed")
+registry.register(self_watchdog_feeds, INT_FMT)
+
+self_influx_writes = Metric("p1_exporter_influx_writes_total", Metric.TYPE_COUNTER, ("result"))
+self_influx_writes.set_help("InfluxDB writes by result")
+self_influx_dropped = Metric("p1_exporter_influx_dropped_total", Metric.TYPE_COUNTER)
+self_influx_dropped.set_help("Telegrams dropped from the full InfluxDB queue")
+self_influx_queued = Metric("p1_exporter_influx_queued_bytes", Metric.TYPE_GAUGE)
+self_influx_queued.set_help("Line protocol waiting to be written to InfluxDB")
+if influx is not None:
+    registry.register(self_influx_writes, INT_FMT)
+    registry.register(self_influx_dropped, INT_FMT)
+    registry.register(self_influx_queued, INT_FMT)
+
+self_task_restarts = Metric("p1_exporter_task_restarts_total", Metric.TYPE_COUNTER, ("task",))
+self_task_restarts.set_help("Restarts of tasks that failed")
+registry.register(self_task_restarts, INT_FMT)
+
+self_handoff_skipped = Metric("p1_exporter_handoff_skipped_total", Metric.TYPE_COUNTER, METER_LABELS)
+self_handoff_skipped.set_help("Telegrams decoded on core 1 that core 0 did not take in time")
+if config['dual_core']:
+    registry.register(self_handoff_skipped, INT_FMT)
+
+def update_self_metrics():
+    global loop_stall_us
+    self_decode_seconds.set_value(decode_us / 1000000)
+    self_decode_last.set_value(decode_last_us / 1000000)
+    self_decode_max.set_value(decode_max_us / 1000000)
+    for meter in meters:
+        self_uart_bytes.set_value(meter.framer.bytes, meter.labels)
+        self_uart_reads.set_value(meter.reads, meter.labels)
+        if meter.handoff is not None:
+            meter.update_dropped()
+            self_handoff_skipped.set_value(meter.handoff.skipped, meter.labels)
+    self_loop_lag.set_value(loop_lag_us / 1000000)
+    self_loop_stall.set_value(loop_stall_us / 1000000)
+    loop_stall_us = 0
+    for path, stats in http_server.stats.items():
+        route = "other" if path is None else path
+        self_http_requests.set_value(stats[0], route)
+        self_http_seconds.set_value(stats[1] / 1000000, route)
+    self_clients.set_value(http_server.connections, "http")
+    self_clients.set_value(len(http_clients), "waiting")
+    self_clients.set_value(len(raw_relay.clients), "raw")
+    self_clients.set_value(event_stream.clients, "stream")
+    sent, dropped, overflows = raw_relay.totals()
+    self_raw_bytes.set_value(sent, "sent")
+    self_raw_bytes.set_value(dropped, "dropped")
+    self_raw_overflows.set_value(overflows)
+    self_raw_disconnects.set_value(raw_relay.disconnected)
+    self_gc_collections.set_value(gc_collections)
+    self_mem_free.set_value(mem_free())
+    self_wifi_reconnects.set_value(wifi_reconnects)
+    self_watchdog_feeds.set_value(watchdog_feeds)
+    for name, restarts in task_restarts.items():
+        self_task_restarts.set_value(restarts, name)
+    if influx is not None:
+        self_influx_writes.set_value(influx.writes_ok, "ok")
+        self_influx_writes.set_value(influx.writes_rejected, "rejected")
+        self_influx_writes.set_value(influx.writes_failed, "failed")
+        self_influx_dropped.set_value(influx.dropped)
+        self_influx_queued.set_value(influx.queued)
+    if mqtt is not None:
+        self_mqtt_messages.set_value(mqtt.messages)
+        self_mqtt_skipped.set_value(mqtt.skipped)
+        self_mqtt_connects.set_value(mqtt.connects)
+
+# The values are published to MQTT as they are decoded, with the power and
+# current deadbands in the units of the telegram
+mqtt = None
+if config['mqtt_enable'] and len(config['mqtt_host']) > 0:
+    mqtt_deadbands = {}
+    for meter in meters:
+        for obis, obis_code in meter.obis_table.codes.items():
+            key = obis if meter.key_prefix is None else meter.key_prefix + obis
+            if obis_code.metric is power:
+                mqtt_deadbands[key] = config['mqtt_deadband_power'] / 1000
+            elif obis_code.metric is current:
+                mqtt_deadbands[key] = config['mqtt_deadband_current'] / 1000
+    mqtt = MqttPublish(config['mqtt_host'], config['mqtt_port'],
+                       'p1exporter-' + ubinascii.hexlify(network.WLAN(network.STA_IF).config('mac')).decode(),
+                       config['mqtt_topic'], config['mqtt_user'], config['mqtt_password'],
+                       config['mqtt_format'], config['mqtt_retain'], config['mqtt_changed_only'],
+                       mqtt_deadbands, config['mqtt_interval'])
+
+self_mqtt_messages = Metric("p1_exporter_mqtt_messages_total", Metric.TYPE_COUNTER)
+self_mqtt_messages.set_help("MQTT messages published")
+self_mqtt_skipped = Metric("p1_exporter_mqtt_skipped_total", Metric.TYPE_COUNTER)
+self_mqtt_skipped.set_help("Values not published for being unchanged or within the deadband")
+self_mqtt_connects = Metric("p1_exporter_mqtt_connects_total", Metric.TYPE_COUNTER)
+self_mqtt_connects.set_help("Connections made to the MQTT broker")
+if mqtt is not None:
+    registry.register(self_mqtt_messages, INT_FMT)
+    registry.register(self_mqtt_skipped, INT_FMT)
+    registry.register(self_mqtt_connects, INT_FMT)
 
 class HtmlTopNav:
     def __init__(self, title):
@@ -626,12 +1494,12 @@ class HtmlTopNav:
     def setTitle(self, title):
         self.title = title
 
-    def render(self, cl):
-        cl.write('<div class="topnav">\n')
+    def render(self, page):
+        page.add('<div class="topnav">\n')
         for item in self.items:
-            cl.write('  <a %s href="%s">%s</a>\n' % ('class="active"' if item['text'] == self.is_active else '', item['link'], item['text']))
-        cl.write('<span class="title">%s</span>\n' % self.title)
-        cl.write('</div>\n')
+            page.add('  <a %s href="%s">%s</a>\n' % ('class="active"' if item['text'] == self.is_active else '', item['link'], item['text']))
+        page.add('<span class="title">%s</span>\n' % self.title)
+        page.add('</div>\n')
 
 top_nav = HtmlTopNav('P1 Exporter')
 top_nav.addMenuItem('Home', '/')
@@ -640,450 +1508,410 @@ top_nav.addMenuItem('Metrics', '/metrics')
 #top_nav.addMenuItem('About', '/about.html')
 top_nav.setActive('Home')
 
-def send_html_header(cl, code, headers):
-    send_http_header(cl, code, headers)
-    cl.write('<html>\n')
-    cl.write('<head>\n')
-    cl.write('  <title>P1 Exporter</title>\n')
-    cl.write('  <link rel="icon" type="image/x-icon" href="/favicon.ico">\n')
-    cl.write('  <link rel="stylesheet" href="index.css">')
-    cl.write('</head>\n')
-    cl.write('<body>\n')
-    top_nav.render(cl)
-
-def send_html_trailer(cl):
-    cl.write('</body></html>\r\n')
-    cl.close()
-
-def reply_with_error(cl, request, code):
-    send_http_header(cl, code, ['Content-type: text/plain'])
-    cl.write(request)
-    cl.close()
-
-def reply_with_index_page(cl):
-    top_nav.setActive('Home')
-    send_html_header(cl, 200, ['Content-type: text/html;charset=utf-8'])
-    #cl.write('<h1>P1 Exporter</h1>\n')
-    
-    cl.write('<table id="meter">\n')
-    cl.write('<tr><th>Beskrivning</th><th>Värde</th><th>Tidsstämpel</th></tr>\n')
-    
-    for obis in obis_display_order:
-        obis_spec = obis_map[obis]
-        value = '-'
-        ts = '-'
-        if "metric" in obis_spec:
-            metric = obis_spec["metric"]
-            value = metric.value(obis_spec["labels"])
-            if value is None:
-                value = '-'
-            epoch_ms = metric.timestamp(obis_spec["labels"])
-            if epoch_ms is not None:
-                utc = time.gmtime(int(epoch_ms / 1000))
-                ts = '%d-%02d-%02d %02d:%02d:%02dZ' % utc[0:6]
-        cl.write('<tr><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (obis_spec["name"], value, ts))
-    cl.write('</table>\n')
-    
-    send_html_trailer(cl)
+# The pages are compiled into templates once, only the values are filled in
+# for every request
+def html_header(page, active):
+    top_nav.setActive(active)
+    page.add('<html>\n')
+    page.add('<head>\n')
+    page.add('  <title>P1 Exporter</title>\n')
+    page.add('  <link rel="icon" type="image/x-icon" href="/favicon.ico">\n')
+    page.add('  <link rel="stylesheet" href="index.css">')
+    page.add('</head>\n')
+    page.add('<body>\n')
+    top_nav.render(page)
+
+def html_trailer(page):
+    page.add('</body></html>\r\n')
+
+def reply_with_error(request, cl, code):
+    cl.start(code, ['Content-type: text/plain'])
+    cl.write(request.request_line)
+
+def obis_value_cell(obis_code):
+    metric = obis_code.metric
+    labels = obis_code.labels
+    def cell():
+        value = metric.value(labels)
+        if value is None:
+            return '-'
+        return str(value)
+    return cell
+
+# All values of a telegram have the same time, so the last one formatted is
+# kept
+last_ts = [None, '-']
+
+def obis_ts_cell(obis_code):
+    metric = obis_code.metric
+    labels = obis_code.labels
+    def cell():
+        epoch_ms = metric.timestamp(labels)
+        if epoch_ms is None:
+            return '-'
+        if epoch_ms != last_ts[0]:
+            utc = time.gmtime(int(epoch_ms / 1000))
+            last_ts[0] = epoch_ms
+            last_ts[1] = '%d-%02d-%02d %02d:%02d:%02dZ' % utc[0:6]
+        return last_ts[1]
+    return cell
+
+def compile_index_page():
+    page = Template()
+    html_header(page, 'Home')
+    #page.add('<h1>P1 Exporter</h1>\n')
+
+    page.add('<table id="meter">\n')
+    page.add('<tr><th>Beskrivning</th><th>Värde</th><th>Tidsstämpel</th></tr>\n')
+
+    for meter in meters:
+        if len(meters) > 1:
+            page.add('<tr><th colspan="3">%s</th></tr>\n' % escape(meter.name))
+        obis_table = meter.obis_table
+        for obis in obis_table.order:
+            obis_code = obis_table.codes[obis]
+            page.add('<tr><td>%s</td><td>' % escape(obis_code.name))
+            if obis_code.metric is not None:
+                page.cell(obis_value_cell(obis_code))
+                page.add('</td><td>')
+                page.cell(obis_ts_cell(obis_code))
+            else:
+                page.add('-</td><td>-')
+            page.add('</td></tr>\n')
+    page.add('</table>\n')
 
-#def reply_with_favicon(cl):
-#    print("### Send favicon")
-#    if 'favicon.ico' in uos.listdir('/'):
-#        send_http_header(cl, 200, ['Content-type: image/x-icon'])
-#        with open('/favicon.ico', 'rb') as f:
-#            cl.sendall(f.read())
-#    else:
-#        send_http_header(404)
-#    cl.close()
-#    print('### Done sending favicon')
-    
-def reply_with_config_page(cl):
-    top_nav.setActive('Config')
-    send_html_header(cl, 200, ['Content-type: text/html;charset=utf-8'])
-    #cl.write('<h1>P1 Exporter Configuration</h1>\n')
-    cl.write('<form action="/save_config">\n')
+    html_trailer(page)
+    return page
+
+def config_checkbox_cell(name):
+    return lambda: 'checked' if config[name] else ''
+
+def config_radio_cell(name, value):
+    return lambda: 'checked' if value == str(config[name]) else ''
+
+def config_value_cell(name):
+    return lambda: escape(str(config[name]))
+
+def compile_config_page():
+    page = Template()
+    html_header(page, 'Config')
+    #page.add('<h1>P1 Exporter Configuration</h1>\n')
+    page.add('<form action="/save_config">\n')
     prev_fieldset = None
     for input in CONFIG_VARS:
+        name = input['name']
         if input['fieldset'] != prev_fieldset:
             if prev_fieldset is not None:
-                cl.write('</fieldset>\n')
-            cl.write('<fieldset>\n')
-            cl.write('<legend>%s</legend>\n' % input['fieldset'])
+                page.add('</fieldset>\n')
+            page.add('<fieldset>\n')
+            page.add('<legend>%s</legend>\n' % input['fieldset'])
             prev_fieldset = input['fieldset']
         if input['type'] == 'checkbox':
-            cl.write('<input name="%s" value="" type="hidden"/>\n' % (input['name']))
-            cl.write('<input id="%s" name="%s" type="checkbox" %s/>\n' % (input['name'], input['name'], 'checked' if config[input['name']] else ''))
-            cl.write('<label for="%s">%s</label>\n' % (input['name'], input['text']))
+            page.add('<input name="%s" value="" type="hidden"/>\n' % (name))
+            page.add('<input id="%s" name="%s" type="checkbox" ' % (name, name))
+            page.cell(config_checkbox_cell(name))
+            page.add('/>\n')
+            page.add('<label for="%s">%s</label>\n' % (name, input['text']))
         elif input['type'] == 'radio':
             for sel in input['selections']:
-                cl.write('<input id="%s" name="%s" value="%s" type="radio" %s/>\n'
-                         % (sel['id'], input['name'], sel['value'], 'checked' if sel['value'] == str(config[input['name']]) else ''))
-                cl.write('<label for="%s">%s</label>\n' % (sel['id'], sel['text']))
+                page.add('<input id="%s" name="%s" value="%s" type="radio" '
+                         % (sel['id'], name, sel['value']))
+                page.cell(config_radio_cell(name, sel['value']))
+                page.add('/>\n')
+                page.add('<label for="%s">%s</label>\n' % (sel['id'], sel['text']))
         elif input['type'] == 'number':
-            cl.write('<label for="%s">%s:</label><br/>\n' % (input['name'], input['text']))
-            cl.write('<input id="%s" name="%s" value="%s" type="number" min="%d" max="%d"/>\n'
-                     % (input['name'], input['name'], config[input['name']], input['min'], input['max']))
+            page.add('<label for="%s">%s:</label><br/>\n' % (name, input['text']))
+            page.add('<input id="%s" name="%s" value="' % (name, name))
+            page.cell(config_value_cell(name))
+            page.add('" type="number" min="%d" max="%d"/>\n' % (input['min'], input['max']))
         elif input['type'] in {'text', 'password'}:
-            cl.write('<label for="%s">%s:</label><br/>\n' % (input['name'], input['text']))
-            cl.write('<input id="%s" name="%s" value="%s" type="%s"/>\n'
-                     % (input['name'], input['name'], config[input['name']], input['type']))
-        cl.write('<br/>')
-    cl.write('</fieldset>\n')
-    cl.write('<input type="reset" value="Reset"><input type="submit" value="Save">\n')
-    cl.write('</form>\n')
-    send_html_trailer(cl)
-
-def unescape_form_value(val):
-    unescaped = ''
-    val = val.replace('+', ' ')
-    begin = 0
-    while True:
-        pos = val.find('%', begin)
-        if pos == -1:
-            break
-        unescaped += val[begin:pos] + chr(int(val[pos+1:pos+3], 16))
-        begin = pos + 3
-    unescaped += val[begin:]
-    return unescaped
-    
-def reply_with_save_config(cl, request):
-    req = request.decode()
-    print(req)    
-    send_http_header(cl, 303, ['Location: /', 'Retry-After: 20'])
-    
-    begin = req.find('?') + 1
-    end = req.find(' ', begin)
-    params_str = req[begin:end]
-    begin = 0
-    params = dict()
-    while True:
-        end = params_str.find('&', begin)
-        if end == -1:
-            param = params_str[begin:]
-        else:
-            param = params_str[begin:end]
-        equals = param.find('=')
-        pname = param[0:equals]
-        pvalue = param[equals+1:]
-        print(pname, pvalue)
-        params[pname] = unescape_form_value(pvalue)
-        if end == -1:
-            break
-        begin = end + 1
+            page.add('<label for="%s">%s:</label><br/>\n' % (name, input['text']))
+            page.add('<input id="%s" name="%s" value="' % (name, name))
+            page.cell(config_value_cell(name))
+            page.add('" type="%s"/>\n' % input['type'])
+        page.add('<br/>')
+    page.add('</fieldset>\n')
+    page.add('<input type="reset" value="Reset"><input type="submit" value="Save">\n')
+    page.add('</form>\n')
+    html_trailer(page)
+    return page
+
+index_page = compile_index_page()
+config_page = compile_config_page()
+
+def reply_with_index_page(request, cl):
+    cl.start(200, ['Content-type: text/html;charset=utf-8'])
+    index_page.render(cl.write)
+
+#def reply_with_favicon(cl):
+#    print("### Send favicon")
+#    if 'favicon.ico' in uos.listdir('/'):
+#        send_http_header(cl, 200, ['Content-type: image/x-icon'])
+#        with open('/favicon.ico', 'rb') as f:
+#            cl.sendall(f.read())
+#    else:
+#        send_http_header(404)
+#    cl.close()
+#    print('### Done sending favicon')
     
+def reply_with_config_page(request, cl):
+    cl.start(200, ['Content-type: text/html;charset=utf-8'])
+    config_page.render(cl.write)
+
+def config_value(var, text):
+    # The value of a submitted form field, ValueError if it is not one the
+    # form allows
+    value = type(var['default'])(text)
+    if 'min' in var and not var['min'] <= value <= var['max']:
+        raise ValueError(var['name'])
+    if 'selections' in var and text not in [s['value'] for s in var['selections']]:
+        raise ValueError(var['name'])
+    return value
+
+async def reply_with_save_config(request, cl):
+    print(request.target)
+    params = request.query
+    values = dict()
     for input in CONFIG_VARS:
         if input['name'] in params:
-            config[input['name']] = type(input['default'])(params[input['name']])
+            try:
+                values[input['name']] = config_value(input, params[input['name']])
+            except ValueError:
+                # Nothing is saved unless every value is valid
+                cl.start(400, ['Content-type: text/plain'])
+                cl.write('Invalid %s\r\n' % input['name'])
+                return
+    cl.start(303, ['Location: /', 'Retry-After: 20'])
+    cl.keep_alive = False
+
+    config.update(values)
     print(config)
     save_config()
-    cl.close()
+    await cl.finish()
+    if data_log is not None:
+        data_log.flush()
     reboot()
 
-def send_openmetrics(cl):
-    cl.write(uptime.headers())
-    cl.write(uptime.value_rows())
-    cl.write("\n")
-    
-    cl.write(temperature.headers())
-    cl.write(temperature.value_rows())
-    cl.write("\n")
-    
-    value_rows = energy.value_rows()
-    if len(value_rows) > 0:
-        cl.write(energy.headers())
-        cl.write(value_rows)
-        cl.write("\n")
-    
-    value_rows = power.value_rows()
-    if len(value_rows) > 0:
-        cl.write(power.headers())
-        cl.write(value_rows)
-        cl.write("\n")
-    
-    value_rows = voltage.value_rows()
-    if len(value_rows) > 0:
-        cl.write(voltage.headers())
-        cl.write(value_rows)
-        cl.write("\n")
-    
-    value_rows = current.value_rows()
-    if len(value_rows) > 0:
-        cl.write(current.headers())
-        cl.write(value_rows)
-        cl.write("\n")
-
-def reply_with_openmetrics(cl, wait):
-    send_http_header(cl, 200, ['Content-type: text/plain'])
-    if wait:
-        add_http_client(cl)
-    else:
-        send_openmetrics(cl)
-        cl.close()
-
-def reply_with_file(cl, filename, content_type):
-    print("### Send file:", filename)
-    if filename in uos.listdir('/'):
-        send_http_header(cl, 200, ['Content-type: %s' % content_type])
-        with open('/%s' % filename, 'rb') as f:
-            cl.sendall(f.read())
-    else:
-        send_http_header(404)
-    cl.close()
-    print('### Done sending file')
+def read_temperature():
+    reading = sensor_temp.read_u16() * conversion_factor
+    return 27 - (reading - 0.706)/0.001721
 
-def process_http_request():
+def update_openmetrics():
+    uptime.set_value(ticks_diff(ticks_ms(), starttime)/1000)
+    temperature.set_value(read_temperature())
+    update_self_metrics()
+    registry.render()
+
+# Set for every decoded telegram to wake up the /waitmetrics clients
+telegram_event = asyncio.Event()
+
+def send_waiting_clients():
+    telegram_event.set()
+    telegram_event.clear()
+
+def reply_with_openmetrics(request, cl):
+    update_openmetrics()
+    cl.send_raw(registry.response())
+    reset_aggregates()
+
+async def reply_with_waitmetrics(request, cl):
+    http_clients.append(cl)
+    print("### connected clients: %d" % len(http_clients))
     try:
-        cl, addr = s.accept()
-        #cl.setblocking(True)
-        cl.settimeout(2.5)
-        print('### Http client connected from', addr)
-        wdt.feed()
-        request = cl.recv(1024)
-        wdt.feed()
-        print(request)
-        if len(request) == 0:
-            cl.close()
-            return
-    
-        uptime.set_value(time.ticks_diff(time.ticks_ms(), starttime)/1000)
-        
-        reading = sensor_temp.read_u16() * conversion_factor 
-        temp = 27 - (reading - 0.706)/0.001721
-        print(temp)
-        temperature.set_value(temp)
-        
-        if request.startswith('GET / '):
-            reply_with_index_page(cl)
-        elif request.startswith('GET /favicon.ico '):
-            reply_with_file(cl, 'favicon.ico', 'image/x-icon')
-        elif request.startswith('GET /config '):
-            reply_with_config_page(cl)
-        elif request.startswith('GET /save_config?'):
-            reply_with_save_config(cl, request)
-        elif request.startswith('GET /metrics '):
-            reply_with_openmetrics(cl, False)
-        elif request.startswith('GET /waitmetrics '):
-            reply_with_openmetrics(cl, True)
-        elif request.startswith('GET /index.css '):
-            reply_with_file(cl, 'index.css', 'text/css')
-        else:
-            #print(request)
-            reply_with_error(cl, request, 404)
-    except OSError as e:
-        print('OSError:', e)
-        cl.close()
-    print('### Http connection done')
-
-
-# Enable pull-up on the UART rx pin
-#Pin(config['uart_rx_gpio'], Pin.IN, Pin.PULL_UP)
-
-# Set up the UART for receiving P1 data
-uart1 = UART(
-    config['uart_no'],
-    baudrate=config['uart_baudrate'],
-    bits=config['uart_bits'],
-    parity=None,
-    stop=1,
-    tx=Pin(config['uart_tx_gpio']),
-    rx=Pin(config['uart_rx_gpio']),
-    rxbuf=1024,
-    invert=UART.INV_RX)
-#uart1.write('\nhello\n')
-poller.register(uart1, select.POLLIN)
-
-values = dict()
-
-def oled_print_obis(obis, decimals, with_unit, x, y):
-    global values
+        await telegram_event.wait()
+    finally:
+        http_clients.remove(cl)
+        print("### connected clients: %d" % len(http_clients))
+    update_openmetrics()
+    cl.send_raw(registry.response())
+    reset_aggregates()
+
+async def reply_with_stream(request, cl):
+    # Server-Sent Events of every telegram, of the changed values only if
+    # the changed parameter is set
+    await event_stream.serve(cl, request.query.get('changed', '') not in ('', '0'))
+
+async def reply_with_history(request, cl):
+    # The history as CSV, of the series starting with the series parameter,
+    # from since in seconds, negative for relative to the newest row, and
+    # downsampled to step seconds if given
+    try:
+        since = int(request.query.get('since', '0'))
+        step = int(request.query.get('step', '0'))
+    except ValueError:
+        cl.start(400, ['Content-type: text/plain'])
+        cl.write('Invalid since or step\r\n')
+        return
+    cl.start(200, ['Content-type: text/csv'])
+    await history.stream(cl.send, request.query.get('series', ''), since, step)
+
+async def reply_with_log(request, cl):
+    # Everything in the data log from since in seconds, as CSV, for
+    # backfilling what was missed by the scrapes
+    if data_log is None:
+        reply_with_error(request, cl, 404)
+        return
+    try:
+        since = int(request.query.get('since', '0'))
+    except ValueError:
+        cl.start(400, ['Content-type: text/plain'])
+        cl.write('Invalid since\r\n')
+        return
+    cl.start(200, ['Content-type: text/csv'])
+    await data_log.stream(cl.send, since)
+
+# favicon.ico and index.css, read once
+file_cache = FileCache(ROOT)
+
+http_server = HttpServer(config['http_idle_timeout'], config['http_max_requests'])
+http_server.route('/', reply_with_index_page)
+http_server.route('/favicon.ico',
+                  lambda request, cl: file_cache.serve(request, cl, 'favicon.ico', 'image/x-icon'))
+http_server.route('/config', reply_with_config_page)
+http_server.route('/save_config', reply_with_save_config)
+http_server.route('/metrics', reply_with_openmetrics)
+http_server.route('/waitmetrics', reply_with_waitmetrics)
+http_server.route('/stream', reply_with_stream)
+http_server.route('/history', reply_with_history)
+http_server.route('/log', reply_with_log)
+http_server.route('/index.css',
+                  lambda request, cl: file_cache.serve(request, cl, 'index.css', 'text/css'))
+http_server.not_found = lambda request, cl: reply_with_error(request, cl, 404)
+
+
+def oled_print_obis(values, obis, decimals, with_unit, x, y):
     if obis in values:
-        val = values[obis]
-        txt = ("%." + str(decimals) + "f") % float(val["value"])
+        value, unit = values[obis]
+        txt = ("%." + str(decimals) + "f") % float(value)
         if with_unit:
-            txt += val["unit"]
+            txt += unit
     else:
         txt = "N/A"
     oled.text(txt, x, y)
 
 
-def oled_print_three_phase(measurement_code, decimals, row):
+def oled_print_three_phase(values, measurement_code, decimals, row):
     obis = "1-0:%02d.7.0" % (measurement_code)
-    oled_print_obis(obis, decimals, False, 0, row)
+    oled_print_obis(values, obis, decimals, False, 0, row)
     obis = "1-0:%02d.7.0" % (measurement_code + 20)
-    oled_print_obis(obis, decimals, False, 38, row)
+    oled_print_obis(values, obis, decimals, False, 38, row)
     obis = "1-0:%02d.7.0" % (measurement_code + 40)
-    oled_print_obis(obis, decimals, False, 76, row)
-    oled.text("%s" % (values[obis]["unit"]), 112, row)
+    oled_print_obis(values, obis, decimals, False, 76, row)
+    oled.text("%s" % (values[obis][1]), 112, row)
     
 
-def decode_p1_msg(msg):
-    global values
+# The OLED shows the first meter
+def oled_show(header, values):
+    manufacturer, speed, meter_id = header
+
+    # Clear screen
+    oled.fill(0)
     
-    #print(msg.decode())
-    line_re = re.compile("[\r\n]")
-    flag_re = re.compile("^(...)(.)(.*)$")
-    ts_re = re.compile(r"^(\d\d\d\d)(\d\d)(\d\d)(\d\d)(\d\d)(\d\d).$")
-
-    lines = line_re.split(msg.decode())
-    match = flag_re.match(lines[0])
-    if not match:
-        return
+    # Datum och tid
+    row = 0
+    row_inc = 8
     
-    led.on()
+    oled.text(manufacturer + meter_id, 0, row)
+    row += row_inc
     
-    manufacturer = match.group(1)
-    speed = match.group(2)
-    meter_id = match.group(3)
-    print("manufacturer=", manufacturer)
-    print("speed=", speed)
-    print("id=", meter_id)
+    obis = "0-0:1.0.0"
+    if obis in values:
+        oled.text("%s" % (values[obis][0]), 0, row)
+    else:
+        oled.text("N/A", 0, row)
+    row += row_inc
     
-    timestamp = None
-    for line in lines[1:]:
-        #print(line)
-        match = re.match("^([^(]+)\(([^*]+)(\*(.*))?\)$", line)
-        if match:
-            obis = match.group(1)
-            value = match.group(2)
-            unit = match.group(4)
-            if unit is None:
-                unit = ''
-                
-            if obis == "0-0:1.0.0":
-                match = ts_re.match("20" + value)
-                if match:
-                    the_time = tuple(int(el) for el in match.groups())
-                    timestamp = 1000 * (time.mktime(the_time + (0, 0)) - config['tz_offset'])
-                    print(timestamp / 1000)
-                    continue
-
-            obis_spec = None
-            if obis in obis_map:
-                obis_spec = obis_map[obis]
-                name = obis_spec['name']
-            else:
-                name = obis
-            print(name + ': ' + value + unit)
-            values[obis] = {
-                "value": value,
-                "unit": unit
-                }
-            if obis_spec is not None and "metric" in obis_spec:
-                metric = obis_spec["metric"]
-                labels = obis_spec["labels"]
-                #print(labels)
-                metric.set_value(value, labels, timestamp)
-
-    if config['oled_enable']:
-        # Clear screen
-        oled.fill(0)
-        
-        # Datum och tid
-        row = 0
-        row_inc = 8
-        
-        oled.text(manufacturer + meter_id, 0, row)
-        row += row_inc
-        
-        obis = "0-0:1.0.0"
-        if obis in values:
-            val = values[obis]
-            oled.text("%s" % (val["value"]), 0, row)
-        else:
-            oled.text("N/A", 0, row)
-        row += row_inc
-        
-        # Mätarställning Aktiv/Reaktiv Energi Uttag
-        oled_print_obis("1-0:1.8.0", 0, True, 0, row)
-        row += row_inc
-        oled_print_obis("1-0:3.8.0", 0, True, 0, row)
-        row += row_inc
-        
-        # Aktiv/Reaktiv Effekt Uttag, momentan trefaseffekt
-        oled_print_obis("1-0:1.7.0", 1, True, 0, row)
-        oled_print_obis("1-0:3.7.0", 1, True, 64, row)
-        row += row_inc
-
-        # Aktiv Effekt Uttag (L1, L2, L3)
-        oled_print_three_phase(21, 1, row)
-        row += row_inc
-        
-        # Fasström (L1, L2, L3)
-        oled_print_three_phase(31, 1, row)
-        row += row_inc
-
-        # Fasspänning (L1, L2, L3)
-        oled_print_three_phase(32, 0, row)
-        row += 12
-        
-        oled.show()
-
-    for cl in http_clients[:]:
-        try:
-            send_openmetrics(cl)
-        except OSError as e:
-            print(e)
-        remove_http_client(cl)
-
-    led.off()
-
-msg = None
-def uart_rx():
-    global msg
-    data = uart1.read()
-    print("### data=", data)
-    #uart1.write(data)
+    # Mätarställning Aktiv/Reaktiv Energi Uttag
+    oled_print_obis(values, "1-0:1.8.0", 0, True, 0, row)
+    row += row_inc
+    oled_print_obis(values, "1-0:3.8.0", 0, True, 0, row)
+    row += row_inc
+    
+    # Aktiv/Reaktiv Effekt Uttag, momentan trefaseffekt
+    oled_print_obis(values, "1-0:1.7.0", 1, True, 0, row)
+    oled_print_obis(values, "1-0:3.7.0", 1, True, 64, row)
+    row += row_inc
+
+    # Aktiv Effekt Uttag (L1, L2, L3)
+    oled_print_three_phase(values, 21, 1, row)
+    row += row_inc
+    
+    # Fasström (L1, L2, L3)
+    oled_print_three_phase(values, 31, 1, row)
+    row += row_inc
 
-    for cl in raw_clients[:]:
-        try:
-            cl.write(data)
-        except OSError as e:
-            remove_raw_client(cl)
-
-    while data is not None and len(data) > 0:
-        if msg is None:
-            pos = data.find(b'/')
-            if pos > -1:
-                data = data[pos+1:]
-                msg = b''
-            else:
-                data = ''
-        if msg is not None:
-            pos = data.find(b'!')
-            if pos > -1:
-                msg += data[0:pos]
-                #crc = data[pos+1:pos+5]
-                #print(msg.decode() + '\nCRC=' + crc.decode())
-                decode_p1_msg(msg)
-                msg = None
-                data = data[pos+1:]
-            else:
-                msg += data
-                data = ''
-                
+    # Fasspänning (L1, L2, L3)
+    oled_print_three_phase(values, 32, 0, row)
+    row += 12
+    
+    oled.show()
 
-while True:
-        events = poller.poll(1000)
-        wdt.feed()
+def decode_telegram(meter, mv):
+    global decode_us, decode_last_us, decode_max_us
+    start = ticks_us()
+    ok = meter.decode(mv)
+    elapsed = ticks_diff(ticks_us(), start)
+    decode_us += elapsed
+    decode_last_us = elapsed
+    if elapsed > decode_max_us:
+        decode_max_us = elapsed
+    return ok
+
+registry.render()
+
+async def wifi_supervisor_task():
+    global wifi_reconnects
+    while True:
+        feed_watchdog()
         if wlan.status() != 3:
-            wlan_setup()
-        for desc, event in events:
-            if desc == raw_server and event == select.POLLIN:
-                add_raw_client()
-            for cl in raw_clients[:]:
-                if desc == cl and event == select.POLLIN:
-                    data = cl.read(1)
-                    print("### Raw read: len=%d" % len(data))
-                    if len(data) == 0:
-                        remove_raw_client(cl)
-            for cl in http_clients[:]:
-                if desc == cl and event == select.POLLIN:
-                    data = cl.read(1)
-                    print("### Http read: len=%d" % len(data))
-                    if len(data) == 0:
-                        remove_http_client(cl)
-            if desc == s and event == select.POLLIN:
-                process_http_request()
-            if desc == uart1 and event == select.POLLIN:
-                uart_rx()
-
+            wifi_reconnects += 1
+            await wlan_setup(False)
+        await asyncio.sleep(1)
+
+# The event loop is checked at this interval, in seconds, for how late it is
+LOOP_CHECK_INTERVAL = 0.1
+
+async def loop_monitor_task():
+    # A task that is late waking up means something else held on to the
+    # event loop. A drop in allocated memory means a garbage collection.
+    global loop_lag_us, loop_stall_us, gc_collections
+    interval_us = int(LOOP_CHECK_INTERVAL * 1000000)
+    allocated = mem_alloc()
+    while True:
+        start = ticks_us()
+        await asyncio.sleep(LOOP_CHECK_INTERVAL)
+        loop_lag_us = ticks_diff(ticks_us(), start) - interval_us
+        if loop_lag_us > loop_stall_us:
+            loop_stall_us = loop_lag_us
+        prev = allocated
+        allocated = mem_alloc()
+        if allocated < prev:
+            gc_collections += 1
+
+async def main(addr='0.0.0.0', http_port=80, raw_port=1234):
+    setup_hardware()
+    await wlan_setup()
+
+    await http_server.start(addr, http_port)
+    print('Http socket listening on port', http_port)
+    await asyncio.start_server(raw_relay.serve, addr, raw_port)
+    print('Raw socket listening on port', raw_port)
+
+    if config['dual_core']:
+        for meter in meters:
+            asyncio.create_task(supervise("meter_" + meter.name, meter.run_handoff))
+        # Counted from here, as core 1 must not add to the dict
+        task_restarts["core1"] = 0
+        _thread.start_new_thread(core1_loop, ())
+    else:
+        for meter in meters:
+            asyncio.create_task(supervise("meter_" + meter.name, meter.run))
+    asyncio.create_task(supervise("loop_monitor", loop_monitor_task))
+    if influx is not None:
+        asyncio.create_task(supervise("influx", influx.run))
+    if mqtt is not None:
+        asyncio.create_task(supervise("mqtt", mqtt.run))
+    await supervise("wifi", wifi_supervisor_task)
+
+if __name__ == '__main__':
+    asyncio.run(main())
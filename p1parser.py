@@ -0,0 +1,190 @@
+# Streaming parser for P1 (DSMR) telegrams
+#
+# The parser is fed raw bytes in chunks of any size and calls back for the
+# telegram header and for every OBIS data line it recognises. Lines are
+# found and taken apart with find(), so the bytes are scanned in C rather
+# than one at a time in Python. A complete line is parsed where it is, only
+# a line split over two chunks is collected into a fixed size line buffer,
+# so apart from the strings handed to the callbacks nothing is allocated per
+# line. The module has no dependencies and runs under both MicroPython and
+# CPython.
+#
+# A telegram looks like this:
+#
+#   /ELL5\253833635_A
+#
+#   0-0:1.0.0(210217184019W)
+#   1-0:1.8.0(00006678.394*kWh)
+#   ...
+#   !7945
+
+LINE_MAX = 128
+
+_SLASH = 0x2f
+_EXCL = 0x21
+_RPAR = 0x29
+
+
+class P1Parser:
+    def __init__(self, on_value, on_header=None, on_end=None, line_max=LINE_MAX):
+        # on_value(obis, value, unit) is called for every data line
+        # on_header(manufacturer, speed, ident) is called for the '/' line
+        # on_end() is called when the '!' ending the telegram is seen
+        self.on_value = on_value
+        self.on_header = on_header
+        self.on_end = on_end
+        self._line = bytearray(line_max)
+        self._active = False
+        self.errors = 0
+        # Length of the part of a line held in the line buffer, more than
+        # its size if the line did not fit
+        self._len = 0
+
+    def reset(self):
+        self._active = False
+        self._len = 0
+
+    def feed(self, data, start=0, end=None):
+        # Parse data[start:end]. data must have find(), a memoryview is
+        # copied first.
+        if type(data) == memoryview:
+            data = bytes(data[start:end])
+            start = 0
+            end = None
+        if end is None:
+            end = len(data)
+        find = data.find
+        pos = start
+        while pos < end:
+            # Lines end at a CR, an LF or both
+            eol = find(b'\n', pos, end)
+            cr = find(b'\r', pos, end if eol < 0 else eol)
+            if cr >= 0:
+                # The LF following a CR ends nothing more
+                next_pos = eol + 1 if cr == eol - 1 else cr + 1
+                eol = cr
+            elif eol < 0:
+                self._collect(data, pos, end)
+                break
+            else:
+                next_pos = eol + 1
+            if self._len > 0:
+                # The end of a line started in an earlier chunk
+                self._collect(data, pos, eol)
+                n = self._len
+                self._len = 0
+                if n > len(self._line):
+                    # Line overflow or the tail after '!'
+                    if self._active:
+                        self.errors += 1
+                else:
+                    self._parse_line(self._line, 0, n)
+            else:
+                self._parse_line(data, pos, eol)
+            pos = next_pos
+
+    def _collect(self, data, start, end):
+        # Add data[start:end] to the line in the line buffer
+        n = self._len
+        length = end - start
+        if n + length > len(self._line):
+            self._len = len(self._line) + 1
+            return
+        self._line[n:n+length] = data[start:end]
+        self._len = n + length
+
+    def _parse_line(self, buf, start, end):
+        # Parse the line buf[start:end]
+        if end <= start:
+            return
+        first = buf[start]
+        if first == _SLASH:
+            # A header always starts a new telegram, even if the end of the
+            # previous one was lost
+            self._active = True
+            self.errors = 0
+        elif first == _EXCL:
+            if self._active:
+                self._active = False
+                if self.on_end is not None:
+                    self.on_end()
+            # The CRC following the '!' is skipped
+            return
+        if not self._active:
+            return
+        if end - start > len(self._line):
+            self.errors += 1
+            return
+        try:
+            if first == _SLASH:
+                if end - start < 5:
+                    self.errors += 1
+                elif self.on_header is not None:
+                    self.on_header(buf[start+1:start+4].decode('ascii'),
+                                   buf[start+4:start+5].decode('ascii'),
+                                   buf[start+5:end].decode('ascii'))
+                return
+            obis_end = buf.find(b'(', start, end)
+            if obis_end <= start or buf[end-1] != _RPAR:
+                self.errors += 1
+                return
+            # Only the last parenthesis group holds the value
+            value_start = buf.rfind(b'(', obis_end, end) + 1
+            value_end = end - 1
+            unit = ''
+            star = buf.rfind(b'*', value_start, value_end)
+            if star >= 0:
+                unit = buf[star+1:value_end].decode('ascii')
+                value_end = star
+            if value_end > value_start:
+                self.on_value(buf[start:obis_end].decode('ascii'),
+                              buf[value_start:value_end].decode('ascii'), unit)
+        except ValueError:
+            # Undecodable bytes on the line
+            self.errors += 1
+
+
+def _days_from_civil(year, month, day):
+    # Number of days since 1970-01-01 in the proleptic Gregorian calendar
+    if month <= 2:
+        year -= 1
+        month += 9
+    else:
+        month -= 3
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * month + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def timestamp_seconds(value):
+    # Convert a YYMMDDhhmmssX timestamp value to seconds since the epoch.
+    # No time zone adjustment is made. None is returned if the value is
+    # malformed.
+    if len(value) < 12:
+        return None
+    try:
+        year = 2000 + int(value[0:2])
+        month = int(value[2:4])
+        day = int(value[4:6])
+        hour = int(value[6:8])
+        minute = int(value[8:10])
+        second = int(value[10:12])
+    except ValueError:
+        return None
+    days = _days_from_civil(year, month, day)
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+
+def json_number(value):
+    # Return a numeric value as a JSON number, without the leading zeros the
+    # values are padded with. None is returned if it is not a number.
+    try:
+        float(value)
+    except ValueError:
+        return None
+    value = value.lstrip('0')
+    if len(value) == 0 or value[0] == '.':
+        value = '0' + value
+    return value
@@ -0,0 +1,174 @@
+# Fan-out of the P1 data stream to the clients of the raw socket server
+#
+# Data is never written to a client socket from where it is received.
+# Instead it is copied into a bounded queue per client and each client has a
+# task of its own flushing the queue when the socket can take it. A slow
+# client thereby only delays itself. A client whose queue overflows loses the
+# queued data and is resynced at the start of the next telegram so it never
+# sees a telegram with a hole in it.
+#
+# In raw mode the data is relayed as it is read from the UART. In telegram
+# mode only complete telegrams are relayed, optionally only those with a
+# correct CRC, so a client never has to find the start of a telegram itself.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+QUEUE_SIZE = 4096
+TIMEOUT = 5
+MAX_OVERFLOWS = 10
+
+MODE_RAW = 'raw'
+MODE_TELEGRAM = 'telegram'
+MODE_VERIFIED = 'verified'
+
+_SLASH = b'/'
+_CRLF = b'\r\n'
+
+# The CRC digits and CR LF queued after a telegram
+_CRC_LINE = 6
+
+
+class RelayClient:
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.queue = bytearray(queue_size)
+        self.mv = memoryview(self.queue)
+        self.queued = 0
+        self.event = asyncio.Event()
+        # Waiting for the start of a telegram after an overflow
+        self.syncing = False
+        self.closed = False
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.overflows = 0
+
+    def put(self, data):
+        if self.syncing:
+            pos = bytes(data).find(_SLASH)
+            if pos < 0:
+                self.bytes_dropped += len(data)
+                return
+            self.bytes_dropped += pos
+            data = data[pos:]
+            self.syncing = False
+        n = len(data)
+        if self.queued + n > len(self.queue):
+            self.overflows += 1
+            self.bytes_dropped += self.queued + n
+            self.queued = 0
+            self.syncing = True
+            self.event.set()
+            return
+        self.queue[self.queued:self.queued+n] = data
+        self.queued += n
+        self.event.set()
+
+
+class RawRelay:
+    def __init__(self, queue_size=QUEUE_SIZE, mode=MODE_RAW, timeout=TIMEOUT,
+                 max_overflows=MAX_OVERFLOWS, max_telegram_size=0):
+        # Clients whose queue overflows more than max_overflows times, or
+        # that do not accept any data for timeout seconds, are disconnected.
+        # A telegram is queued in one piece, so outside raw mode the queue
+        # is made to hold one of max_telegram_size, or every telegram would
+        # overflow it.
+        if mode != MODE_RAW and queue_size < max_telegram_size + _CRC_LINE:
+            print('*** Raw queue size %d below a telegram, using %d' %
+                  (queue_size, max_telegram_size + _CRC_LINE))
+            queue_size = max_telegram_size + _CRC_LINE
+        self.queue_size = queue_size
+        self.mode = mode
+        self.timeout = timeout
+        self.max_overflows = max_overflows
+        self.clients = []
+        # Totals of the clients gone, bytes_sent also of those connected
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.overflows = 0
+        self.disconnected = 0
+
+    def totals(self):
+        # Return the bytes sent and dropped and the queue overflows of all
+        # clients, connected or gone
+        dropped = self.bytes_dropped
+        overflows = self.overflows
+        for client in self.clients:
+            dropped += client.bytes_dropped
+            overflows += client.overflows
+        return self.bytes_sent, dropped, overflows
+
+    def feed(self, data):
+        # Queue data read from the UART for all clients, in raw mode. Nothing
+        # is written here so this never blocks, whatever state the client
+        # sockets are in.
+        if self.mode != MODE_RAW:
+            return
+        for client in self.clients:
+            client.put(data)
+
+    def feed_telegram(self, telegram, crc, crc_ok):
+        # Queue a framed telegram, from the '/' up to and including the '!',
+        # followed by its CRC digits, if not in raw mode. The telegram is
+        # written in one piece, terminated by CR LF as sent by the meter.
+        if self.mode == MODE_RAW or (self.mode == MODE_VERIFIED and crc_ok is not True):
+            return
+        for client in self.clients:
+            client.put(telegram)
+            client.put(crc)
+            client.put(_CRLF)
+
+    async def serve(self, reader, writer):
+        # Connection handler for asyncio.start_server
+        client = RelayClient(writer, self.queue_size)
+        print('### Raw client connected from', client.peer)
+        self.clients.append(client)
+        flusher = asyncio.create_task(self._flush(client))
+        try:
+            # Anything sent by the client is ignored, just wait for it to go
+            # away
+            while not client.closed:
+                data = await reader.read(64)
+                if len(data) == 0:
+                    break
+        except OSError:
+            pass
+        self._close(client)
+        flusher.cancel()
+
+    async def _flush(self, client):
+        try:
+            while not client.closed:
+                await client.event.wait()
+                client.event.clear()
+                if client.overflows > self.max_overflows:
+                    print('### Raw client too slow')
+                    break
+                n = client.queued
+                if n == 0:
+                    continue
+                # The stream keeps what is written so the queue can be reused
+                # right away
+                client.writer.write(bytes(client.mv[0:n]))
+                client.queued = 0
+                client.bytes_sent += n
+                self.bytes_sent += n
+                await asyncio.wait_for(client.writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            print('### Raw client error:', repr(e))
+        self._close(client)
+
+    def _close(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        self.clients.remove(client)
+        self.bytes_dropped += client.bytes_dropped
+        self.overflows += client.overflows
+        self.disconnected += 1
+        print('### Raw client %s gone: sent=%d dropped=%d overflows=%d'
+              % (client.peer, client.bytes_sent, client.bytes_dropped, client.overflows))
+        client.writer.close()
@@ -0,0 +1,119 @@
+# Server-Sent Events stream of the decoded telegrams
+#
+# Every telegram is turned into one event holding the measured values as a
+# JSON object keyed by OBIS code, and one holding only the values that
+# changed since the telegram before. Both are serialized once and the same
+# bytes are sent to every client. A client that falls behind skips to the
+# latest event, and is then sent all values even if it asked for the changed
+# ones only, so it never misses a change. With more than one meter, every
+# event holds the values of one meter and the name of it, and the changes
+# of a meter are since its telegram before. A client is then sent the
+# changed values of a meter only if it was sent the event before of that
+# meter.
+#
+#   GET /stream             every value of every telegram
+#   GET /stream?changed=1   only the values that changed
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import json
+
+from p1parser import json_number
+
+# Seconds between comments sent to idle clients, to notice them going away
+KEEPALIVE = 15
+
+HEADERS = ['Content-Type: text/event-stream', 'Cache-Control: no-cache']
+
+
+class EventStream:
+    def __init__(self, keepalive=KEEPALIVE):
+        self.keepalive = keepalive
+        self.clients = 0
+        # Number of the latest event
+        self.seq = 0
+        self.full = b''
+        self.changed = b''
+        # The meter of the latest event, and the number of the event before
+        # of that meter, 0 if none
+        self.meter = None
+        self.prev = 0
+        # Number of the latest event of every meter
+        self._seqs = {}
+        self._last = {}
+        # The JSON item of the name of every meter, escaped once
+        self._meters = {}
+        self._event = asyncio.Event()
+
+    def publish(self, values, ts, meter=None):
+        # Make the events of a telegram at ts in seconds from values, a dict
+        # of OBIS code to (value, unit), and wake up the clients. Only values with a unit
+        # are included. Nothing is made while there are no clients. The
+        # telegrams of more than one meter are told apart by meter, their
+        # name, which is then added to the events.
+        if self.clients == 0:
+            self.full = b''
+            self.changed = b''
+            self._seqs = {}
+            self._last = {}
+            return
+        full = ['"timestamp": %d' % ts]
+        if meter is not None:
+            item = self._meters.get(meter)
+            if item is None:
+                item = self._meters[meter] = '"meter": ' + json.dumps(meter)
+            full.append(item)
+        changed = list(full)
+        last = self._last.get(meter)
+        if last is None:
+            last = self._last[meter] = {}
+        for obis, (value, unit) in values.items():
+            if len(unit) == 0:
+                continue
+            text = json_number(value)
+            if text is None:
+                continue
+            item = '"%s": %s' % (obis, text)
+            full.append(item)
+            if last.get(obis) != text:
+                last[obis] = text
+                changed.append(item)
+        self.seq += 1
+        self.meter = meter
+        self.prev = self._seqs.get(meter, 0)
+        self._seqs[meter] = self.seq
+        self.full = ('id: %d\ndata: {%s}\n\n' % (self.seq, ', '.join(full))).encode()
+        self.changed = ('id: %d\ndata: {%s}\n\n' % (self.seq, ', '.join(changed))).encode()
+        self._event.set()
+        self._event.clear()
+
+    async def serve(self, cl, changed_only=False):
+        # Send the events to the HttpResponse cl until the client goes away
+        cl.start(200, HEADERS)
+        self.clients += 1
+        try:
+            await cl.send(b': p1 exporter\n\n')
+            # A new client is sent all values first, of every meter. The
+            # number of the latest event sent is kept per meter.
+            last = None
+            sent = {}
+            while True:
+                if self.seq == last:
+                    try:
+                        await asyncio.wait_for(self._event.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        await cl.send(b': keepalive\n\n')
+                        continue
+                if changed_only and sent.get(self.meter) == self.prev:
+                    data = self.changed
+                else:
+                    data = self.full
+                last = self.seq
+                sent[self.meter] = last
+                if len(data) > 0:
+                    await cl.send(data)
+        finally:
+            self.clients -= 1
@@ -0,0 +1,41 @@
+# Pages compiled once into byte chunks
+#
+# A template is built at startup from static text and cells, functions
+# returning the text to put in their place. Adjacent static text is joined
+# into one chunk, so rendering a page only calls the cells. The chunks are
+# handed to a write function, like HttpResponse.write, which collects them to
+# be sent in one write.
+
+
+def escape(text):
+    # Escape text for use in HTML, attribute values included
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+class Template:
+    def __init__(self):
+        self.chunks = []
+        self._static = []
+
+    def add(self, text):
+        # Add static text
+        self._static.append(text)
+
+    def cell(self, fn):
+        # Add a cell, fn() returns its text
+        self._flush()
+        self.chunks.append(fn)
+
+    def _flush(self):
+        if len(self._static) > 0:
+            self.chunks.append(''.join(self._static).encode())
+            self._static = []
+
+    def render(self, write):
+        self._flush()
+        for chunk in self.chunks:
+            if type(chunk) == bytes:
+                write(chunk)
+            else:
+                write(chunk())